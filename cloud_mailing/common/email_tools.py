@@ -17,6 +17,7 @@
 
 import email
 import email.header
+import zlib
 
 __author__ = 'Cedric RICARD'
 
@@ -39,3 +40,10 @@ def header_to_unicode(header_str):
             last_encoding = None
             l.append(txt)
     return ''.join(l)
+
+
+def decompress_transcript(data):
+    """
+    Returns the text of an SMTP session transcript, as stored (zlib compressed) by satellites and master.
+    """
+    return zlib.decompress(str(data))
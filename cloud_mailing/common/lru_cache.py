@@ -0,0 +1,90 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import OrderedDict
+
+__author__ = 'Cedric RICARD'
+
+
+class LRUCache(object):
+    """
+    Thread safe dictionary-like cache keeping at most `max_entries` entries.
+    Least recently used entries are dropped first.
+
+    If `max_size` is given, the total size of values, as returned by `sizeof`, is also kept under this limit. Values
+    bigger than `max_size` are never cached.
+    """
+
+    def __init__(self, max_entries=100, max_size=None, sizeof=len):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._pop(key)
+            if self.max_size is not None:
+                value_size = self.sizeof(value)
+                if value_size > self.max_size:
+                    return
+                self.size += value_size
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries \
+                    or self.max_size is not None and self.size > self.max_size:
+                self._pop(next(iter(self._entries)))
+
+    def remove(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def remove_if(self, predicate):
+        """Removes all entries whose key matches the predicate."""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return
+        if self.max_size is not None:
+            self.size -= self.sizeof(value)
@@ -62,8 +62,12 @@ TEST_TARGET_PORT = config.getint('MAILING', 'test_target_port', 33625)  # used f
 TEST_FAKE_DNS = config.getboolean('MAILING', 'test_faked_dns', False)  # used for mailing tests. DNS always returns local ip.
 USE_LOCAL_DNS_CACHE = config.getboolean('MAILING', 'use_local_dns_cache', False)  # mainly used for mailing tests. DNS always returns determined ips for some domains.
 LOCAL_DNS_CACHE_FILE = config.get('MAILING', 'local_dns_cache_filename', os.path.join(PROJECT_ROOT, 'local_dns_cache.ini'))  # mainly used for mailing tests. DNS always returns determined ips for some domains.
+SOURCE_IPS = filter(None, [ip.strip() for ip in config.get('MAILING', 'source_ips', '').split(',')])  # local addresses outgoing connections are spread over. Default one if empty.
+DNS_CACHE_FILE = config.get('MAILING', 'dns_cache_filename', os.path.join(PROJECT_ROOT, 'dns_cache.pickle'))  # DNS answers saved at shutdown and loaded at startup.
 MAIL_TEMP = config.get('MAILING', 'MAIL_TEMP', os.path.join(PROJECT_ROOT, 'temp'))
 CUSTOMIZED_CONTENT_FOLDER = config.get('MAILING', 'CUSTOMIZED_CONTENT_FOLDER', os.path.join(PROJECT_ROOT, 'cust_ml'))
+ATTACHMENTS_CACHE_SIZE = config.getint('MAILING', 'attachments_cache_size', 50 * 1024 * 1024)  # in bytes. Max memory used by encoded attachments cache.
+RENDERED_PARTS_CACHE_SIZE = config.getint('MAILING', 'rendered_parts_cache_size', 20 * 1024 * 1024)  # in characters. Max memory used by rendered text parts cache.
 
 # Create missing folders
 for dir_name in (CUSTOMIZED_CONTENT_FOLDER, MAIL_TEMP):
@@ -0,0 +1,56 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.trial.unittest import TestCase
+from ..lru_cache import LRUCache
+
+__author__ = 'Cedric RICARD'
+
+
+class LRUCacheTestCase(TestCase):
+
+    def test_least_recently_used_is_dropped(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_remove_if(self):
+        cache = LRUCache()
+        cache.set((1, 'subject'), 'a')
+        cache.set((1, '0'), 'b')
+        cache.set((2, '0'), 'c')
+        cache.remove_if(lambda key: key[0] == 1)
+        self.assertEqual(1, len(cache))
+        self.assertIn((2, '0'), cache)
+
+    def test_max_size(self):
+        cache = LRUCache(max_entries=10, max_size=10)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        cache.set('c', 'x' * 4)
+        self.assertEqual(8, cache.size)
+        self.assertNotIn('a', cache)
+        cache.set('d', 'x' * 11)
+        self.assertNotIn('d', cache)
+        cache.remove('b')
+        self.assertEqual(4, cache.size)
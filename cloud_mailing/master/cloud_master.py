@@ -23,7 +23,7 @@ import time
 from datetime import datetime, timedelta
 
 import pymongo
-from bson import ObjectId
+from bson import Binary, ObjectId
 from twisted.cred import checkers, portal, error as cred_error, credentials
 from twisted.internet import reactor, defer
 from twisted.internet.threads import deferToThreadPool
@@ -36,7 +36,7 @@ from twisted.spread.util import CallbackPageCollector
 from zope.interface import implements
 
 from . import settings_vars
-from .models import CloudClient, Mailing, SenderDomain
+from .models import CloudClient, Mailing, SenderDomain, SmtpSession, SatelliteDomainLimits
 from .models import RECIPIENT_STATUS, MAILING_STATUS
 from ..common import settings
 from ..common.db_common import get_db
@@ -349,6 +349,7 @@ class MailingManagerView(pb.Viewable):
                                                  rcpt['reply_enhanced_code'],
                                                  rcpt['reply_text'],
                                                  smtp_log = rcpt['smtp_log'])
+                    recipient.smtp_session = rcpt.get('smtp_session')
                     ml_stats = mailings_stats.setdefault(recipient.mailing.id, {})
                     if recipient.send_status not in (RECIPIENT_STATUS.FINISHED,
                                                      RECIPIENT_STATUS.ERROR,
@@ -434,6 +435,8 @@ class MailingManagerView(pb.Viewable):
                 s.sent = stats['sent']
                 s.failed = stats['failed']
                 s.tries = stats['tries']
+                s.tls_handshakes = stats.get('tls_handshakes', 0)
+                s.tls_resumed = stats.get('tls_resumed', 0)
                 #s.read = stats['read']
                 #s.unsubscribe = stats['unsubscribe']
 
@@ -444,6 +447,48 @@ class MailingManagerView(pb.Viewable):
                 self.log.exception("Can't update statistics: %s", repr(stats))
         return ids_ok
 
+    def view_send_smtp_sessions(self, client, sessions):
+        """
+        Stores SMTP sessions transcripts, referenced by the recipients reports.
+
+        Each session is described by a dictionary with all its attributes, the transcript being zlib compressed.
+        Returns an array with the IDs of successfully stored sessions.
+        """
+        ids_ok = []
+        for session in sessions:
+            try:
+                SmtpSession._get_collection().update(
+                    {'_id': ObjectId(session['_id'])},
+                    {'$set': {'sender': self.cloud_client.serial,
+                              'target': session.get('target'),
+                              'created': session.get('created'),
+                              'failed': session.get('failed', False),
+                              'log': Binary(session['log'])}},
+                    upsert=True)
+                ids_ok.append(session['_id'])
+            except:
+                self.log.exception("Can't store SMTP session [%s]", session.get('_id'))
+        return ids_ok
+
+    def view_send_domain_limits(self, client, limits):
+        """
+        Stores the concurrency limits learned by the satellite for each domain.
+
+        Each limit is a dictionary with 'domain_name', 'queues' and 'messages_per_queue' keys.
+        """
+        self._store_domain_limits(limits, self.cloud_client.serial)
+
+    @staticmethod
+    def _store_domain_limits(limits, serial):
+        now = datetime.utcnow()
+        for limit in limits:
+            SatelliteDomainLimits._get_collection().update_one(
+                {'sender': serial, 'domain_name': limit['domain_name']},
+                {'$set': {'queues': limit['queues'],
+                          'messages_per_queue': limit['messages_per_queue'],
+                          'updated': now}},
+                upsert=True)
+
 
 class CloudRealm:
     implements(portal.IRealm)
@@ -30,6 +30,8 @@ __author__ = 'Cedric RICARD'
 
 def init_master_db(db):
     create_index(db.mailingrecipient, [('next_try', pymongo.ASCENDING)])
+    create_index(db.satellitedomainlimits, [('sender', pymongo.ASCENDING), ('domain_name', pymongo.ASCENDING)],
+                 unique=True)
     do_migrations(db)
 
 
@@ -74,7 +76,18 @@ def _0002_set_subject(db):
         db.mailing.update_one({'_id': mailing['_id']}, {'$set': {'subject': subject}})
 
 
+def _0003_move_domain_limits(db):
+    for client in db.cloudclient.find({'domain_limits': {'$exists': True}}, projection=('serial', 'domain_limits')):
+        for limit in client['domain_limits'] or []:
+            db.satellitedomainlimits.update_one({'sender': client['serial'], 'domain_name': limit['domain_name']},
+                                                {'$set': {'queues': limit['queues'],
+                                                          'messages_per_queue': limit['messages_per_queue']}},
+                                                upsert=True)
+    db.cloudclient.update_many({}, {'$unset': {'domain_limits': True}})
+
+
 migrations = [
     _0001_remove_temp_queue,
     _0002_set_subject,
+    _0003_move_domain_limits,
 ]
@@ -251,7 +251,8 @@ class MailingRecipient(Model):
     reply_code     = Field(int)
     reply_enhanced_code = Field()
     reply_text = Field()
-    smtp_log         = Field()
+    smtp_log         = Field()  # its own part of the SMTP session transcript
+    smtp_session     = Field()  # id of the SmtpSession holding the whole transcript, if stored
     dsn              = Field()  # Delivery Status Notification (if received) RFC-3464
     in_progress     = Field(bool, default=False)  # added to a satellite for sending
     report_ready    = Field(bool, default=False)  # data ready to report to API client
@@ -300,6 +301,24 @@ class MailingRecipient(Model):
             self.next_try = datetime.utcnow() + timedelta(hours=6)
 
 
+class SmtpSession(Model):
+    """Whole transcript of an SMTP session made by a satellite, shared by all recipients sent through it."""
+    sender      = Field()   # Serial of the satellite
+    target      = Field()   # server address
+    created     = Field(datetime)
+    failed      = Field(bool, default=False)  # True if an email was refused or if the connection was lost
+    log         = Field()   # zlib compressed transcript
+
+
+class SatelliteDomainLimits(Model):
+    """Concurrency limits learned by a satellite for a domain. There is one document per satellite and domain."""
+    sender              = Field()   # Serial of the satellite
+    domain_name         = Field()
+    queues              = Field(int)
+    messages_per_queue  = Field(int)
+    updated             = Field(datetime)
+
+
 class MailingHourlyStats(Model):
     sender      = Field()   # Serial of the sender
     date        = Field(datetime)
@@ -307,6 +326,8 @@ class MailingHourlyStats(Model):
     sent        = Field(int, default=0)
     failed      = Field(int, default=0)
     tries       = Field(int, default=0)  # Total tentatives count, including sent, failed and temporary failed.
+    tls_handshakes = Field(int, default=0)  # successful TLS handshakes, including resumed sessions
+    tls_resumed = Field(int, default=0)  # TLS sessions resumed (abbreviated handshakes)
 
     # class Meta:
     #     database = DATABASE
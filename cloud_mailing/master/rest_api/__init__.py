@@ -27,6 +27,7 @@ from twisted.web.resource import Resource
 from twisted.web.server import Session
 from twisted.web.xmlrpc import Proxy
 
+from .domain_limits import ListDomainLimitsApi
 from .hourly_stats import HourlyStatsApi
 from .satellites import ListSatellitesApi
 from .mailings import ListMailingsApi
@@ -233,5 +234,6 @@ def make_rest_api(xmlrpc_port=33610, xmlrpc_use_ssl=True, api_key=None):
     api.putChild('recipients', ListRecipientsApi())
     api.putChild('satellites', ListSatellitesApi())
     api.putChild('hourly-stats', HourlyStatsApi())
+    api.putChild('domain-limits', ListDomainLimitsApi())
     api.putChild('os', OsApi())
     return api
\ No newline at end of file
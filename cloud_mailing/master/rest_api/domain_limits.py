@@ -0,0 +1,33 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+from twisted.web.resource import Resource
+
+from .. import serializers
+from ...common.rest_api_common import ApiResource, ListModelMixin
+
+__author__ = 'Cedric RICARD'
+
+
+class ListDomainLimitsApi(ListModelMixin, ApiResource):
+    """
+    Resource to list the concurrency limits learned by satellites, per domain. They may be filtered by 'sender'
+    (satellite serial) and 'domain_name'.
+    """
+    serializer_class = serializers.SatelliteDomainLimitsSerializer
+
+    def __init__(self):
+        Resource.__init__(self)
@@ -223,7 +223,7 @@ class RecipientSerializer(Serializer):
     model_class = models.MailingRecipient
     fields = (
         '_id', 'email', 'send_status', 'tracking_id',
-        'reply_code', 'reply_enhanced_code', 'reply_text', 'smtp_log',
+        'reply_code', 'reply_enhanced_code', 'reply_text', 'smtp_log', 'smtp_session',
         'modified',
         'first_try', 'next_try', 'try_count',
         'in_progress',
@@ -260,13 +260,21 @@ class SatelliteSerializer(Serializer):
     model_class = models.CloudClient
     fields = (
         '_id', 'serial', 'enabled', 'paired', 'date_paired', 'shared_key', 'domain_affinity', 'group', 'version',
-        'settings'
+        'settings',
     )
 
+
+class SatelliteDomainLimitsSerializer(Serializer):
+    model_class = models.SatelliteDomainLimits
+    fields = (
+        '_id', 'sender', 'domain_name', 'queues', 'messages_per_queue', 'updated'
+    )
+
+
 class HourlyStatsSerializer(Serializer):
     model_class = models.MailingHourlyStats
     fields = (
-        'sender', 'date', 'epoch_hour', 'sent', 'failed', 'tries'
+        'sender', 'date', 'epoch_hour', 'sent', 'failed', 'tries', 'tls_handshakes', 'tls_resumed'
     )
 
     # def make_filter(self, args):
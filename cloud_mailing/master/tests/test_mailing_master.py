@@ -528,6 +528,27 @@ class SendReportTest(DatabaseMixin, TestCase):
         self.assertEquals(30, ml2.total_error)
 
 
+class DomainLimitsTest(DatabaseMixin, TestCase):
+
+    def setUp(self):
+        self.connect_to_db()
+
+    def tearDown(self):
+        self.disconnect_from_db()
+
+    def test_store_domain_limits(self):
+        MailingManagerView._store_domain_limits([{'domain_name': 'a.com', 'queues': 2, 'messages_per_queue': 20},
+                                                 {'domain_name': 'b.com', 'queues': 1, 'messages_per_queue': 10}],
+                                                "SERIAL")
+        MailingManagerView._store_domain_limits([{'domain_name': 'a.com', 'queues': 3, 'messages_per_queue': 30}],
+                                                "SERIAL")
+        MailingManagerView._store_domain_limits([{'domain_name': 'a.com', 'queues': 1, 'messages_per_queue': 5}],
+                                                "OTHER")
+        self.assertEqual(3, models.SatelliteDomainLimits.count())
+        limit = models.SatelliteDomainLimits.find_one({'sender': "SERIAL", 'domain_name': 'a.com'})
+        self.assertEqual((3, 30), (limit.queues, limit.messages_per_queue))
+
+
 class MailingManagerQueries(DatabaseMixin, TestCase):
 
     def setUp(self):
@@ -20,7 +20,8 @@ from datetime import datetime
 from twisted.trial import unittest
 
 from ...common.unittest_mixins import DatabaseMixin
-from ..db_initialization import do_migrations, init_master_db, migrations, _0001_remove_temp_queue
+from ..db_initialization import do_migrations, init_master_db, migrations, _0001_remove_temp_queue, \
+    _0003_move_domain_limits
 from . import factories
 
 __author__ = 'Cedric RICARD'
@@ -112,4 +113,18 @@ class MigrationsTestCase(DatabaseMixin, unittest.TestCase):
         self.assertEqual('my-company.biz', recipient['domain_name'])
         self.assertEqual(False, recipient['in_progress'])
 
-        self.assertFalse('mailingtempqueue' in self.db_sync.collection_names())
\ No newline at end of file
+        self.assertFalse('mailingtempqueue' in self.db_sync.collection_names())
+
+    def test_0003_move_domain_limits(self):
+        client = factories.CloudClientFactory()
+        self.db_sync.cloudclient.update_one({'_id': client.id}, {'$set': {'domain_limits': [
+            {'domain_name': 'a.com', 'queues': 3, 'messages_per_queue': 40},
+            {'domain_name': 'b.com', 'queues': 1, 'messages_per_queue': 10},
+        ]}})
+
+        _0003_move_domain_limits(self.db_sync)
+
+        self.assertNotIn('domain_limits', self.db_sync.cloudclient.find_one({'_id': client.id}))
+        self.assertEqual(2, self.db_sync.satellitedomainlimits.count({'sender': client.serial}))
+        limit = self.db_sync.satellitedomainlimits.find_one({'sender': client.serial, 'domain_name': 'a.com'})
+        self.assertEqual((3, 40), (limit['queues'], limit['messages_per_queue']))
@@ -18,7 +18,7 @@
 from datetime import datetime
 import base64
 
-from ..models import MAILING_STATUS, Mailing
+from ..models import MAILING_STATUS, Mailing, SatelliteDomainLimits
 from . import factories
 import json
 from twisted.web.http_headers import Headers
@@ -334,3 +334,25 @@ class RecipientTestCase(CommonTestMixin, DatabaseMixin, RestApiTestMixin, TestCa
         return d
 
 
+class DomainLimitsTestCase(CommonTestMixin, DatabaseMixin, RestApiTestMixin, TestCase):
+
+    def setUp(self):
+        self.connect_to_db()
+        self.start_rest_api()
+        self.setup_settings()
+
+    def tearDown(self):
+        self.clear_settings()
+        return self.stop_rest_api().addBoth(lambda x: self.disconnect_from_db())
+
+    def test_list_domain_limits(self):
+        """
+        List domain limits of a satellite
+        """
+        SatelliteDomainLimits.create(sender='CXM_1', domain_name='a.com', queues=2, messages_per_queue=20)
+        SatelliteDomainLimits.create(sender='CXM_2', domain_name='a.com', queues=1, messages_per_queue=10)
+        d = self.call_api('GET', "/domain-limits?sender=CXM_1", http_status.HTTP_200_OK,
+                          credentials=('admin', self.api_key))
+        d.addCallback(lambda x: self.assertEqual(1, len(x['items'])) and x)
+        d.addCallback(lambda x: self.assertEqual(2, x['items'][0]['queues']) and x)
+        return d
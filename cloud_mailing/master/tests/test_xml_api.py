@@ -20,6 +20,9 @@ import email
 import logging
 from datetime import datetime, timedelta
 import os
+import zlib
+
+from bson import Binary
 
 from twisted.internet import reactor
 from twisted.trial.unittest import TestCase
@@ -34,7 +37,7 @@ from ..cloud_master import MailingManagerView
 from .factories import MailingFactory, RecipientFactory, CloudClientFactory
 from ...common.models import Settings
 from ..xmlrpc_api import CloudMailingRpc
-from ..models import Mailing, MAILING_STATUS, RECIPIENT_STATUS, MailingHourlyStats, MailingRecipient
+from ..models import Mailing, MAILING_STATUS, RECIPIENT_STATUS, MailingHourlyStats, MailingRecipient, SmtpSession
 from ...common import settings
 from ...common.config_file import ConfigFile
 
@@ -770,6 +773,16 @@ class XmlRpcMailingTestCase(DatabaseMixin, TestCase):
         d.addCallback(lambda x: self.assertEqual(MailingRecipient.find_one({'email': "4@2.fr"}).send_status, RECIPIENT_STATUS.FINISHED) and x)
         return d
 
+    def test_get_smtp_session(self):
+        session = SmtpSession.create(sender='CXM_SERIAL', target='10.0.0.1', failed=True,
+                                     log=Binary(zlib.compress('>>> EHLO localhost\n<<< 250 OK')))
+        d = self.proxy().callRemote("get_smtp_session", str(session.id))
+        d.addCallback(lambda x: self.assertEqual(x['log'], '>>> EHLO localhost\n<<< 250 OK') and x)
+        d.addCallback(lambda x: self.assertEqual(x['target'], '10.0.0.1') and x)
+        d.addCallback(lambda x: self.assertTrue(x['failed']) and x)
+        d.addCallback(lambda x: self.proxy().callRemote("get_smtp_session", 'unknown'))
+        return self.assertFailure(d, xmlrpc.Fault)
+
     def test_get_recipients_count(self):
         """
         Count all recipients matching a filter
@@ -31,7 +31,8 @@ from StringIO import StringIO
 from datetime import datetime, timedelta
 
 import pymongo
-from bson import DBRef
+from bson import DBRef, ObjectId
+from bson.errors import InvalidId
 from mogo.connection import Connection
 from twisted.internet import defer
 from twisted.internet.threads import deferToThread
@@ -43,11 +44,12 @@ from .api_common import set_mailing_properties, start_mailing
 from .cloud_master import make_customized_file_name
 from .mailing_manager import MailingManager
 from .models import CloudClient, Mailing, relay_status, MAILING_STATUS, MailingRecipient, RECIPIENT_STATUS, \
-    recipient_status
+    recipient_status, SmtpSession
 from .serializers import MailingSerializer
 from ..common import settings
 from ..common.config_file import ConfigFile
 from ..common.db_common import get_db
+from ..common.email_tools import decompress_transcript
 from ..common.html_tools import strip_tags
 from ..common.xml_api_common import withRequest, doc_signature, BasicHttpAuthXMLRPC, XMLRPCDocGenerator, doc_hide
 
@@ -735,7 +737,8 @@ class CloudMailingRpc(BasicHttpAuthXMLRPC, XMLRPCDocGenerator):
                 - reply_code: the error code returned by remote SMTP server
                 - reply_enhanced_code: The enhanced error code, if remote SMTP server supports ESMTP protocol
                 - reply_text: The full message returned by remote SMTP server.
-                - smtp_log: The full SMTP transaction log
+                - smtp_log: the part of the SMTP session log for this recipient
+                - smtp_session: id of the stored SMTP session transcript, if any (see get_smtp_session())
                 - modified: last modification date
                 - first_try: The first time the recipient has been tried
                 - next_try: When we will try to send email again (if case of soft bound)
@@ -822,7 +825,8 @@ class CloudMailingRpc(BasicHttpAuthXMLRPC, XMLRPCDocGenerator):
                 - reply_code: the error code returned by remote SMTP server
                 - reply_enhanced_code: The enhanced error code, if remote SMTP server supports ESMTP protocol
                 - reply_text: The full message returned by remote SMTP server.
-                - smtp_log: the full log of the SMTP transaction
+                - smtp_log: the part of the SMTP session log for this recipient
+                - smtp_session: id of the stored SMTP session transcript, if any (see get_smtp_session())
                 - modified: last modification date
                 - first_try: The first time the recipient has been tried
                 - next_try: When we will try to send email again (if case of soft bound)
@@ -934,6 +938,34 @@ class CloudMailingRpc(BasicHttpAuthXMLRPC, XMLRPCDocGenerator):
             return 0
         return deferToThread(_reset_recipients_status, recipient_ids)
 
+    @withRequest
+    @doc_signature('<i>string</i> session_id', '<i>struct</i> SMTP session')
+    def xmlrpc_get_smtp_session(self, request, session_id):
+        """
+        Returns the whole transcript of an SMTP session, as referenced by the 'smtp_session' field of recipients status.
+        :param session_id: id of the SMTP session
+        :return: A structure containing following keys:
+                - id: SMTP session id
+                - sender: serial of the satellite which made the session
+                - target: address of the remote SMTP server
+                - created: session date
+                - failed: True if an email was refused or if the connection was lost
+                - log: the SMTP session transcript
+        """
+        log_api.debug("XMLRPC: get_smtp_session(%s)", session_id)
+        def _get_smtp_session(session_id):
+            try:
+                session = SmtpSession._get_collection().find_one({'_id': ObjectId(session_id)})
+            except InvalidId:
+                session = None
+            if not session:
+                raise Fault(http.NOT_FOUND, "Unknown SMTP session '%s'" % session_id)
+            session['id'] = str(session.pop('_id'))
+            session['log'] = decompress_transcript(session['log']).decode('utf-8', 'replace')
+            ensure_no_null_values(session)
+            return session
+        return deferToThread(_get_smtp_session, session_id)
+
     # -------------------------------------
     # Statistics functions
 
@@ -81,13 +81,15 @@ class CloudClient(pb.Referenceable):
         if self.mailing_queue:
             if activated:
                 self.mailing_queue.delay_if_empty = 1
-                self.mailing_queue.nextTime = 0
+                self.mailing_queue.forceToCheck()
             else:
                 self.mailing_queue.delay_if_empty = 10
 
     def remote_set_settings(self, settings):
         for key, value in settings.items():
             Settings.set(key, value)
+        if self.mailing_queue:
+            self.mailing_queue.domain_configs.invalidate()
 
     def remote_close_mailing(self, mailing_id):
         """Ask queue to remove all recipients from this mailing id."""
@@ -96,12 +98,9 @@ class CloudClient(pb.Referenceable):
     def remote_mailing_changed(self, mailing_id):
         """Informs satellite that mailing content has changed."""
         Mailing.update({'_id': mailing_id}, {'$set': {'body_downloaded': False}})
-        import os, glob
-        for entry in glob.glob(os.path.join(settings.MAIL_TEMP, MailCustomizer.make_patten_for_queue(mailing_id))):
-            try:
-                os.remove(entry)
-            except Exception:
-                log.exception("Can't remove customized file '%s'", entry)
+        MailCustomizer.invalidate_mailing_content(mailing_id)
+        if self.mailing_queue:
+            self.mailing_queue.spool.release_mailing(mailing_id)
 
     def remote_get_recipients_list(self):
         """
@@ -0,0 +1,163 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from datetime import datetime
+
+from .models import DomainConcurrency
+
+__author__ = 'ricard'
+
+
+class _DomainState(object):
+    def __init__(self, queues, messages):
+        self.queues = queues
+        self.messages = messages
+        self.sent = 0  # messages sent since the last change of the window
+        self.last_decrease = None
+        self.deferrals = []  # times of the recent deferrals
+        self.dirty = False
+
+
+class ConcurrencyController(object):
+    """
+    Adapts, for each domain, the count of queues and the count of messages per queue (AIMD algorithm).
+
+    Each time a whole window (queues * messages) has been sent, both are raised additively, by `queues_increase`
+    and `messages_increase`. Congestion signals (421 replies, connection failures, timeouts, slow greetings) cut them
+    by `decrease_factor`. A burst of signals only leads to a single cut per `decrease_interval` seconds.
+
+    Other 4xx replies may only concern a recipient (greylisting, full mailbox, ...). They are deferrals, and only
+    `deferrals_threshold` deferrals within `deferrals_window` seconds are a congestion signal.
+
+    Values are bounded by the limits given to `get_limits()`. The same instance may be used by reactor's threads.
+    """
+
+    def __init__(self, initial_queues=1, queues_increase=1, messages_increase=10, min_messages=1,
+                 decrease_factor=0.5, decrease_interval=60, deferrals_threshold=5, deferrals_window=60, clock=None):
+        self.initial_queues = initial_queues
+        self.queues_increase = queues_increase
+        self.messages_increase = messages_increase
+        self.min_messages = min_messages
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self.deferrals_threshold = deferrals_threshold
+        self.deferrals_window = deferrals_window
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.log = logging.getLogger('concurrency')
+        self._domains = {}
+        self._bounds = {}  # key = domain, value = (max_queues, max_messages) given by the last get_limits() call
+        self._lock = threading.Lock()
+
+    def get_limits(self, domain, max_queues, max_messages):
+        """Returns the allowed (queues, messages per queue) for the domain, within the given limits."""
+        with self._lock:
+            self._bounds[domain] = (max_queues, max_messages)
+            state = self._domains.get(domain)
+            if state is None:
+                state = self._domains[domain] = _DomainState(self.initial_queues, max_messages)
+            self._clamp(domain, state)
+            return int(state.queues), int(state.messages)
+
+    def _clamp(self, domain, state):
+        max_queues, max_messages = self._bounds.get(domain, (None, None))
+        if max_queues is not None:
+            state.queues = max(1.0, min(state.queues, max_queues))
+        if max_messages is not None:
+            state.messages = max(min(self.min_messages, max_messages), min(state.messages, max_messages))
+
+    def on_success(self, domain):
+        """A message has been accepted by the server."""
+        with self._lock:
+            state = self._domains.get(domain)
+            if state is None:
+                return
+            state.sent += 1
+            if state.sent >= int(state.queues) * int(state.messages):
+                state.sent = 0
+                queues, messages = state.queues, state.messages
+                state.queues += self.queues_increase
+                state.messages += self.messages_increase
+                self._clamp(domain, state)
+                state.dirty |= (queues, messages) != (state.queues, state.messages)
+
+    def on_congestion(self, domain, reason):
+        """The server is congested: it replied 421, failed, timed out, or was slow to answer."""
+        with self._lock:
+            state = self._domains.get(domain)
+            if state is None:
+                return
+            self._decrease(domain, state, reason)
+
+    def on_deferral(self, domain, reason):
+        """The server deferred a message with another 4xx reply."""
+        with self._lock:
+            state = self._domains.get(domain)
+            if state is None:
+                return
+            now = self.clock.seconds()
+            state.deferrals = [t for t in state.deferrals if now - t < self.deferrals_window]
+            state.deferrals.append(now)
+            if len(state.deferrals) >= self.deferrals_threshold:
+                state.deferrals = []
+                self._decrease(domain, state, "%d deferrals, last one: %s" % (self.deferrals_threshold, reason))
+
+    def _decrease(self, domain, state, reason):
+        now = self.clock.seconds()
+        if state.last_decrease is not None and now - state.last_decrease < self.decrease_interval:
+            return
+        state.last_decrease = now
+        state.sent = 0
+        state.queues *= self.decrease_factor
+        state.messages *= self.decrease_factor
+        self._clamp(domain, state)
+        state.dirty = True
+        self.log.info("Congestion for '%s' (%s). Limits are now %d queues of %d messages", domain, reason,
+                      state.queues, state.messages)
+
+    def as_list(self):
+        """Returns the learned limits, as dicts with 'domain_name', 'queues' and 'messages_per_queue' keys."""
+        with self._lock:
+            return [self._as_dict(domain, state) for domain, state in self._domains.items()]
+
+    @staticmethod
+    def _as_dict(domain, state):
+        return {'domain_name': domain, 'queues': int(state.queues), 'messages_per_queue': int(state.messages)}
+
+    def load(self):
+        """Reads limits learned before the last restart."""
+        with self._lock:
+            for entry in DomainConcurrency.find():
+                self._domains[entry.domain_name] = _DomainState(entry.queues, entry.messages_per_queue)
+        self.log.debug("Concurrency limits loaded for %d domains", len(self._domains))
+
+    def save(self):
+        """Stores the limits changed since the last call. Returns them, as `as_list()` does."""
+        with self._lock:
+            changed = [(domain, state.queues, state.messages, self._as_dict(domain, state))
+                       for domain, state in self._domains.items() if state.dirty]
+            for domain, state in self._domains.items():
+                state.dirty = False
+        for domain, queues, messages, limit in changed:
+            DomainConcurrency.update({'domain_name': domain},
+                                     {'$set': {'queues': queues, 'messages_per_queue': messages,
+                                               'updated': datetime.utcnow()}},
+                                     upsert=True)
+        return [limit for domain, queues, messages, limit in changed]
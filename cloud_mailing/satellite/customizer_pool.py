@@ -0,0 +1,151 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import cPickle
+import logging
+import multiprocessing
+import signal
+
+from twisted.internet import defer, reactor, task
+from twisted.python.failure import Failure
+
+from .mail_customizer import MailCustomizer
+from .models import Mailing
+
+__author__ = 'ricard'
+
+
+def _init_worker():
+    # Ctrl-C is handled by the satellite process which will terminate the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # SIGTERM handler inherited from the reactor would prevent the pool to terminate idle workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _customize(recipient, mailing, with_content=True):
+    """
+    Executed into a worker process. The mailing skeleton and compiled templates stay in the process memory for next
+    recipients of the same mailing.
+
+    Returns a tuple (success, result) where result is the customizer result or the raised exception, or (None, None)
+    if the mailing was given without its content (`with_content` is False) and the process doesn't have it yet.
+    """
+    try:
+        if not with_content:
+            skeleton = MailCustomizer.mailingsContent.get(mailing.id, None)
+            if skeleton is None or skeleton.modified != mailing.modified:
+                return None, None
+        customizer = MailCustomizer(recipient, mailing.read_tracking, mailing.click_tracking, mailing.url_encoding,
+                                    mailing=mailing)
+        return True, customizer._run_customizer()
+    except Exception, ex:
+        try:
+            cPickle.dumps(ex, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            ex = Exception(repr(ex))
+        return False, ex
+
+
+class CustomizerPool(object):
+    """
+    Pool of processes used to customize emails, allowing the satellite to use all CPU cores.
+
+    The pool only calls back for results successfully sent back by workers. Pending results are also checked every
+    `poll_interval` seconds, so other failures (arguments or result which can't be pickled) and customizations
+    lasting more than `timeout` seconds (killed worker) fire their deferred too.
+
+    Mailings are sent to workers without their content, which is only sent again to workers that don't have it yet.
+    """
+    CONTENT_FIELDS = ('header', 'body')
+
+    def __init__(self, processes, timeout=120, poll_interval=1, clock=None):
+        self.log = logging.getLogger("mailing")
+        self.processes = processes
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        # list of (AsyncResult, deferred, deadline, recipient, mailing), only used from the reactor thread
+        self._pending = []
+        self._light_mailings = {}  # key = mailing__id, value = mailing without its content
+        self._poller = task.LoopingCall(self._check_results)
+        self._poller.clock = clock
+        self._pool = multiprocessing.Pool(processes, initializer=_init_worker)
+        self.log.info("Customizer pool started with %d processes", processes)
+
+    def customize(self, recipient, mailing):
+        """
+        Customizes the mailing for the recipient into a worker process.
+
+        @return: a deferred fired with the customizer result (same as L{MailCustomizer.customize})
+        """
+        d = defer.Deferred()
+        self._apply(d, recipient, mailing, with_content=False)
+        if not self._poller.running:
+            self._poller.start(self.poll_interval, now=False)
+        return d
+
+    def _apply(self, d, recipient, mailing, with_content):
+        args = (recipient, with_content and mailing or self._get_light_mailing(mailing), with_content)
+        result = self._pool.apply_async(_customize, args, callback=self._on_result)
+        self._pending.append((result, d, self.clock.seconds() + self.timeout, recipient, mailing))
+
+    def _get_light_mailing(self, mailing):
+        """Returns a copy of the mailing without its content, cheap to send to workers for each recipient."""
+        light_mailing = self._light_mailings.get(mailing.id, None)
+        if light_mailing is None or light_mailing.modified != mailing.modified:
+            light_mailing = Mailing(**dict([(key, value) for key, value in mailing.items()
+                                            if key not in self.CONTENT_FIELDS]))
+            self._light_mailings[mailing.id] = light_mailing
+        return light_mailing
+
+    def _on_result(self, result):
+        # called by a pool's thread
+        reactor.callFromThread(self._check_results)
+
+    def _check_results(self):
+        now = self.clock.seconds()
+        pending = self._pending
+        self._pending = []
+        for result, d, deadline, recipient, mailing in pending:
+            if result.ready():
+                try:
+                    success, value = result.get(0)
+                except Exception:
+                    d.errback(Failure())
+                    continue
+                if success is None:
+                    self._apply(d, recipient, mailing, with_content=True)
+                elif success:
+                    d.callback(value)
+                else:
+                    d.errback(value)
+            elif now >= deadline:
+                d.errback(multiprocessing.TimeoutError("Customization not finished after %d seconds" % self.timeout))
+            else:
+                self._pending.append((result, d, deadline, recipient, mailing))
+        if not self._pending and self._poller.running:
+            self._poller.stop()
+
+    def close(self):
+        self.log.info("Stopping customizer pool")
+        if self._poller.running:
+            self._poller.stop()
+        self._light_mailings.clear()
+        self._pool.terminate()
+        self._pool.join()
@@ -0,0 +1,248 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import itertools
+import logging
+import re
+import time
+
+import dkim
+from dkim.canonicalization import CanonicalizationPolicy, Relaxed
+from dkim.crypto import parse_pem_private_key, UnparsableKeyError
+
+__author__ = 'ricard'
+
+
+class BodyHasher(object):
+    """
+    Computes the DKIM body hash of a message given by chunks, without needing the whole body at once.
+
+    Gives the same result than the canonicalization and hash of the full body made by dkimpy.
+    """
+    re_eol = re.compile(r"\r?\n")
+    re_trailing_whitespace = re.compile(r"[\t ]+\r\n")
+    re_whitespace = re.compile(r"[\t ]+")
+    re_trailing_lines = re.compile(r"(?:\r\n)+\Z")
+
+    def __init__(self, hasher, relaxed=False):
+        self.hash = hasher()
+        self.relaxed = relaxed
+        self.length = 0  # canonicalized body length
+        self._pending = ''  # last line, not yet terminated
+        self._empty_lines = 0  # empty lines not yet hashed, as they are ignored at end of body
+
+    def update(self, data):
+        data = self._pending + data
+        eol = data.rfind('\n')
+        if eol < 0:
+            self._pending = data
+            return
+        self._pending = data[eol + 1:]
+        lines = self.re_eol.sub('\r\n', data[:eol + 1])
+        if self.relaxed:
+            lines = self.re_whitespace.sub(' ', self.re_trailing_whitespace.sub('\r\n', lines))
+        m = self.re_trailing_lines.search(lines)
+        empty_lines = (m.end() - m.start()) / 2
+        content = lines[:m.start()]
+        if content:
+            self._write('\r\n' * self._empty_lines + content + '\r\n')
+            self._empty_lines = empty_lines - 1
+        else:
+            self._empty_lines += empty_lines
+
+    def _write(self, data):
+        self.hash.update(data)
+        self.length += len(data)
+
+    def result(self):
+        """Returns the body hash, base64 encoded, and the canonicalized body length."""
+        last_line = self._pending
+        if self.relaxed:
+            last_line = self.re_whitespace.sub(' ', last_line)
+        if last_line:
+            self._write('\r\n' * self._empty_lines + last_line + '\r\n')
+        elif not self.length:
+            self._write('\r\n')
+        return base64.b64encode(self.hash.digest()), self.length
+
+
+class DkimSigner(object):
+    """
+    Computes DKIM signatures using always the same settings.
+
+    The private key is parsed only once, at creation.
+    """
+
+    def __init__(self, selector, domain, privkey, identity=None, canonicalize=(b'relaxed', b'simple'),
+                 signature_algorithm=b'rsa-sha256', include_headers=None, length=False, extra_headers=()):
+        """
+        @param extra_headers: headers to sign in addition to `include_headers` (or to default ones).
+        """
+        try:
+            self.private_key = parse_pem_private_key(privkey)
+        except UnparsableKeyError as e:
+            raise dkim.KeyFormatError(str(e))
+        if identity is not None and not identity.endswith(domain):
+            raise dkim.ParameterError("identity must end with domain")
+        if signature_algorithm not in dkim.HASH_ALGORITHMS:
+            raise dkim.ParameterError("Unsupported signature algorithm: " + signature_algorithm)
+        self.selector = selector
+        self.domain = domain
+        self.identity = identity
+        self.canon_policy = CanonicalizationPolicy.from_c_value(b'/'.join(canonicalize))
+        self.signature_algorithm = signature_algorithm
+        self.hasher = dkim.HASH_ALGORITHMS[signature_algorithm]
+        self.include_headers = include_headers
+        self.length = length
+        self.extra_headers = list(extra_headers)
+
+    @classmethod
+    def from_settings(cls, dkim_settings, extra_headers=()):
+        """Creates a signer from mailing dkim settings."""
+        return cls(dkim_settings['selector'], dkim_settings['domain'], dkim_settings['privkey'],
+                   canonicalize=dkim_settings.get('canonicalize', (b'relaxed', b'simple')),
+                   signature_algorithm=dkim_settings.get('signature_algorithm', b'rsa-sha256'),
+                   include_headers=dkim_settings.get('include_headers'),
+                   length=dkim_settings.get('length', False),
+                   extra_headers=extra_headers)
+
+    @property
+    def body_hash_key(self):
+        """Signers having the same key share the same body hash."""
+        return self.canon_policy.body_algorithm, self.signature_algorithm
+
+    def make_body_hasher(self):
+        return BodyHasher(self.hasher, relaxed=self.canon_policy.body_algorithm is Relaxed)
+
+    def sign(self, message, body_hashes):
+        """
+        Returns the DKIM-Signature header line for a message.
+
+        @param message: a `dkim.DKIM` object holding the parsed message headers.
+        @param body_hashes: dictionary giving for each `body_hash_key` the result of the `BodyHasher`.
+        @return: the DKIM-Signature header, terminated by '\\n'
+        """
+        if self.include_headers is None:
+            include_headers = message.default_sign_headers()
+        else:
+            include_headers = list(self.include_headers)
+        include_headers = tuple([x.lower() for x in include_headers + self.extra_headers])
+        if b'from' not in include_headers:
+            raise dkim.ParameterError("The From header field MUST be signed")
+        for x in set(include_headers).intersection(message.should_not_sign):
+            raise dkim.ParameterError("The %s header field SHOULD NOT be signed" % x)
+
+        bodyhash, body_length = body_hashes[self.body_hash_key]
+
+        sigfields = [x for x in [
+            (b'v', b"1"),
+            (b'a', self.signature_algorithm),
+            (b'c', self.canon_policy.to_c_value()),
+            (b'd', self.domain),
+            (b'i', self.identity or b"@" + self.domain),
+            self.length and (b'l', str(body_length).encode('ascii')),
+            (b'q', b"dns/txt"),
+            (b's', self.selector),
+            (b't', str(int(time.time())).encode('ascii')),
+            (b'h', b" : ".join(include_headers)),
+            (b'bh', bodyhash),
+            # b= is folded onto its own line (see dkim.DKIM.sign)
+            (b'b', b'0' * 60),
+        ] if x]
+
+        message.hasher = self.hasher
+        sig = message.gen_header(sigfields, include_headers, self.canon_policy, b"DKIM-Signature", self.private_key)
+        return str((b'DKIM-Signature: ' + sig).replace(b'\r\n', b'\n'))
+
+
+class MailingSigner(object):
+    """
+    Signs customized emails of a mailing: DKIM signature, then Feedback-ID header with its own signature.
+
+    Message is given as a list of strings (segments). Its body is hashed segment by segment, only once for both
+    signatures, and signature headers are returned as a new segment, so the message is never copied.
+    """
+
+    def __init__(self, mailing, logger=None):
+        self.log = logger or logging.getLogger("mailing")
+        self.modified = mailing.modified
+        self.dkim_signer = None
+        self.fbl_signer = None
+        self.fbl_header = None
+
+        dkim_settings = mailing.get('dkim', None)
+        if dkim_settings and dkim_settings.get('enabled', True):
+            self.dkim_signer = DkimSigner.from_settings(dkim_settings)
+
+        fbl_settings = mailing.get('feedback_loop', None) or {}
+        fbl_dkim_settings = fbl_settings.get('dkim', None)
+        sender_id = fbl_settings.get('sender_id', None)
+        if fbl_dkim_settings and sender_id:
+            campaign_id = fbl_settings.get('campaign_id', mailing.id)
+            customer_id = fbl_settings.get('customer_id', mailing.domain_name)
+            mail_type_id = fbl_settings.get('mail_type_id', mailing.type)
+            self.fbl_header = 'Feedback-ID: %s:%s:%s:%s\n' % (campaign_id, customer_id, mail_type_id, sender_id)
+            self.fbl_signer = DkimSigner.from_settings(fbl_dkim_settings, extra_headers=[b'Feedback-ID'])
+
+    def sign(self, segments):
+        """Returns the message segments preceded by the signature headers."""
+        signers = filter(None, (self.dkim_signer, self.fbl_signer))
+        if not signers:
+            return segments
+        headers, body = self._split_message(segments)
+        hashers = {}
+        for signer in signers:
+            if signer.body_hash_key not in hashers:
+                hashers[signer.body_hash_key] = signer.make_body_hasher()
+        for chunk in body:
+            for hasher in hashers.values():
+                hasher.update(chunk)
+        body_hashes = dict([(key, hasher.result()) for key, hasher in hashers.items()])
+
+        message = dkim.DKIM(headers, logger=self.log)
+        headers = ''
+        if self.dkim_signer:
+            headers = self.dkim_signer.sign(message, body_hashes)
+            self._prepend_header(message, headers)
+        if self.fbl_signer:
+            headers = self.fbl_header + headers
+            self._prepend_header(message, self.fbl_header)
+            headers = self.fbl_signer.sign(message, body_hashes) + headers
+        return [headers] + segments
+
+    @staticmethod
+    def _split_message(segments):
+        """Returns the message headers and an iterator over the body chunks."""
+        headers = []
+        for i, segment in enumerate(segments):
+            if segment.startswith('\n') and headers and headers[-1].endswith('\n'):
+                pos = -1
+            else:
+                pos = segment.find('\n\n')
+                if pos < 0:
+                    headers.append(segment)
+                    continue
+                headers.append(segment[:pos + 1])
+            body = itertools.chain((segment[pos + 2:],), itertools.islice(segments, i + 1, None))
+            return ''.join(headers), body
+        return ''.join(headers), iter(())
+
+    @staticmethod
+    def _prepend_header(message, header):
+        new_headers, body = dkim.rfc822_parse(header)
+        message.headers[0:0] = new_headers
@@ -0,0 +1,199 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import cPickle as pickle
+import logging
+import os
+
+from twisted.internet import defer
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.names import dns
+from twisted.names.error import DNSNameError
+from twisted.python.failure import Failure
+
+__author__ = 'ricard'
+
+
+class DnsCache(object):
+    """
+    Resolver keeping the answers of another resolver to MX, A and AAAA queries until their TTL expires.
+
+    Answers without any record and 'name error' (NXDOMAIN) failures are kept too (negative caching), during the TTL
+    given by the SOA record if any, or `negative_ttl` seconds.
+
+    It also implements `getHostByName()`, so it can be installed as reactor resolver.
+    """
+    lookup_methods = {dns.MX: 'lookupMailExchange', dns.A: 'lookupAddress', dns.AAAA: 'lookupIPV6Address'}
+
+    def __init__(self, resolver, clock=None, negative_ttl=300, max_ttl=86400, path=None, prefetch_concurrency=10):
+        """
+        @param resolver: the resolver making the real queries (for example from C{twisted.names.client}).
+        @param max_ttl: in seconds, the maximum time an answer is kept, whatever its TTL.
+        @param path: file where the cache is saved by `save()` and read by `load()`.
+        @param prefetch_concurrency: maximum count of simultaneous queries made by `prefetch()`.
+        """
+        self.resolver = resolver
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.path = path
+        self.log = logging.getLogger('dns_cache')
+        self._entries = {}  # key = (name, type), value = (expiration, answer tuple or error class)
+        self._pending = {}  # key = (name, type), value = list of deferreds waiting for the query in progress
+        self._prefetch_semaphore = defer.DeferredSemaphore(prefetch_concurrency)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookupMailExchange(self, name, timeout=None):
+        return self.lookup(name, dns.MX, timeout)
+
+    def lookupAddress(self, name, timeout=None):
+        return self.lookup(name, dns.A, timeout)
+
+    def lookupIPV6Address(self, name, timeout=None):
+        return self.lookup(name, dns.AAAA, timeout)
+
+    def getHostByName(self, name, timeout=None):
+        """Returns the first IPv4 address of `name`."""
+        if isIPAddress(name) or isIPv6Address(name):
+            return defer.succeed(name)
+        d = self.lookupAddress(name, timeout)
+        d.addCallback(self._cbHostByName, name, timeout)
+        return d
+
+    def _cbHostByName(self, answer, name, timeout):
+        for record in answer[0]:
+            if record.type == dns.A:
+                return record.payload.dottedQuad()
+        # CNAME not followed by the server: the resolver knows how to follow it
+        return self.resolver.getHostByName(name, timeout)
+
+    def lookup(self, name, query_type, timeout=None, margin=0):
+        """
+        Returns a deferred fired with the answer to the query, as a (answers, authority, additional) tuple.
+
+        The cached answer is used if it is still valid in `margin` seconds. Otherwise the query is made (only once
+        for simultaneous lookups).
+        """
+        key = (name.lower(), query_type)
+        entry = self._entries.get(key)
+        if entry and entry[0] > self.clock.seconds() + margin:
+            answer = entry[1]
+            if isinstance(answer, tuple):
+                return defer.succeed(answer)
+            return defer.fail(answer(name))
+        d = defer.Deferred()
+        if key in self._pending:
+            self._pending[key].append(d)
+        else:
+            self._pending[key] = [d]
+            getattr(self.resolver, self.lookup_methods[query_type])(name, timeout).addBoth(self._cbQuery, key)
+        return d
+
+    def cached_mx_names(self, name):
+        """
+        Returns the sorted tuple of MX server names of the domain if a valid answer is in cache, else None. No query
+        is made, so it may be called from any thread.
+        """
+        entry = self._entries.get((name.lower(), dns.MX))
+        if not entry or entry[0] <= self.clock.seconds() or not isinstance(entry[1], tuple):
+            return None
+        names = sorted(set(str(record.payload.name).lower() for record in entry[1][0] if record.type == dns.MX))
+        return tuple(names) or None
+
+    def _cbQuery(self, result, key):
+        if isinstance(result, Failure):
+            if result.check(DNSNameError):
+                self._store(key, self.negative_ttl, result.value.__class__)
+        else:
+            self._store(key, self._get_ttl(result), result)
+        for d in self._pending.pop(key):
+            d.callback(result)
+
+    def _get_ttl(self, answer):
+        answers, authority, additional = answer
+        if answers:
+            return min(record.ttl for record in answers)
+        for record in authority:
+            if record.type == dns.SOA:
+                return min(record.ttl, record.payload.minimum)
+        return self.negative_ttl
+
+    def _store(self, key, ttl, answer):
+        ttl = min(ttl, self.max_ttl)
+        if ttl > 0:
+            self._entries[key] = (self.clock.seconds() + ttl, answer)
+
+    def cleanup(self):
+        """Forgets expired answers."""
+        now = self.clock.seconds()
+        for key, entry in self._entries.items():
+            if entry[0] <= now:
+                del self._entries[key]
+
+    def prefetch(self, domains, margin=0):
+        """
+        Resolves MX servers of the given domains and their addresses, unless they are already in cache for at least
+        `margin` seconds. Errors are ignored.
+
+        @return: a deferred fired once all queries are done.
+        """
+        dl = []
+        for domain in domains:
+            d = self._prefetch(domain, dns.MX, margin)
+            d.addCallback(self._prefetch_addresses, margin)
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+    def _prefetch(self, name, query_type, margin):
+        d = self._prefetch_semaphore.run(self.lookup, name, query_type, margin=margin)
+        d.addErrback(lambda err: None)
+        return d
+
+    def _prefetch_addresses(self, answer, margin):
+        if not answer:
+            return None
+        return defer.DeferredList([self._prefetch(str(record.payload.name), dns.A, margin)
+                                   for record in answer[0] if record.type == dns.MX])
+
+    def save(self):
+        """Writes valid answers into the cache file, so they can be loaded at next startup."""
+        if not self.path:
+            return
+        self.cleanup()
+        try:
+            with open(self.path + '.tmp', 'wb') as f:
+                pickle.dump(self._entries, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(self.path + '.tmp', self.path)
+            self.log.debug("%d DNS answers saved into '%s'", len(self._entries), self.path)
+        except Exception:
+            self.log.exception("Can't save DNS cache into '%s'", self.path)
+
+    def load(self):
+        """Reads answers saved by `save()`. Expired ones are ignored."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                self._entries.update(pickle.load(f))
+        except Exception:
+            self.log.exception("Can't load DNS cache from '%s'", self.path)
+        self.cleanup()
+        self.log.debug("%d DNS answers loaded from '%s'", len(self._entries), self.path)
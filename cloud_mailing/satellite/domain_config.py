@@ -0,0 +1,61 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+
+from .models import DomainConfiguration
+
+__author__ = 'ricard'
+
+
+class DomainConfigurationCache(object):
+    """
+    Keeps all L{DomainConfiguration} in memory, so queues are built without a query per domain.
+
+    Configurations are read again by the first `get()` following `invalidate()`, or once older than `max_age`
+    seconds, so changes made directly into database are also taken into account. The same instance may be used by
+    reactor's threads.
+    """
+
+    def __init__(self, max_age=60, clock=None):
+        self.max_age = max_age
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.log = logging.getLogger('domain_config')
+        self._configs = None  # key = domain name, value = configuration as a dict
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    def get(self, domain):
+        """Returns the configuration of the domain, or an empty dict if it has none."""
+        with self._lock:
+            if self._configs is None or self.clock.seconds() - self._loaded >= self.max_age:
+                self._load()
+            return self._configs.get(domain.lower(), {})
+
+    def invalidate(self):
+        with self._lock:
+            self._configs = None
+
+    def _load(self):
+        self._configs = {}
+        for config in DomainConfiguration._get_collection().find():
+            self._configs[config['domain_name'].lower()] = config
+        self._loaded = self.clock.seconds()
+        self.log.debug("%d domain configurations loaded", len(self._configs))
@@ -16,48 +16,60 @@
 # along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
 
 import base64
-import cPickle
 import cStringIO
 import email
 import email.generator
 import email.parser
+import hashlib
 import logging
-import os
 import re
 import threading
 import urllib
 from email.header import Header
 from email.message import Message
 
-import dkim
 import jinja2
+import jinja2.meta
 from jinja2 import nodes
 from jinja2.ext import Extension
 
+from .dkim_signer import MailingSigner
+from .mail_skeleton import MailingSkeleton, REMOVED_HEADERS
 from .models import MailingRecipient
 from ..common import settings
-from ..common.email_tools import header_to_unicode
+from ..common.lru_cache import LRUCache
 
 __author__ = 'ricard'
 
 
 class MailCustomizer:
-    """Customize the mailing email to a recipient, then save it to a folder."""
+    """Customize the mailing email to a recipient."""
 
-    mailingsContent = {} # key = mailing__id, value = email.message.Message
+    mailingsContent = {} # key = mailing__id, value = MailingSkeleton
+    signers = {}  # key = mailing__id, value = MailingSigner
     _parserLock = threading.Lock()
+    # key = (mailing__id, part key, click_tracking, read_tracking, url_encoding), value = compiled jinja2.Template
+    templatesCache = LRUCache(max_entries=500)
+    # key = attachment hash, value = flattened MIME part
+    attachmentsCache = LRUCache(max_entries=1000, max_size=settings.ATTACHMENTS_CACHE_SIZE)
+    # key = template key + values of contact variables used by the template, value = rendered text with placeholders
+    # for recipient variables
+    renderedCache = LRUCache(max_entries=1000, max_size=settings.RENDERED_PARTS_CACHE_SIZE)
+    # variables given by the customizer and different for each recipient, spliced into cached rendered texts
+    RECIPIENT_VARIABLES = ('UNSUBSCRIBE', 'unsubscribe', '_tracking_url')
     re_links = re.compile(r"(<a [^>]*href\s*=\s*['\"])(https?://[^'\"]*)(['\"])")
 
-    def __init__(self, recipient, read_tracking=True, click_tracking=False, url_encoding=None):
+    def __init__(self, recipient, read_tracking=True, click_tracking=False, url_encoding=None, mailing=None):
+        """
+        @param mailing: the recipient's mailing, if already loaded. Avoids to query the database for it.
+        """
         assert(isinstance(recipient, MailingRecipient))
 
         self.recipient = recipient
-        self.unsubscribe_url = self.make_unsubscribe_url(recipient.mailing.tracking_url, recipient.tracking_id)
-        self.tracking_url = self.make_tracking_url(recipient.mailing.tracking_url, recipient.tracking_id)
+        self.mailing = mailing or recipient.mailing
+        self.unsubscribe_url = self.make_unsubscribe_url(self.mailing.tracking_url, recipient.tracking_id)
+        self.tracking_url = self.make_tracking_url(self.mailing.tracking_url, recipient.tracking_id)
         self.log = logging.getLogger("mailing")
-        self.temp_path = settings.MAIL_TEMP
-        if not os.path.exists(settings.MAIL_TEMP):
-            os.makedirs(settings.MAIL_TEMP)
         self._do_customization = self._do_customization
         self.read_tracking = read_tracking
         self.click_tracking = click_tracking
@@ -99,32 +111,123 @@ class MailCustomizer:
                                             'sha1': contact_sha1,
         }
 
-    def _do_customization(self, body, contact_data, is_html=False):
+    @staticmethod
+    def invalidate_mailing_content(mailing_id):
+        """Forget everything cached for a mailing (parsed content, compiled templates and DKIM signer)."""
+        MailCustomizer.mailingsContent.pop(mailing_id, None)
+        MailCustomizer.signers.pop(mailing_id, None)
+        MailCustomizer.templatesCache.remove_if(lambda key: key[0] == mailing_id)
+        MailCustomizer.renderedCache.remove_if(lambda key: key[0] == mailing_id)
+
+    @staticmethod
+    def _make_template(body, is_html=False, click_tracking=False, url_encoding=None):
         body = body.replace(r"%7B%7B%20unsubscribe%20%7D%7D", r"{{ unsubscribe }}")
         body = body.replace(r"%7B%7Bunsubscribe%7D%7D", r"{{ unsubscribe }}")
-        if is_html and self.click_tracking:
+        if is_html and click_tracking:
             output_link = r"\1{{ _tracking_url }}?"
-            if self.url_encoding == 'base64':
+            if url_encoding == 'base64':
                 output_link += 'c=b64&'
-            body = self.re_links.sub(output_link + r"o={{ '\2'|url_encode }}&t={% click %}\2{% endclick %}\3", body)
+            body = MailCustomizer.re_links.sub(output_link + r"o={{ '\2'|url_encode }}&t={% click %}\2{% endclick %}\3", body)
+        template = jinja2.Template(body, extensions=['jinja2.ext.with_', ClickExtension])
+        template.contact_variables = MailCustomizer._find_contact_variables(template.environment, body)
+        return template
+
+    @staticmethod
+    def _find_contact_variables(environment, source):
+        """
+        Returns the names of contact variables used by the template, or None if its rendered text can't be cached
+        because recipient variables aren't only printed as is (filters, tests, click tracked links, ...).
+        """
+        ast = environment.parse(source)
+        recipient_variables = MailCustomizer.RECIPIENT_VARIABLES
+        # {% click %} blocks encode their content, so placeholders wouldn't be found in the rendered text
+        for block in ast.find_all(nodes.CallBlock):
+            if any(node.name in recipient_variables for node in block.find_all(nodes.Name)):
+                return None
+        printed = sum(1 for output in ast.find_all(nodes.Output) for node in output.nodes
+                      if isinstance(node, nodes.Name) and node.name in recipient_variables)
+        used = sum(1 for node in ast.find_all(nodes.Name) if node.name in recipient_variables)
+        if printed != used:
+            return None
+        return tuple(sorted(jinja2.meta.find_undeclared_variables(ast).difference(recipient_variables)))
+
+    @staticmethod
+    def get_mailing_template(mailing_id, part_key, body, is_html=False, click_tracking=False, read_tracking=True,
+                             url_encoding=None):
+        """Returns the compiled template for a mailing part, compiling it only once per mailing."""
+        key = (mailing_id, part_key, is_html and click_tracking, read_tracking, url_encoding)
+        template = MailCustomizer.templatesCache.get(key)
+        if template is None:
+            template = MailCustomizer._make_template(body, is_html, click_tracking, url_encoding)
+            MailCustomizer.templatesCache.set(key, template)
+        return template
+
+    def _get_template(self, body, is_html=False, part_key=None):
+        """Returns the compiled template for this body.
+
+        If `part_key` is given, the template is compiled only once per mailing and taken from cache next times.
+        """
+        if part_key is None:
+            return self._make_template(body, is_html, self.click_tracking, self.url_encoding)
+        return self.get_mailing_template(self.mailing.id, part_key, body, is_html, self.click_tracking,
+                                         self.read_tracking, self.url_encoding)
+
+    def _do_customization(self, body, contact_data, is_html=False, part_key=None):
         context = {
             'UNSUBSCRIBE': self.unsubscribe_url,
             'unsubscribe': self.unsubscribe_url,
-            '_tracking_url': self.make_clic_url(self.recipient.mailing.tracking_url, self.recipient.tracking_id),
+            '_tracking_url': self.make_clic_url(self.mailing.tracking_url, self.recipient.tracking_id),
             '_url_encoding': self.url_encoding,
         }
-        context.update(contact_data)
-        template = jinja2.Template(body, extensions=['jinja2.ext.with_', ClickExtension])
+        template = self._get_template(body, is_html, part_key)
         if is_html and self.read_tracking:
             tracking_img = '<img src="%s" border="0" alt="" width="1" height="1" />\n' % self.tracking_url
         else:
             tracking_img = ''
-        return template.render(context) + tracking_img
+        rendered_key = self._get_rendered_key(template, contact_data, is_html, part_key)
+        if rendered_key is None:
+            context.update(contact_data)
+            return template.render(context) + tracking_img
+
+        # Recipients having the same values for the variables used by the template share the same rendered text.
+        # Only recipient variables differ: they are rendered as placeholders, replaced for each recipient.
+        rendered = self.renderedCache.get(rendered_key)
+        if rendered is None:
+            placeholders = dict(context)
+            for name in self.RECIPIENT_VARIABLES:
+                placeholders[name] = self._make_placeholder(name)
+            placeholders.update(contact_data)
+            rendered = template.render(placeholders)
+            self.renderedCache.set(rendered_key, rendered)
+        for name in self.RECIPIENT_VARIABLES:
+            rendered = rendered.replace(self._make_placeholder(name), context[name])
+        return rendered + tracking_img
+
+    def _get_rendered_key(self, template, contact_data, is_html, part_key):
+        """Returns the key of the rendered text into `renderedCache`, or None if it can't be cached."""
+        contact_variables = getattr(template, 'contact_variables', None)
+        if part_key is None or contact_variables is None:
+            return None
+        if any(name in contact_data for name in self.RECIPIENT_VARIABLES):
+            return None
+        values = tuple((name in contact_data, contact_data.get(name)) for name in contact_variables)
+        key = (self.mailing.id, part_key, is_html and self.click_tracking, self.read_tracking, self.url_encoding,
+               values)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    @staticmethod
+    def _make_placeholder(name):
+        return u'\x00%s\x00' % name
 
-    def _customize_message(self, message, contact_data):
+    def _customize_message(self, message, contact_data, part_key=None):
         """Do all dirty job to customize the content of this message.
 
         The given message HAVE TO be single part and of type "text/*".
+        `part_key` identifies the part into the mailing, to allow templates caching.
         """
         assert(isinstance(message, Message))
         assert(message.is_multipart() == False)
@@ -141,9 +244,14 @@ class MailCustomizer:
         del message['Content-Transfer-Encoding']
         new_body = self._do_customization(decoded,
                                           contact_data,
-                                          message.get_content_subtype() == 'html'
+                                          message.get_content_subtype() == 'html',
+                                          part_key
                                           ).encode(charset)
         message.set_payload(new_body)
+        self._encode_payload(message, encoding)
+
+    @staticmethod
+    def _encode_payload(message, encoding):
         if encoding == 'quoted-printable':
             email.encoders.encode_quopri(message)
         elif encoding == 'base64':
@@ -151,7 +259,38 @@ class MailCustomizer:
         else:
             email.encoders.encode_7or8bit(message)
 
+    def _customize_text_part(self, text_part, contact_data):
+        """Returns the customized text part (its Content-Transfer-Encoding header followed by the encoded body)."""
+        new_body = self._do_customization(text_part.text, contact_data, text_part.is_html, text_part.key)
+        message = Message()
+        message.set_payload(new_body.encode(text_part.charset))
+        self._encode_payload(message, text_part.encoding)
+        return "Content-Transfer-Encoding: %s\n\n%s" % (message['Content-Transfer-Encoding'], message.get_payload())
+
+    @staticmethod
+    def _get_attachment_key(attachment):
+        h = hashlib.sha1()
+        for field in ('content-type', 'charset', 'filename', 'content-id', 'data'):
+            value = attachment.get(field) or ''
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            h.update('%s=%d:' % (field, len(value)))
+            h.update(value)
+        return h.digest()
+
     def _make_mime_part(self, attachment):
+        """Returns the MIME part for an attachment. Parts are encoded only once, then taken from cache."""
+        key = self._get_attachment_key(attachment)
+        flattened = MailCustomizer.attachmentsCache.get(key)
+        if flattened is None:
+            fp = cStringIO.StringIO()
+            generator = email.generator.Generator(fp, mangle_from_=False)
+            generator.flatten(self._build_mime_part(attachment))
+            flattened = fp.getvalue()
+            MailCustomizer.attachmentsCache.set(key, flattened)
+        return FlattenedPart(flattened)
+
+    def _build_mime_part(self, attachment):
         from email import encoders
 
         data = base64.b64decode(attachment['data'])
@@ -190,199 +329,215 @@ class MailCustomizer:
             contact_data = {'email': str(recipient.email)}
         return contact_data
 
-    def _run_customizer(self):
-        """Executes the entire process of customize a mailing for a recipient
-        and returns its full path.
-
-        This may take some time and shouldn't be run from the reactor thread.
+    def _make_message_id(self):
+        # email.utils.make_msgid() is very very slow on certain circumstance
+        return "<%s.%d@cm.%s>" % (self.recipient.id, self.mailing.id, self.recipient.domain_name)
+
+    def _add_recipient_headers(self, message, subject, contact_data):
+        message['Subject'] = Header(subject)
+
+        # Adding missing headers
+        # message['Precedence'] = "bulk"
+        h = Header(self.recipient.sender_name or '')
+        h.append("<%s>" % self.recipient.mail_from)
+        message['From'] = h
+        h = Header()
+        h.append(contact_data.get('firstname') or '')
+        h.append(contact_data.get('lastname') or '')
+        h.append("<%s>" % contact_data['email'])
+        message['To'] = h
+        message['Date'] = email.utils.formatdate()
+        message['Message-ID'] = self._make_message_id()
+        if self.unsubscribe_url:
+            message['List-Unsubscribe'] = self.unsubscribe_url
+
+    def _make_recipient_headers(self, subject, contact_data):
+        """Returns the flattened recipient headers."""
+        message = Message()
+        self._add_recipient_headers(message, subject, contact_data)
+        fp = cStringIO.StringIO()
+        generator = email.generator.Generator(fp, mangle_from_=False)
+        generator.flatten(message)
+        return fp.getvalue()[:-1]  # without the empty line ending headers
+
+    def _render_skeleton(self, skeleton, contact_data):
+        """Customizes the mailing using its skeleton and returns the flattened email, as a list of strings.
+
+        Static segments are shared with the skeleton, they aren't copied.
         """
-        try:
-            fullpath = os.path.join(self.temp_path, MailCustomizer.make_file_name(self.recipient.mailing.id, self.recipient.id))
-            if os.path.exists(fullpath):
-                self.log.debug("Customized email found here: %s", fullpath)
-                parser = email.parser.Parser()
-                with file(fullpath, 'rt') as fd:
-                    header = parser.parse(fd, headersonly=True)
-                    return header['Message-ID'], fullpath
-            contact_data = self.make_contact_data_dict(self.recipient)
-            message = self._parse_message()
-            assert(isinstance(contact_data, dict))
-            assert(isinstance(message, Message))
-            #email.iterators._structure(message)
-
-            mixed_attachments=[]
-            related_attachments=[]
-            for attachment in contact_data.get('attachments', []):
-                if 'content-id' in attachment:
-                    related_attachments.append(attachment)
+        assert(isinstance(skeleton, MailingSkeleton))
+        segments = []
+        for segment in skeleton.segments:
+            if segment is MailingSkeleton.HEADERS:
+                subject = self._do_customization(skeleton.subject, contact_data, part_key='subject')
+                segments.append(self._make_recipient_headers(subject, contact_data))
+            elif isinstance(segment, basestring):
+                segments.append(segment)
+            else:
+                segments.append(self._customize_text_part(segment, contact_data))
+        return segments
+
+    def _customize_message_tree(self, skeleton, contact_data):
+        """Customizes a full copy of the mailing content. Needed when the recipient has its own attachments, as
+        they change the email structure. Returns the flattened email, as a list of strings."""
+        message = skeleton.get_message()
+        assert(isinstance(message, Message))
+        #email.iterators._structure(message)
+
+        mixed_attachments=[]
+        related_attachments=[]
+        for attachment in contact_data.get('attachments', []):
+            if 'content-id' in attachment:
+                related_attachments.append(attachment)
+            else:
+                mixed_attachments.append(attachment)
+
+        #bodies = MailingBody.objects.filter(relay = self.recipient.mailing_queue).order_by('header_pos')
+        def convert_to_mixed(part, mixed_attachments, subtype):
+            import email.mime.multipart
+
+            part2 = email.mime.multipart.MIMEMultipart(_subtype=subtype)
+            part2.set_payload(part.get_payload())
+            del part['Content-Type']
+            part['Content-Type'] = 'multipart/mixed'
+            part.set_payload(None)
+            part.attach(part2)
+            for attachment in mixed_attachments:
+                part.attach(self._make_mime_part(attachment))
+
+        def personalise_bodies(part, mixed_attachments=[], related_attachments=[], path='0'):
+            import email.message
+            assert(isinstance(part, email.message.Message))
+            if part.is_multipart():
+                subtype = part.get_content_subtype()
+                if subtype == 'mixed':
+                    personalise_bodies(part.get_payload(0), related_attachments=related_attachments,
+                                       path=path + '.0')
+                    for attachment in mixed_attachments:
+                        part.attach(self._make_mime_part(attachment))
+
+                elif subtype == 'alternative':
+                    for i, p in enumerate(part.get_payload()):
+                        personalise_bodies(p, related_attachments=related_attachments, path='%s.%d' % (path, i))
+                    if mixed_attachments:
+                        convert_to_mixed(part, mixed_attachments, subtype="alternative")
+
+                elif subtype == 'digest':
+                    raise email.errors.MessageParseError, "multipart/digest not supported"
+
+                elif subtype == 'parallel':
+                    raise email.errors.MessageParseError, "multipart/parallel not supported"
+
+                elif subtype == 'related':
+                    personalise_bodies(part.get_payload(0), path=path + '.0')
+                    for attachment in related_attachments:
+                        part.attach(self._make_mime_part(attachment))
+                    if mixed_attachments:
+                        convert_to_mixed(part, mixed_attachments, subtype="related")
+
                 else:
-                    mixed_attachments.append(attachment)
-
-            #bodies = MailingBody.objects.filter(relay = self.recipient.mailing_queue).order_by('header_pos')
-            def convert_to_mixed(part, mixed_attachments, subtype):
-                import email.mime.multipart
-
-                part2 = email.mime.multipart.MIMEMultipart(_subtype=subtype)
-                part2.set_payload(part.get_payload())
-                del part['Content-Type']
-                part['Content-Type'] = 'multipart/mixed'
-                part.set_payload(None)
-                part.attach(part2)
-                for attachment in mixed_attachments:
-                    part.attach(self._make_mime_part(attachment))
-
-            def personalise_bodies(part, mixed_attachments=[], related_attachments=[]):
-                import email.message
-                assert(isinstance(part, email.message.Message))
-                if part.is_multipart():
-                    subtype = part.get_content_subtype()
-                    if subtype == 'mixed':
-                        personalise_bodies(part.get_payload(0), related_attachments=related_attachments)
+                    self.log.warn("Unknown multipart subtype '%s'" % subtype)
+
+            else:
+                maintype = part.get_content_maintype()
+                if maintype == 'text':
+                    self._customize_message(part, contact_data, part_key=path)
+
+                    if mixed_attachments:
+                        import email.mime.text
+
+                        part2 = email.mime.text.MIMEText(part.get_payload(decode=True))
+                        del part['Content-Type']
+                        part['Content-Type'] = 'multipart/mixed'
+                        part.set_payload(None)
+                        part.attach(part2)
                         for attachment in mixed_attachments:
                             part.attach(self._make_mime_part(attachment))
 
-                    elif subtype == 'alternative':
-                        for p in part.get_payload():
-                            personalise_bodies(p, related_attachments=related_attachments)
-                        if mixed_attachments:
-                            convert_to_mixed(part, mixed_attachments, subtype="alternative")
-
-                    elif subtype == 'digest':
-                        raise email.errors.MessageParseError, "multipart/digest not supported"
+                else:
+                    self.log.warn("personalise_bodies(): can't handle '%s' parts" % part.get_content_type())
 
-                    elif subtype == 'parallel':
-                        raise email.errors.MessageParseError, "multipart/parallel not supported"
+        personalise_bodies(message, mixed_attachments, related_attachments)
 
-                    elif subtype == 'related':
-                        personalise_bodies(part.get_payload(0))
-                        for attachment in related_attachments:
-                            part.attach(self._make_mime_part(attachment))
-                        if mixed_attachments:
-                            convert_to_mixed(part, mixed_attachments, subtype="related")
+        # Customize the subject
+        subject = self._do_customization(skeleton.subject, contact_data, part_key='subject')
+        for header in REMOVED_HEADERS:
+            del message[header]
+        self._add_recipient_headers(message, subject, contact_data)
 
-                    else:
-                        self.log.warn("Unknown multipart subtype '%s'" % subtype)
+        fp = cStringIO.StringIO()
+        generator = FlattenedPartsGenerator(fp, mangle_from_=False)
+        generator.flatten(message)
+        return [fp.getvalue()]
 
-                else:
-                    maintype = part.get_content_maintype()
-                    if maintype == 'text':
-                        self._customize_message(part, contact_data)
-
-                        if mixed_attachments:
-                            import email.mime.text
-
-                            part2 = email.mime.text.MIMEText(part.get_payload(decode=True))
-                            del part['Content-Type']
-                            part['Content-Type'] = 'multipart/mixed'
-                            part.set_payload(None)
-                            part.attach(part2)
-                            for attachment in mixed_attachments:
-                                part.attach(self._make_mime_part(attachment))
-
-                    else:
-                        self.log.warn("personalise_bodies(): can't handle '%s' parts" % part.get_content_type())
-
-            personalise_bodies(message, mixed_attachments, related_attachments)
-
-            # Customize the subject
-            subject = self._do_customization(header_to_unicode(message.get("Subject", "")), contact_data)
-            # Remove some headers
-            for header in ('Subject', 'Received', 'To', 'From', 'User-Agent', 'Date', 'Message-ID', 'List-Unsubscribe',
-                           'DKIM-Signature', 'Authentication-Results', 'Received-SPF', 'Received-SPF', 'X-Received',
-                           'Delivered-To', 'Feedback-ID', 'Precedence', 'Return-Path'):
-                if header in message:
-                    del message[header]
-
-            message['Subject'] = Header(subject)
-
-            # Adding missing headers
-            # message['Precedence'] = "bulk"
-            h = Header(self.recipient.sender_name or '')
-            h.append("<%s>" % self.recipient.mail_from)
-            message['From'] = h
-            h = Header()
-            h.append(contact_data.get('firstname') or '')
-            h.append(contact_data.get('lastname') or '')
-            h.append("<%s>" % contact_data['email'])
-            message['To'] = h
-            message['Date'] = email.utils.formatdate()
-            # message['Message-ID'] = email.utils.make_msgid()  # very very slow on certain circumstance
-            message['Message-ID'] = "<%s.%d@cm.%s>" % (self.recipient.id, self.recipient.mailing.id, self.recipient.domain_name )
-            if self.unsubscribe_url:
-                message['List-Unsubscribe'] = self.unsubscribe_url
+    def _run_customizer(self):
+        """Executes the entire process of customize a mailing for a recipient
+        and returns a tuple (message_id, customized_email) where the customized email is given as a list of strings
+        (see L{MailingSkeleton}).
 
-            fp = cStringIO.StringIO()
-            generator = email.generator.Generator(fp, mangle_from_=False)
-            generator.flatten(message)
-            flattened_message = fp.getvalue()
-            flattened_message = self.add_dkim_signature(flattened_message)
-            flattened_message = self.add_fbl(flattened_message)
-
-            with open(fullpath+'.tmp', 'wt') as fp:
-                fp.write(flattened_message)
-                fp.close()
-            if os.path.exists(fullpath):
-                os.remove(fullpath)
-            os.rename(fullpath+'.tmp', fullpath)
-            return message['Message-ID'], fullpath
+        This may take some time and shouldn't be run from the reactor thread.
+        """
+        try:
+            contact_data = self.make_contact_data_dict(self.recipient)
+            assert(isinstance(contact_data, dict))
+            skeleton = self._get_skeleton()
+            if contact_data.get('attachments'):
+                segments = self._customize_message_tree(skeleton, contact_data)
+            else:
+                segments = self._render_skeleton(skeleton, contact_data)
+            segments = self._get_signer().sign(segments)
+            return self._make_message_id(), segments
 
         except Exception:
             self.log.exception("Failed to customize mailing '%s' for recipient '%s'" % (self.recipient.mail_from, self.recipient.email))
             raise
 
-    def add_dkim_signature(self, flattened_message):
-        sig = ''
-        dkim_settings = self.recipient.mailing.get('dkim', None)
-        if dkim_settings and dkim_settings.get('enabled', True):
-            sig = dkim.sign(flattened_message, dkim_settings['selector'], dkim_settings['domain'],
-                            dkim_settings['privkey'],
-                            canonicalize=dkim_settings.get('canonicalize', (b'relaxed', b'simple')),
-                            signature_algorithm=dkim_settings.get('signature_algorithm', b'rsa-sha256'),
-                            include_headers=dkim_settings.get('include_headers'),
-                            length=dkim_settings.get('length', False),
-                            logger=self.log)
-            sig = str(sig.replace(b'\r\n', b'\n'))  # sig is in unicode
-        return sig + flattened_message
-
-    def add_fbl(self, flattened_message):
-        sig = ''
-        mailing = self.recipient.mailing
-        fbl_settings = mailing.get('feedback_loop', {})
-        if not fbl_settings:
-            return flattened_message
-        dkim_settings = fbl_settings.get('dkim', None)
-        sender_id = fbl_settings.get('sender_id', None)
-        if dkim_settings and sender_id:
-            campaign_id = fbl_settings.get('campaign_id', mailing.id)
-            customer_id = fbl_settings.get('customer_id', mailing.domain_name)
-            mail_type_id = fbl_settings.get('mail_type_id', mailing.type)
-            fbl_header = 'Feedback-ID: %s:%s:%s:%s\n' % (campaign_id, customer_id, mail_type_id, sender_id)
-            flattened_message = fbl_header + flattened_message
-            d = dkim.DKIM(flattened_message, signature_algorithm=dkim_settings.get('signature_algorithm', b'rsa-sha256'), logger=self.log)
-            sig = d.sign(dkim_settings['selector'], dkim_settings['domain'], dkim_settings['privkey'],
-                         canonicalize=dkim_settings.get('canonicalize', (b'relaxed', b'simple')),
-                         include_headers=dkim_settings.get('include_headers', d.default_sign_headers()) + ['Feedback-ID'],
-                         length=dkim_settings.get('length', False),
-                         )
-            sig = str(sig.replace(b'\r\n', b'\n'))  # sig is in unicode
-        return sig + flattened_message
-
-    def _parse_message(self):
-        MailCustomizer._parserLock.acquire()
-        try:
-            result = MailCustomizer.mailingsContent.get(self.recipient.mailing.id, None)
-            if result:
-                return cPickle.loads(result)
-            else:
-                # parse email
-                mparser = email.parser.FeedParser()
-                mparser.feed(self.recipient.mailing.header)
-                mparser.feed(self.recipient.mailing.body)
-                result = mparser.close()
-                MailCustomizer.mailingsContent[self.recipient.mailing.id] = cPickle.dumps(result)
-            return result
-        finally:
-            MailCustomizer._parserLock.release()
+    @staticmethod
+    def get_mailing_signer(mailing):
+        """Returns the DKIM signer of the mailing, creating it if needed."""
+        signer = MailCustomizer.signers.get(mailing.id, None)
+        if signer is None or signer.modified != mailing.modified:
+            # Creation is cheap enough to not need any lock
+            signer = MailingSigner(mailing)
+            MailCustomizer.signers[mailing.id] = signer
+        return signer
+
+    @staticmethod
+    def get_mailing_skeleton(mailing):
+        """Returns the parsed content of the mailing, parsing it if needed."""
+        mailing_id = mailing.id
+        skeleton = MailCustomizer.mailingsContent.get(mailing_id, None)
+        if skeleton is not None and skeleton.modified != mailing.modified:
+            # Mailing content changed without being invalidated here (i.e. we are a customizer process)
+            MailCustomizer.invalidate_mailing_content(mailing_id)
+            skeleton = None
+        if skeleton is None:
+            with MailCustomizer._parserLock:
+                skeleton = MailCustomizer.mailingsContent.get(mailing_id, None)
+                if skeleton is None:
+                    skeleton = MailingSkeleton(mailing.header, mailing.body, mailing.modified)
+                    MailCustomizer.mailingsContent[mailing_id] = skeleton
+        return skeleton
+
+    @staticmethod
+    def prepare_mailing(mailing):
+        """
+        Parses the mailing content and compiles all its templates (including click tracking links rewriting), so
+        customization only has to render them for each recipient.
+
+        This may take some time and shouldn't be run from the reactor thread.
+        """
+        skeleton = MailCustomizer.get_mailing_skeleton(mailing)
+        for text_part in skeleton.text_parts.values():
+            MailCustomizer.get_mailing_template(mailing.id, text_part.key, text_part.text, text_part.is_html,
+                                                mailing.click_tracking, mailing.read_tracking, mailing.url_encoding)
+        MailCustomizer.get_mailing_signer(mailing)
+
+    def _get_signer(self):
+        return self.get_mailing_signer(self.mailing)
+
+    def _get_skeleton(self):
+        return self.get_mailing_skeleton(self.mailing)
 
     def customize(self):
         """Start the customization process. Returns a deferred.
@@ -393,6 +548,24 @@ class MailCustomizer:
 
 
 
+class FlattenedPart(Message):
+    """MIME part already flattened, written as is by L{FlattenedPartsGenerator}."""
+
+    def __init__(self, flattened):
+        Message.__init__(self)
+        self.flattened = flattened
+
+
+class FlattenedPartsGenerator(email.generator.Generator):
+    """Generator writing L{FlattenedPart} parts without flattening them again."""
+
+    def _write(self, msg):
+        if isinstance(msg, FlattenedPart):
+            self._fp.write(msg.flattened)
+        else:
+            email.generator.Generator._write(self, msg)
+
+
 class ClickExtension(Extension):
     """
     Jinja2 extension to handle click tracking
@@ -0,0 +1,131 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import cPickle
+import cStringIO
+import email.errors
+import email.generator
+import email.parser
+import logging
+import re
+import uuid
+from email.message import Message
+
+from ..common.email_tools import header_to_unicode
+
+__author__ = 'ricard'
+
+# Headers removed from the mailing content. Most of them are generated again for each recipient.
+REMOVED_HEADERS = ('Subject', 'Received', 'To', 'From', 'User-Agent', 'Date', 'Message-ID', 'List-Unsubscribe',
+                   'DKIM-Signature', 'Authentication-Results', 'Received-SPF', 'X-Received',
+                   'Delivered-To', 'Feedback-ID', 'Precedence', 'Return-Path')
+
+
+class TextPart(object):
+    """A text part of the mailing, to be customized for each recipient."""
+
+    def __init__(self, key, message):
+        assert(isinstance(message, Message))
+        assert(message.get_content_maintype() == 'text')
+        self.key = key
+        self.charset = message.get_content_charset(failobj='us-ascii')
+        self.is_html = message.get_content_subtype() == 'html'
+        self.encoding = message['Content-Transfer-Encoding']
+        original = message.get_payload(decode=True)
+        if isinstance(original, unicode):
+            self.text = original
+        else:
+            self.text = original.decode(self.charset)
+
+
+class MailingSkeleton(object):
+    """
+    Mailing content parsed once and flattened into static segments, with placeholders for what changes for each
+    recipient: the recipient headers (see `HEADERS`) and the text parts (as `TextPart` objects).
+
+    The customized email is then only made of text parts rendering and a join.
+    """
+    HEADERS = 'headers'
+
+    def __init__(self, header, body, modified=None):
+        """
+        @param modified: modification date of the mailing, used to detect outdated skeletons.
+        """
+        self.log = logging.getLogger("mailing")
+        self.modified = modified
+        mparser = email.parser.FeedParser()
+        mparser.feed(header)
+        mparser.feed(body)
+        message = mparser.close()
+        # kept for recipients needing a structure change (personal attachments)
+        self.pickled_message = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+        self.subject = header_to_unicode(message.get("Subject", ""))
+        self.text_parts = {}  # key = part key, value = TextPart
+        self.segments = self._make_segments(message)
+
+    def get_message(self):
+        """Returns a new copy of the parsed mailing content."""
+        return cPickle.loads(self.pickled_message)
+
+    def _make_segments(self, message):
+        marker_name = 'X-CM-Skeleton-%s' % uuid.uuid4().hex
+        for header in REMOVED_HEADERS:
+            del message[header]
+        message[marker_name] = self.HEADERS
+        self._add_text_part_markers(message, marker_name, '0')
+
+        fp = cStringIO.StringIO()
+        generator = email.generator.Generator(fp, mangle_from_=False)
+        generator.flatten(message)
+
+        # headers marker replaces its own line, part marker replaces its line and the empty line that follows.
+        re_markers = re.compile(r"^%s: (?:(%s)\n|part:([\d.]+)\n\n)" % (marker_name, self.HEADERS), re.M)
+        segments = []
+        pos = 0
+        flattened_message = fp.getvalue()
+        for m in re_markers.finditer(flattened_message):
+            segments.append(flattened_message[pos:m.start()])
+            if m.group(1):
+                segments.append(self.HEADERS)
+            else:
+                segments.append(self.text_parts[m.group(2)])
+            pos = m.end()
+        segments.append(flattened_message[pos:])
+        return filter(None, segments)
+
+    def _add_text_part_markers(self, part, marker_name, path):
+        """Replaces customizable text parts content by a marker header."""
+        if part.is_multipart():
+            subtype = part.get_content_subtype()
+            if subtype in ('mixed', 'related'):
+                self._add_text_part_markers(part.get_payload(0), marker_name, path + '.0')
+            elif subtype == 'alternative':
+                for i, p in enumerate(part.get_payload()):
+                    self._add_text_part_markers(p, marker_name, '%s.%d' % (path, i))
+            elif subtype == 'digest':
+                raise email.errors.MessageParseError, "multipart/digest not supported"
+            elif subtype == 'parallel':
+                raise email.errors.MessageParseError, "multipart/parallel not supported"
+            else:
+                self.log.warn("Unknown multipart subtype '%s'" % subtype)
+        elif part.get_content_maintype() == 'text':
+            self.text_parts[path] = TextPart(path, part)
+            del part['Content-Transfer-Encoding']
+            part[marker_name] = 'part:%s' % path
+            part.set_payload('')
+        else:
+            self.log.warn("MailingSkeleton: can't handle '%s' parts" % part.get_content_type())
@@ -34,9 +34,9 @@ for the twisted.mail SMTP server
 """
 import cPickle as pickle
 import logging
-import os
 import threading
 import time
+from collections import Counter, namedtuple
 from datetime import datetime
 from datetime import timedelta
 
@@ -51,15 +51,90 @@ from twisted.spread.util import CallbackPageCollector
 
 from ..common.db_common import get_db
 from . import settings_vars
+from .concurrency import ConcurrencyController
+from .customizer_pool import CustomizerPool
+from .dns_cache import DnsCache
+from .domain_config import DomainConfigurationCache
+from .rate_limiter import RateLimiter
+from .scheduler import SendScheduler
+from .source_ips import SourceIPPool
 from .mail_customizer import MailCustomizer
-from .models import Mailing, MailingRecipient, RECIPIENT_STATUS, HourlyStats, DomainStats, DomainConfiguration, \
-    ActiveQueue
+from .spool import MessageSpool
+from .models import Mailing, MailingRecipient, RECIPIENT_STATUS, HourlyStats, DomainStats, ActiveQueue, \
+    MXConfiguration, SmtpSession
 from .mx import MXCalculator, FakedMXCalculator
-from .sendmail import SMTPRelayerFactory
+from .sendmail import SMTPRelayerFactory, SMTPConnectionPool, MXConnector
 from ..common import settings
 from ..common.config_file import ConfigFile
 
 
+DomainLimits = namedtuple('DomainLimits', ('max_queues', 'max_mx', 'cnx_per_mx'))
+
+
+def get_domain_limits(domain_config):
+    """
+    Returns the L{DomainLimits} for a domain, from its L{DomainConfiguration} (or an empty dict) and default settings.
+
+    The queues count is `max_relayers`, or `default_max_queue_per_domain`. If the domain configures `max_mx` or
+    `cnx_per_mx`, it defaults to `max_mx * cnx_per_mx` and is capped by it, as each queue holds one connection.
+    Default MX settings only tell how queues are spread over MX servers: they never limit the queues count.
+    """
+    mx_configured = domain_config.get('max_mx') or domain_config.get('cnx_per_mx')
+    max_mx = domain_config.get('max_mx') or settings_vars.get_int(settings_vars.DEFAULT_MAX_MX)
+    cnx_per_mx = domain_config.get('cnx_per_mx') or settings_vars.get_int(settings_vars.DEFAULT_CNX_PER_MX)
+    max_queues = domain_config.get('max_relayers')
+    if not max_queues:
+        if mx_configured:
+            max_queues = max_mx * cnx_per_mx
+        else:
+            max_queues = settings_vars.get_int(settings_vars.DEFAULT_MAX_QUEUE_PER_DOMAIN)
+    elif mx_configured:
+        max_queues = min(max_queues, max_mx * cnx_per_mx)
+    return DomainLimits(max_queues, max_mx, cnx_per_mx)
+
+
+def group_exchanges_by_mx(exchanges, max_messages, get_mx_names):
+    """
+    Moves into the same queues the recipients of domains served by the same MX servers, so they are sent through a
+    single connection instead of one per domain. Only domains having a single and not full queue are grouped. A
+    grouped queue holds at most the smallest `max_messages` of its domains, which becomes the one of the domain
+    keeping it. Emptied domains are removed from `exchanges`.
+
+    @param exchanges: dict as returned by `MailingSender._get_exchanges_dict()`.
+    @param max_messages: dict giving the maximum size of a queue for each domain.
+    @param get_mx_names: function returning a hashable key identifying the MX servers of a domain, or None if unknown.
+    @return: the count of queues freed.
+    """
+    freed = 0
+    groups = {}
+    for domain, (limits, queues) in exchanges.items():
+        if len(queues) != 1 or len(queues[0]) >= max_messages[domain]:
+            continue
+        mx_names = get_mx_names(domain)
+        if mx_names:
+            groups.setdefault(mx_names, []).append(domain)
+    for domains in groups.values():
+        if len(domains) < 2:
+            continue
+        # biggest queues first, so smaller ones fill the remaining room
+        domains.sort(key=lambda d: (-len(exchanges[d][1][0]), d))
+        targets = []  # domains keeping their queue
+        for domain in domains:
+            recipients = exchanges[domain][1][0]
+            for target in targets:
+                max_size = min(max_messages[target], max_messages[domain])
+                queue = exchanges[target][1][0]
+                if len(queue) + len(recipients) <= max_size:
+                    queue.extend(recipients)
+                    max_messages[target] = max_size
+                    del exchanges[domain]
+                    freed += 1
+                    break
+            else:
+                targets.append(domain)
+    return freed
+
+
 class EmtpyFactory(Exception):
     pass
 
@@ -83,7 +158,8 @@ class MailingSender(pb.Referenceable):
     each connection's responsibility in term of messages. Create
     more relayers if the need arises.
 
-    Someone should press .checkState periodically
+    New relayers are created by `check_mailing()`, called by the L{SendScheduler} when recipients become ready,
+    when a queue is finished or when a mailing content is received.
     """
 
     def __init__(self, cloud_client, timer_delay=5, delay_if_empty=20, maxConnections=2):
@@ -103,14 +179,50 @@ class MailingSender(pb.Referenceable):
 
         self.maxConnections = maxConnections
         self.maxMessagesPerConnection = 100
-        self.relay_manager = ActiveQueuesList(self.log)
-        self.nextTime = 0
+        self.scheduler = SendScheduler(self.check_mailing)
+        self.domain_configs = DomainConfigurationCache()
+        self.relay_manager = ActiveQueuesList(self.log, queueRemovedCallback=self.forceToCheck)
+        self.check_again = False  # True if check_mailing() was called while queues were built
         self.handlingQueueLock = threading.Lock()
         self.handling_get_mailing_next_time = 0
+        self.dns_cache = None
         if settings.TEST_FAKE_DNS:
             Queue.mxcalc = FakedMXCalculator()
         else:
-            Queue.mxcalc = MXCalculator()
+            from twisted.names.client import createResolver
+            self.dns_cache = DnsCache(createResolver(),
+                                      negative_ttl=settings_vars.get_int(settings_vars.DNS_NEGATIVE_CACHE_TTL),
+                                      path=settings.DNS_CACHE_FILE)
+            self.dns_cache.load()
+            # also used to resolve MX names when connecting to them
+            reactor.installResolver(self.dns_cache)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.dns_cache.save)
+            Queue.mxcalc = MXCalculator(resolver=self.dns_cache)
+        if Queue.rate_limiter is None:
+            Queue.rate_limiter = RateLimiter()
+        if settings.SOURCE_IPS and Queue.source_ips is None:
+            Queue.source_ips = SourceIPPool(settings.SOURCE_IPS)
+        if settings_vars.get_bool(settings_vars.SMTP_STARTTLS) and Queue.tls_session_cache is None:
+            from .tls_session_cache import TLSSessionCache
+            Queue.tls_session_cache = TLSSessionCache(
+                max_age=settings_vars.get_int(settings_vars.TLS_SESSION_MAX_AGE),
+                handshakeCallback=lambda host, resumed: HourlyStats.add_tls_handshake(resumed))
+        if settings_vars.get_bool(settings_vars.ADAPTIVE_CONCURRENCY) and Queue.concurrency is None:
+            Queue.concurrency = ConcurrencyController(
+                initial_queues=settings_vars.get_int(settings_vars.DEFAULT_MAX_QUEUE_PER_DOMAIN))
+            Queue.concurrency.load()
+        customizer_processes = settings_vars.get_int(settings_vars.CUSTOMIZER_PROCESSES)
+        if customizer_processes > 0 and not Queue.customizer_pool:
+            Queue.customizer_pool = CustomizerPool(customizer_processes,
+                                                   timeout=settings_vars.get_int(settings_vars.CUSTOMIZER_TIMEOUT))
+            reactor.addSystemEventTrigger('before', 'shutdown', Queue.customizer_pool.close)
+        self.spool = Queue.spool = MessageSpool(settings.MAIL_TEMP,
+                                                settings_vars.get_int(settings_vars.SPOOL_MAX_MEMORY))
+        smtp_session_max_idle_time = settings_vars.get_int(settings_vars.SMTP_SESSION_MAX_IDLE_TIME)
+        if smtp_session_max_idle_time > 0 and Queue.connection_pool is None:
+            Queue.connection_pool = SMTPConnectionPool(
+                smtp_session_max_idle_time, settings_vars.get_int(settings_vars.SMTP_SESSION_MAX_MESSAGES))
+            reactor.addSystemEventTrigger('before', 'shutdown', Queue.connection_pool.close)
 
         self.is_connected = False
         self.invalidate_all_mailing_content()
@@ -119,22 +231,30 @@ class MailingSender(pb.Referenceable):
         self.tasks = []
 
     def start_tasks(self):
-        for fn, delay, startNow in ((self.check_mailing, self.timer_delay, False),
-                                    (self.remove_closed_mailings, 33600, False),
-                                    (self.relay_manager.check_for_zombie_queues, 60, False),
-                                    (self.check_for_missing_mailing, 2, False),
-                                    (self.send_report_for_finished_recipients, 20, False),
-                                    (self.send_statistics, 30, False),
-                                    ):
+        tasks = [(self.remove_closed_mailings, 33600, False),
+                 (self.relay_manager.check_for_zombie_queues, 60, False),
+                 (self.check_for_missing_mailing, 2, False),
+                 (self.send_report_for_finished_recipients, 20, False),
+                 (self.send_statistics, 30, False),
+                 (self.send_smtp_sessions, 20, False),
+                 ]
+        if Queue.concurrency:
+            tasks.append((self.save_concurrency_limits, 60, False))
+        prefetch_delay = settings_vars.get_int(settings_vars.DNS_PREFETCH_DELAY)
+        if self.dns_cache and prefetch_delay > 0:
+            tasks.append((self.prefetch_dns, prefetch_delay, True))
+        for fn, delay, startNow in tasks:
             t = task.LoopingCall(fn)
             t.start(delay, now=startNow)
             self.tasks.append(t)
+        self.forceToCheck()
         self.log.info("Mailing sender started")
 
     def stop_tasks(self):
         for t in self.tasks:
             t.stop()
         self.tasks = []
+        self.scheduler.stop()
         self.log.info("Mailing sender stopped")
 
     def disconnected(self, remoteRef):
@@ -171,6 +291,7 @@ class MailingSender(pb.Referenceable):
             removed_recipients = yield db.mailingrecipient.count({'send_status': RECIPIENT_STATUS.UNVERIFIED})
             self.log.warning("Found that %d recipients have been removed by master. Deleting them...", removed_recipients)
             yield db.mailingrecipient.delete_many({'send_status': RECIPIENT_STATUS.UNVERIFIED})
+        self.scheduler.load()
 
 
     def cb_get_recipients(self, data_list, t0):
@@ -189,18 +310,19 @@ class MailingSender(pb.Referenceable):
                     if not mailing:
                         mailing = Mailing.create(_id=mailing_id)
                 try:
-                    MailingRecipient.create(mailing=DBRef("mailing", mailing.id),
-                                            _id=r['_id'],
-                                            tracking_id=r['tracking_id'],
-                                            contact_data=r.get('contact'),
-                                            email=r['email'],
-                                            mail_from=r['mail_from'],
-                                            sender_name=r.get('sender_name'),
-                                            domain_name=r['email'].split('@', 1)[1],
-                                            first_try=r.get('first_try'),
-                                            next_try=r['next_try'],
-                                            try_count=r.get('try_count'),
+                    recipient = MailingRecipient.create(mailing=DBRef("mailing", mailing.id),
+                                                        _id=r['_id'],
+                                                        tracking_id=r['tracking_id'],
+                                                        contact_data=r.get('contact'),
+                                                        email=r['email'],
+                                                        mail_from=r['mail_from'],
+                                                        sender_name=r.get('sender_name'),
+                                                        domain_name=r['email'].split('@', 1)[1],
+                                                        first_try=r.get('first_try'),
+                                                        next_try=r['next_try'],
+                                                        try_count=r.get('try_count'),
                     )
+                    self.scheduler.add(recipient.id, recipient.domain_name, mailing.id, recipient.next_try)
                     c += 1
                     #print r['id'], '-->', r['recipient']
                 except Exception, ex:
@@ -210,7 +332,6 @@ class MailingSender(pb.Referenceable):
                     # and so, an update will be sent soon or late.
             if c:
                 self.log.debug("Recipients added to local queue.")
-            self.nextTime = 0
         except pickle.PickleError:
             self.log.exception("Can't decode recipients data")
         except Exception:
@@ -262,8 +383,7 @@ class MailingSender(pb.Referenceable):
         try:
             mailing_dict = pickle.loads(data)
             mailing_id = mailing_dict['id']
-            if mailing_id in MailCustomizer.mailingsContent:
-                del MailCustomizer.mailingsContent[mailing_id]
+            MailCustomizer.invalidate_mailing_content(mailing_id)
 
             if not mailing_dict.get('delete', False):
                 header = mailing_dict['header']
@@ -287,6 +407,10 @@ class MailingSender(pb.Referenceable):
                     mailing.type = mailing_dict.get('type', None)
                     mailing.url_encoding = mailing_dict.get('url_encoding', None)
                     mailing.save()
+                    deferToThread(self._prepare_mailing, mailing_id)\
+                        .addErrback(self._eb_prepare_mailing, mailing_id)
+                    # its recipients may now be sent
+                    self.forceToCheck()
                 else:
                     self.log.error("Mailing [%d] doesn't exist. Can't update header and body data.", mailing_id)
             else:
@@ -306,6 +430,16 @@ class MailingSender(pb.Referenceable):
             self.log.exception("Unexpected error getting mailing data")
         return None
         
+    @staticmethod
+    def _prepare_mailing(mailing_id):
+        # reloaded to get the modification date as stored into db
+        mailing = Mailing.grab(mailing_id)
+        if mailing:
+            MailCustomizer.prepare_mailing(mailing)
+
+    def _eb_prepare_mailing(self, err, mailing_id):
+        self.log.error("Can't prepare content of mailing [%d]: %s", mailing_id, err.getErrorMessage())
+
     def eb_get_mailing(self, err):
         err_msg = str(err.value) or str(err)
         self.log.error("Error getting mailing data: %s", err_msg)
@@ -357,6 +491,40 @@ class MailingSender(pb.Referenceable):
         err_msg = str(err.value) or str(err)
         self.log.error("Error while reporting finished recipients: %s", err_msg)
 
+    def send_smtp_sessions(self):
+        """Sends stored SMTP sessions transcripts to the master."""
+        if not self.mailing_manager:
+            self.log.info("MailingManager not connected (NULL). Can't send SMTP sessions. Waiting...")
+            return
+
+        try:
+            sessions = []
+            for session in SmtpSession.find()[0:100]:
+                s = dict(session)
+                s['_id'] = str(s['_id'])
+                s['log'] = str(s['log'])
+                sessions.append(s)
+            if sessions:
+                d = self.mailing_manager.callRemote('send_smtp_sessions', sessions)
+                d.addCallbacks(self.cb_send_smtp_sessions, self.eb_send_smtp_sessions)
+                return d
+        except pb.DeadReferenceError:
+            self.log.info("MailingManager not connected. Waiting...")
+            self.is_connected = False
+        except Exception:
+            self.log.exception("Error in send_smtp_sessions()")
+
+    def cb_send_smtp_sessions(self, session_ids):
+        self.is_connected = True
+        try:
+            SmtpSession.remove({'_id': {'$in': map(lambda id: ObjectId(id), session_ids)}})
+        except Exception:
+            self.log.exception("Error while removing sent SMTP sessions.")
+
+    def eb_send_smtp_sessions(self, err):
+        err_msg = str(err.value) or str(err)
+        self.log.error("Error while sending SMTP sessions: %s", err_msg)
+
     def send_statistics(self):
         try:
             stats = []
@@ -388,7 +556,40 @@ class MailingSender(pb.Referenceable):
         
     # KEEP ?
     def forceToCheck(self):
-        self.nextTime = 0
+        self.scheduler.wake_up()
+
+    def save_concurrency_limits(self):
+        """Stores the limits learned since last call, and sends them to the master."""
+        try:
+            limits = Queue.concurrency.save()
+            if limits and self.mailing_manager:
+                self.mailing_manager.callRemote('send_domain_limits', limits)\
+                    .addErrback(self.eb_send_domain_limits)
+        except pb.DeadReferenceError:
+            self.log.info("MailingManager not connected. Waiting...")
+            self.is_connected = False
+        except Exception:
+            self.log.exception("Error in save_concurrency_limits()")
+
+    def eb_send_domain_limits(self, err):
+        err_msg = str(err.value) or str(err)
+        self.log.error("Error while sending domain limits: %s", err_msg)
+
+    @defer.inlineCallbacks
+    def prefetch_dns(self):
+        """
+        Resolves MX of the domains waiting in queue, so queues don't wait for DNS. Answers expiring before next
+        prefetch are refreshed.
+        """
+        try:
+            t0 = time.time()
+            self.dns_cache.cleanup()
+            domains = yield get_db().mailingrecipient.distinct('domain_name', {'finished': False})
+            yield self.dns_cache.prefetch(domains, margin=settings_vars.get_int(settings_vars.DNS_PREFETCH_DELAY))
+            self.log.debug("DNS prefetched for %d domains in %.1fs (%d answers in cache)",
+                           len(domains), time.time() - t0, len(self.dns_cache))
+        except Exception:
+            self.log.exception("Unknown exception in prefetch_dns.")
 
     @staticmethod
     def make_queue_filter():
@@ -402,51 +603,41 @@ class MailingSender(pb.Referenceable):
 
     def check_mailing(self):
         """
-        Synchronize with the state of the world, and maybe launch a new
-        relay.
+        Creates new relays for the ready recipients of the scheduler, if some relays are free.
 
-        Call me periodically to check I am still up to date.
+        Called by the scheduler each time there may be something to do, so recipients are sent as soon as they are
+        ready.
 
-        @return: None or a Deferred which fires when all of the SMTP clients
-        started by this call have disconnected.
+        @return: None or a Deferred which fires once new relays are started.
         """
-        need_to_release = False
-
-        if time.time() < self.nextTime:
+        if not self.handlingQueueLock.acquire(False):
+            # queues are being built: checked again once done
+            self.check_again = True
             return
+        need_to_release = True
         try:
-            delay_for_next_time = self.delay_if_empty  # default delay
-            if not self.handlingQueueLock.acquire(False):
-                return
-            need_to_release = True
-            
+            self.check_again = False
             self.maxConnections = settings_vars.get_int(settings_vars.MAILING_QUEUE_MAX_THREAD)
             self.maxMessagesPerConnection = settings_vars.get_int(settings_vars.MAILING_QUEUE_MAX_THREAD_SIZE)
-            
-            in_progress = MailingRecipient.search(in_progress=True).count()
-            temp_queue_count = MailingRecipient.search(finished=False).count()
-            to_report_count = MailingRecipient.search(finished=True).count()
+
             active_relay_count = self.relay_manager.activeRelayCount()
+            ready_count = self.scheduler.ready_count()
 
             self.log.debug("Number of active relays: %d / Max relays count: %d / Max recipients per relay: %d / "
-                           "In progress = %d / Queue size = %d / ReportsQueue % d",
-                           active_relay_count, self.maxConnections, self.maxMessagesPerConnection, in_progress,
-                           temp_queue_count, to_report_count)
+                           "Ready = %d / Queue size = %d",
+                           active_relay_count, self.maxConnections, self.maxMessagesPerConnection, ready_count,
+                           len(self.scheduler))
 
-            if active_relay_count >= (int(self.maxConnections / 2) or 1):
-                # this is to limit the number of database queries. Assuming that there is a sufficient
-                # number of recipients to handle, we don't get new ones.
+            if active_relay_count >= self.maxConnections:
+                # checked again once a queue is finished
                 self.log.debug("Skipping filling queue due to too much concurrent connections (%d)", active_relay_count)
                 return
 
-            queue_filter = self.make_queue_filter()
-            if MailingRecipient.find(queue_filter).first():
+            if ready_count:
                 need_to_release = False
-                deferToThread(self.handle_mailing_queue, 
-                              queue_filter
-                              )
-                delay_for_next_time = 0
-            self.nextTime = time.time() + delay_for_next_time
+                d = deferToThread(self.handle_mailing_queue, self.make_queue_filter())
+                d.addBoth(self._cb_handle_mailing_queue)
+                return d
 
         except Exception:
             self.log.exception("Unknown exception in check_mailing.")
@@ -454,7 +645,38 @@ class MailingSender(pb.Referenceable):
             if need_to_release:
                 self.handlingQueueLock.release()
 
+    def _cb_handle_mailing_queue(self, result):
+        """
+        Starts the queues built by `handle_mailing_queue()`, then releases the lock.
+
+        Queues are started from the reactor thread: their MX lookup may be answered at once by the DNS cache, and
+        the connection to the MX server is then made by the same call.
+        """
+        try:
+            if isinstance(result, Failure):
+                self.log.error("handle_mailing_queue() failed: %s", result.getErrorMessage())
+            elif result:
+                mail_server, exchanges, test_exchanges = result
+                self._make_relayers(exchanges, mail_server, testing=False)
+                self._make_relayers(test_exchanges, mail_server, testing=True)
+        except Exception:
+            self.log.exception("Unknown exception while starting queues.")
+        finally:
+            self.handlingQueueLock.release()
+
+        if self.check_again:
+            self.scheduler.wake_up()
+        elif self.scheduler.ready_count() and self.relay_manager.activeRelayCount() < self.maxConnections:
+            # remaining recipients wait for their domain rates, or for their mailing content
+            self.scheduler.wake_up(self.timer_delay)
+
     def handle_mailing_queue(self, queue_filter):
+        """
+        Builds the queues to start. Called from a reactor's thread, as it makes database queries.
+
+        @return: None or a (mail_server, exchanges, test_exchanges) tuple, `exchanges` being dicts as returned by
+            `_get_exchanges_dict()`.
+        """
         #noinspection PyBroadException
         try:
             self.log.debug('handle_mailing_queue()')
@@ -473,23 +695,31 @@ class MailingSender(pb.Referenceable):
                            }
 
             Queue.mxcalc.cleanupBadMXs()
-
-            testing_mailings = map(lambda x: x['_id'], Mailing._get_collection().find({'testing': True}, projection=('_id',)))
-            testing_queue_filter = queue_filter.copy()
-            queue_filter.setdefault('$and', []).append({'mailing.$id': {'$nin': testing_mailings}})
-            testing_queue_filter.setdefault('$and', []).append({'mailing.$id': {'$in': testing_mailings}})
-
-            exchanges = self._get_exchanges_dict(dict(queue_filter))
-            test_exchanges = self._get_exchanges_dict(dict(testing_queue_filter))
+            if Queue.tls_session_cache:
+                Queue.tls_session_cache.cleanup()
+                self.log.debug("TLS: %(handshakes)d handshakes, %(resumed)d resumed (ratio %(resumption_ratio).2f), "
+                               "%(failures)d failures, %(sessions)d sessions in cache",
+                               Queue.tls_session_cache.get_stats())
+            if Queue.source_ips:
+                for ip in Queue.source_ips.addresses:
+                    Queue.rate_limiter.configure_ip(
+                        ip, settings_vars.get_float(settings_vars.MAX_MESSAGES_PER_SECOND_PER_IP),
+                        settings_vars.get_float(settings_vars.MAX_CONNECTIONS_PER_MINUTE_PER_IP))
+            for mx_config in MXConfiguration.find():
+                Queue.rate_limiter.configure_mx(mx_config.mx_name, mx_config.max_messages_per_second,
+                                                mx_config.max_connections_per_minute)
+
+            mailing_ids = set(queue_filter['mailing.$id']['$in'])
+            testing_mailings = set(map(lambda x: x['_id'],
+                                       Mailing._get_collection().find({'testing': True}, projection=('_id',))))
+
+            exchanges = self._get_exchanges_dict(queue_filter, mailing_ids - testing_mailings)
+            test_exchanges = self._get_exchanges_dict(queue_filter, mailing_ids & testing_mailings)
 
             if not exchanges and not test_exchanges:
-                # self.nextTime = time.time() + 60
                 return
 
-            if exchanges:
-                self._make_relayers(exchanges, mail_server, testing=False)
-            if test_exchanges:
-                self._make_relayers(test_exchanges, mail_server, testing=True)
+            return mail_server, exchanges, test_exchanges
 
         except KeyboardInterrupt:
             self.log.info('Mailing queue stopped by user (Crtl-C)')
@@ -498,52 +728,102 @@ class MailingSender(pb.Referenceable):
             self.log.exception("runMailingQueue")
         finally:
             self.log.debug("handle_mailing_queue() finished in %.1fs", time.time() - t0)
-            self.handlingQueueLock.release()
             
-    def _get_exchanges_dict(self, queue_filter):
-        active_queues_count = self.relay_manager.activeRelayCount()
-        exchanges = {} # dict (Key: domain name; Value: list of recipients)
-        skip_domains = []
-        # TODO load domain config then list domain that has reach their max queues number to filter them from query
-        for recipient in MailingRecipient.find(queue_filter).sort('next_try'):
-            assert(isinstance(recipient, MailingRecipient))
-            to = recipient.email
-            parts = to.split('@', 1)
-            if len(parts) != 2:
-                self.log.error("Illegal message destination: " + to)
-                continue
-            domain = parts[1].lower()
-            if domain in skip_domains:
-                continue
+    def _get_exchanges_dict(self, queue_filter, mailing_ids):
+        """
+        Takes the ready recipients of the given mailings from the scheduler, grouped by domain. Only the ones still
+        matching `queue_filter` in database are kept. Each domain may get several queues (so several parallel
+        connections), according to its L{DomainLimits} and to the queues it already has.
+
+        Unless the domain configuration fixes them, the queues count and their size are the ones learned by the
+        L{ConcurrencyController}.
 
-            domain_config = DomainConfiguration.search(domain_name=domain).first() or {}
-
-            if domain not in exchanges:
-                if len(exchanges) >= (self.maxConnections - active_queues_count):
-                    skip_domains.append(domain)
-                    continue # skip this domain
-                if ActiveQueue.search(domain_name=domain).count() >= domain_config.get('max_relayers', settings_vars.get(settings_vars.DEFAULT_MAX_QUEUE_PER_DOMAIN)):
-                    # No more queue for this domain
-                    skip_domains.append(domain)
-                    continue
-                exchanges[domain] = []
-            if len(exchanges[domain]) >= self.maxMessagesPerConnection:
-                skip_domains.append(domain)
-                continue # skip this recipient
-            exchanges[domain].append(recipient)
-            recipient.set_send_mail_in_progress()
+        Queues of domains having the same MX servers are then grouped (see L{group_exchanges_by_mx}). The queues
+        freed by grouping are given to the remaining domains.
+        """
+        free_queues_count = self.maxConnections - self.relay_manager.activeRelayCount()
+        exchanges = {} # dict (Key: domain name; Value: (DomainLimits, list of recipients lists, one per queue))
+        max_messages = {}  # messages per queue, per domain
+        if not mailing_ids:
+            return exchanges
+        group_by_mx = self.dns_cache and settings_vars.get_bool(settings_vars.GROUP_DOMAINS_BY_MX)
+        domains = self.scheduler.domains()
+        while domains and free_queues_count > 0:
+            while domains and free_queues_count > 0:
+                domain = domains.pop(0)
+                limits, queues = self._take_domain_queues(domain, queue_filter, mailing_ids, free_queues_count,
+                                                          max_messages)
+                if queues:
+                    exchanges[domain] = (limits, queues)
+                    free_queues_count -= len(queues)
+            if not group_by_mx:
+                break
+            free_queues_count += group_exchanges_by_mx(exchanges, max_messages, self.dns_cache.cached_mx_names)
         return exchanges
 
-    def _make_relayers(self, exchanges, mail_server, testing=False):
-        for (domain, recipients) in exchanges.iteritems():
-            q_manager = Queue(domain, recipients, mail_server, testing)
-            queue_id = self.relay_manager.add_queue(q_manager)
-            self.log.debug("Relayer for '%s' created." % domain)
-            d = q_manager.start()
+    def _take_domain_queues(self, domain, queue_filter, mailing_ids, free_queues_count, max_messages):
+        """
+        Takes the recipients of at most `free_queues_count` new queues for the domain, and sets the size of its
+        queues into `max_messages`.
 
-            d.addCallbacks(self._cbRelayer, self._ebRelayer,
-                           callbackArgs=(queue_id,),
-                           errbackArgs=(domain, queue_id,))
+        @return: a tuple (L{DomainLimits}, list of recipients lists, one per queue)
+        """
+        domain_config = self.domain_configs.get(domain)
+        limits = get_domain_limits(domain_config)
+        max_messages[domain] = self.maxMessagesPerConnection
+        if Queue.concurrency and not domain_config.get('max_relayers'):
+            # learned queues count may grow up to the MX configuration of the domain, else up to all our relays
+            if domain_config.get('max_mx') or domain_config.get('cnx_per_mx'):
+                ceiling = limits.max_queues
+            else:
+                ceiling = self.maxConnections
+            queues_count, max_messages[domain] = Queue.concurrency.get_limits(
+                domain, ceiling, self.maxMessagesPerConnection)
+            limits = limits._replace(max_queues=queues_count)
+        free_domain_queues = min(free_queues_count, limits.max_queues - self.relay_manager.queues_count(domain))
+        self.configure_rate_limiter(domain, domain_config)
+        queues = []
+        while len(queues) < free_domain_queues and self.can_open_queue(domain):
+            ids = self.scheduler.take(domain, max_messages[domain], mailing_ids)
+            if not ids:
+                break
+            recipients = list(MailingRecipient.find(dict(queue_filter, _id={'$in': ids})).sort('next_try'))
+            if not recipients:
+                # already handled or removed
+                continue
+            MailingRecipient.set_send_mail_in_progress_many(recipients)
+            queues.append(recipients)
+        return limits, queues
+
+    @staticmethod
+    def configure_rate_limiter(domain, domain_config):
+        Queue.rate_limiter.configure_domain(
+            domain,
+            domain_config.get('max_messages_per_second')
+            or settings_vars.get_float(settings_vars.DEFAULT_MAX_MESSAGES_PER_SECOND),
+            domain_config.get('max_connections_per_minute')
+            or settings_vars.get_float(settings_vars.DEFAULT_MAX_CONNECTIONS_PER_MINUTE))
+
+    @staticmethod
+    def can_open_queue(domain):
+        """
+        A new queue (so a new connection) is useless if the domain messages rate is already reached, and forbidden
+        if its connections rate is. The connection is only counted once opened (see L{Queue._open_connection}).
+        """
+        return Queue.rate_limiter.can_send_message(domain) and Queue.rate_limiter.can_open_connection(domain)
+
+    def _make_relayers(self, exchanges, mail_server, testing=False):
+        for (domain, (limits, queues)) in exchanges.iteritems():
+            for recipients in queues:
+                q_manager = Queue(domain, recipients, mail_server, testing,
+                                  max_mx=limits.max_mx, cnx_per_mx=limits.cnx_per_mx)
+                queue_id = self.relay_manager.add_queue(q_manager)
+                self.log.debug("Relayer for '%s' created." % domain)
+                d = q_manager.start()
+
+                d.addCallbacks(self._cbRelayer, self._ebRelayer,
+                               callbackArgs=(queue_id,),
+                               errbackArgs=(domain, queue_id,))
 
     def _cbRelayer(self, domainName, queue_id):
         self.log.debug("Relayer for '%s' finished." % domainName)
@@ -582,6 +862,7 @@ class MailingSender(pb.Referenceable):
 
         MailingRecipient.remove({'mailing.$id': queue_id})
         Mailing.remove({'_id': queue_id})
+        self.scheduler.remove_mailing(queue_id)
         # mailing = Mailing.grab(queue_id)
         # if mailing:
         #     mailing.deleted = True
@@ -590,18 +871,10 @@ class MailingSender(pb.Referenceable):
         # else:
         #     self.log.warn("Mailing id [%d] doesn't exist!", queue_id)
 
-        if queue_id in MailCustomizer.mailingsContent:
-            del MailCustomizer.mailingsContent[queue_id]
+        MailCustomizer.invalidate_mailing_content(queue_id)
 
-        self.log.debug("Delete all customized files for mailing [%d].", queue_id)
-        import glob
-        for entry in glob.glob(os.path.join(settings.MAIL_TEMP, MailCustomizer.make_patten_for_queue(queue_id))):
-            #noinspection PyBroadException
-            try:
-                os.remove(entry)
-            #pylint: disable-msg=W0703
-            except Exception:
-                self.log.exception("Can't remove customized file '%s'", entry)
+        self.log.debug("Delete all customized emails for mailing [%d].", queue_id)
+        self.spool.release_mailing(queue_id)
 
     def remove_closed_mailings(self):
         self.log.info("Remove closed mailings")
@@ -614,31 +887,30 @@ class MailingSender(pb.Referenceable):
                 self.log.warn("Some recipients are still present for closed mailing [%d].", mailing.id)
 
     def delete_all_customized_temp_files(self):
-        """Delete all customized files from temp folder."""
-        self.log.debug("Delete all customized files from temp folder.")
-        import glob
-        for entry in glob.glob(os.path.join(settings.MAIL_TEMP, "cust_ml_*.rfc822*")):
-            #noinspection PyBroadException
-            try:
-                os.remove(entry)
-            #pylint: disable-msg=W0703
-            except Exception:
-                self.log.exception("Can't remove customized file '%s'", entry)
+        """Delete all customized emails, including files from temp folder."""
+        self.log.debug("Delete all customized emails.")
+        self.spool.clear()
 
 
 class ActiveQueuesList(object):
     """Class to handle active relays and provide a way to share live information about relay via DB storage"""
-    def __init__(self, logger):
+    def __init__(self, logger, queueRemovedCallback=None):
         self.log = logger
         self.managed = {}  # SMTP clients we're managing (key = ObjectId, value = Queue)
+        self.domain_queues = Counter()  # active queues per domain (a queue counts for each domain of its recipients)
+        self._lock = threading.Lock()
+        self._queueRemovedCallback = queueRemovedCallback
         ActiveQueue.remove({})  # purge at startup
 
     def add_queue(self, queue):
         """
         Add a queue into the active queues list then return its id.
         """
-        active_queue = ActiveQueue.create(domain_name=queue.domain, recipients=queue.recipients)
-        self.managed[active_queue.id] = queue
+        active_queue = ActiveQueue.create(domain_name=queue.domain, domains=queue.domains,
+                                          recipients=queue.recipients)
+        with self._lock:
+            self.managed[active_queue.id] = queue
+            self.domain_queues.update(queue.domains)
         self.log.debug("add_queue(%s)", active_queue.id)
         return active_queue.id
 
@@ -646,6 +918,11 @@ class ActiveQueuesList(object):
         """Returns the active queues count."""
         return len(self.managed)
 
+    def queues_count(self, domain):
+        """Returns the count of active queues having recipients of this domain."""
+        with self._lock:
+            return self.domain_queues[domain]
+
     def removeActiveRelay(self, queue_id):
         def _remove(queue_id):
             self.log.debug("removeActiveRelay(%s)", queue_id)
@@ -653,7 +930,12 @@ class ActiveQueuesList(object):
             age = datetime.utcnow() - queue.created
             self.log.debug("Queue [%s:%s] was %d seconds old", queue.id, queue.domain_name, age.seconds)
             ActiveQueue.remove({'_id': queue_id})
-            del self.managed[queue_id]
+            with self._lock:
+                self.domain_queues.subtract(self.managed.pop(queue_id).domains)
+                for domain in [domain for domain, count in self.domain_queues.items() if count <= 0]:
+                    del self.domain_queues[domain]
+            if self._queueRemovedCallback:
+                self._queueRemovedCallback()
 
         delay = settings_vars.get_float(settings_vars.MAILING_QUEUE_ENDING_DELAY)
         if delay > 0:
@@ -704,15 +986,35 @@ class Queue(object):
 
     A queue is a resource limiter/controller. A queue should only have one customizer thread, and one TCP connection.
     Also, a queue can only have MAILING_QUEUE_MAX_THREAD_SIZE recipients. So the memory usage is limited too.
+
+    A domain may have several queues. Each one connects to the first of its `max_mx` preferred MX servers having
+    less than `cnx_per_mx` connections, using the connection counters shared by all queues.
+
+    A queue may also hold recipients of other domains served by the same MX servers than `domain`.
     """
     PORT = 25
-    mx_in_use = [] # IP addresses of MX server where we are currently connected
+    # count of our current connections per MX server (key = MX host name: names sharing an address are counted apart)
+    mx_connections = Counter()
     mxcalc = None
-
-    def __init__(self, domain, recipients, mail_server, testing=False):
+    customizer_pool = None  # If set, customization is made by this CustomizerPool instead of reactor's threads
+    spool = None  # MessageSpool keeping customized emails until they are sent
+    connection_pool = None  # If set, SMTPConnectionPool keeping SMTP connections open between queues
+    rate_limiter = None  # If set, RateLimiter limiting messages and connections rates per domain and MX server
+    concurrency = None  # If set, ConcurrencyController adapting queues count and size per domain
+    source_ips = None  # If set, SourceIPPool giving the local address each connection is made from
+    tls_session_cache = None  # If set, TLSSessionCache used for STARTTLS, resuming sessions per MX server
+
+    def __init__(self, domain, recipients, mail_server, testing=False, max_mx=1, cnx_per_mx=1):
         self.domain = domain
         self.mx_ip = None
+        self.mx_addresses = []  # MX servers of the domain, in the preference order
+        self.max_mx = max_mx
+        self.cnx_per_mx = cnx_per_mx
+        self._mx_acquired = False  # True while this queue is counted in `mx_connections`
+        self.source_ip = None
+        self._source_ip_acquired = False  # True while this queue is counted in `source_ips`
         self.recipients = recipients
+        self.domains = [domain] + sorted(set(r.email.split('@', 1)[1].lower() for r in recipients) - {domain})
         self.mail_server = mail_server
         self.testing = testing
         self.log = logging.getLogger('ml_queue.%s' % domain)
@@ -720,6 +1022,10 @@ class Queue(object):
         self.fake_target_port = settings.TEST_TARGET_PORT
         self.factory = None
         self.t0_customization = 0
+        self.t0_connection = 0
+        self.lookahead = 1
+        self._rcpt_managers = []  # recipients not yet customized, in reverse order
+        self._customizing = 0  # count of customizations in progress
 
     def start(self):
         """
@@ -735,6 +1041,13 @@ class Queue(object):
         self.factory = SMTPRelayerFactory(self.domain, retries=0,
                                           connectionClosedCallback=self._cbConnectionClosed,
                                           connectionFailureErrback=self._ebConnectionFailure,
+                                          emailRequestedCallback=self._customize_next_recipients,
+                                          connectionPool=self.connection_pool,
+                                          rateLimiter=self.rate_limiter,
+                                          tlsSessionCache=self.tls_session_cache,
+                                          transcriptCallback=self.store_transcript,
+                                          reconnections=settings_vars.get_int(settings_vars.SMTP_RECONNECTIONS),
+                                          reconnectCallback=self._reconnect,
                                           **kw)
         self.factory.domain = str(main_domain or smtp.DNSNAME)
 
@@ -748,23 +1061,32 @@ class Queue(object):
             d = self.mxcalc.getMX(self.domain)
             d.addCallback(self._cb_store_mx_list)
 
-        d.addCallback(lambda mxs: deferToThread(self._customize_recipients, mxs, self.factory, self.recipients))
+        # customization and sending are pipelined: the connection is opened while first emails are customized
+        d.addCallback(self._start_customization, self.factory, self.recipients)
         d.addCallback(self._send_all_emails, self.PORT, self.factory, self.testing)
 
         d.addErrback(self._ebExchange, self.factory, self.domain, self.recipients)
 
         return d
 
+    @staticmethod
+    def store_transcript(transcript, target):
+        """Stores the transcript of a closed SMTP session, according to the SMTP_TRANSCRIPTS setting."""
+        mode = settings_vars.get(settings_vars.SMTP_TRANSCRIPTS)
+        if mode == 'all' or mode == 'failures' and transcript.failed:
+            SmtpSession.create(_id=ObjectId(transcript.session_id), target=target, failed=transcript.failed,
+                               log=transcript.compressed())
+
     def _cb_store_mx_list(self, mxs):
         self.log.debug("MX list for '%s': %s", self.domain, repr(mxs))
         return map(lambda mx: str(mx.name), mxs)
 
     def _cbConnectionClosed(self, connector):
         """Callback called by SMTPRelayerFactory for connection closed normally.
-        Allows to remove this host from used list.
+        Allows to decrement the connections counter of this host.
         """
-        ip = connector.getDestination().host
-        self.mx_in_use.remove(ip)
+        self._release_mx()
+        self._release_source_ip()
 
     def _ebConnectionFailure(self, connector, err):
         """Callback called by SMTPRelayerFactory for connection error.
@@ -772,46 +1094,174 @@ class Queue(object):
         """
         ip = connector.getDestination().host
         self.mxcalc.markBad(ip)
-        self.mx_in_use.remove(ip)
+        self._release_mx()
+        self._release_source_ip()
+        if self.concurrency:
+            for domain in self.domains:
+                self.concurrency.on_congestion(domain, "connection failure")
+
+    def _cb_mx_connected(self, address):
+        """Callback called by MXConnector when an MX server greeted first. It may not be the selected one."""
+        self.mxcalc.markGood(address)
+        hedge_delay = settings_vars.get_float(settings_vars.MX_HEDGE_DELAY)
+        if self.concurrency and 0 < hedge_delay < time.time() - self.t0_connection:
+            for domain in self.domains:
+                self.concurrency.on_congestion(domain, "slow greeting")
+        if address != self.mx_ip:
+            self._release_mx()
+            self._acquire_mx(address)
+
+    def _eb_mx_failed(self, address, err):
+        """Callback called by MXConnector for each MX server failing to greet. It is temporary disabled."""
+        self.mxcalc.markBad(address)
+
+    def _select_mx(self, addresses):
+        """
+        Returns the first of the `max_mx` preferred MX having less than `cnx_per_mx` connections. If all of them are
+        full (they may be shared with other domains), the least used one is returned.
+        """
+        candidates = addresses[:self.max_mx]
+        for address in candidates:
+            if self.mx_connections[address] < self.cnx_per_mx:
+                return address
+        address = min(candidates, key=lambda mx: self.mx_connections[mx])
+        self.log.debug("All MX servers for '%s' have reach their connections limit. Using '%s'.", self.domain, address)
+        return address
+
+    def _acquire_mx(self, address):
+        self.mx_ip = address
+        self.mx_connections[address] += 1
+        self._mx_acquired = True
 
-    def _customize_recipients(self, mxs, factory, recipients):
-        self.log.debug("Starting customization...")
-        self.t0_customization = time.time()
+    def _release_mx(self):
+        if not self._mx_acquired:
+            return
+        self._mx_acquired = False
+        self.mx_connections[self.mx_ip] -= 1
+        if self.mx_connections[self.mx_ip] <= 0:
+            del self.mx_connections[self.mx_ip]
+
+    def _acquire_source_ip(self):
+        if not self.source_ips:
+            return
+        self.source_ip = self.source_ips.select(self.domain)
+        self.source_ips.acquire(self.source_ip, self.domain)
+        self._source_ip_acquired = True
+
+    def _release_source_ip(self):
+        if not self._source_ip_acquired:
+            return
+        self._source_ip_acquired = False
+        self.source_ips.release(self.source_ip, self.domain)
+
+    def _make_recipient_managers(self, factory, recipients):
+        rcpt_managers = []
+        mailings = {}  # each mailing is loaded only once
         for recipient in recipients:
-            if not recipient.mailing:
+            mailing_id = recipient['mailing'].id
+            if mailing_id not in mailings:
+                mailings[mailing_id] = recipient.mailing
+            mailing = mailings[mailing_id]
+            if not mailing:
                 self.log.warn("Can't find mailing [%d] for recipient [%s:%s]",
-                              recipient['mailing'], recipient.id, recipient.email)
+                              mailing_id, recipient.id, recipient.email)
                 continue
-            rcpt_manager = RecipientManager(factory, recipient, lambda: self.mx_ip, self.log)
-            rcpt_manager.send().addCallbacks(self._cbRecipient,
-                                             self._ebRecipient,
-                                             callbackArgs=(factory,),
-                                             errbackArgs=(recipient, factory,)
-                                             )
-        if factory.get_recipients_count():
-            return mxs
-        else:
-            self.log.error("Factory is empty! All recipients failed at customization level.")
+            rcpt_managers.append(RecipientManager(factory, recipient, lambda: self.mx_ip, self.log, mailing=mailing,
+                                                  spool=self.spool))
+        return rcpt_managers
+
+    def _start_customization(self, mxs, factory, recipients):
+        """
+        Starts customization of the first recipients. Next ones are customized as soon as the connection takes
+        emails, so at most `lookahead` customized emails are waiting for it.
+        """
+        self.log.debug("Starting customization%s...", self.customizer_pool and " using customizer pool" or "")
+        self.t0_customization = time.time()
+        self.lookahead = max(1, settings_vars.get_int(settings_vars.CUSTOMIZATION_LOOKAHEAD))
+        self._rcpt_managers = self._make_recipient_managers(factory, recipients)
+        if not self._rcpt_managers:
+            self.log.error("Factory is empty! No valid recipients.")
             return Failure(EmtpyFactory("No recipients for domain '%s'!" % self.domain))
+        self._rcpt_managers.reverse()
+        factory.expect_emails(len(self._rcpt_managers))
+        factory.deferred.addErrback(self._stop_customization)
+        self._customize_next_recipients()
+        return mxs
+
+    def _customize_next_recipients(self):
+        while self._rcpt_managers and self._customizing + self.factory.get_recipients_count() < self.lookahead:
+            rcpt_manager = self._rcpt_managers.pop()
+            self._customizing += 1
+            rcpt_manager.send(self.customizer_pool).addCallbacks(self._cbRecipient,
+                                                                 self._ebRecipient,
+                                                                 callbackArgs=(self.factory,),
+                                                                 errbackArgs=(rcpt_manager.recipient, self.factory,)
+                                                                 )
+            rcpt_manager.customized.addBoth(self._cb_recipient_customized)
+
+    def _cb_recipient_customized(self, result):
+        self._customizing -= 1
+        if not self._rcpt_managers and not self._customizing:
+            self.log.debug("Customization finished in %.1fs", time.time() - self.t0_customization)
+        self._customize_next_recipients()
+        return result
+
+    def _stop_customization(self, err):
+        """Connection failed: remaining recipients won't be customized."""
+        self._rcpt_managers = []
+        return err
 
     def _send_all_emails(self, addresses, port, factory, testing):
-        self.log.debug("Customization finished in %.1fs", time.time() - self.t0_customization)
         # print "_send_all_emails(%s): %s" % (factory.targetDomain, addresses)
-        DomainStats.add_dns_success(factory.targetDomain)
+        for domain in self.domains:
+            DomainStats.add_dns_success(domain)
 
-        self.log.debug("Factory [%s] contains '%d' recipients", factory.targetDomain, factory.get_recipients_count())
+        self.log.debug("Factory [%s] expects '%d' recipients", factory.targetDomain, factory.pending_emails)
         if testing:
-            address = self.fake_target_ip
             port = self.fake_target_port
+            addresses = [self.fake_target_ip]
+        self.mx_addresses = addresses
+        self._connect(factory, addresses, port)
+        return factory.deferred
+
+    def _reconnect(self, connector, err):
+        """
+        Callback called by SMTPRelayerFactory when the connection is lost before all emails are sent. Remaining ones
+        are sent through a new connection, to another MX server if possible.
+        """
+        address = self.mx_ip
+        self._ebConnectionFailure(connector, err)
+        self._connect(self.factory, [mx for mx in self.mx_addresses if mx != address] + [address],
+                      connector.getDestination().port)
+
+    def _connect(self, factory, addresses, port):
+        address = self._select_mx(addresses)
+        self._acquire_mx(address)
+        self._acquire_source_ip()
+        # other MX are tried if the selected one fails
+        connector = MXConnector(factory, [address] + [mx for mx in addresses if mx != address], port,
+                                hedge_delay=settings_vars.get_float(settings_vars.MX_HEDGE_DELAY),
+                                bind_address=self.source_ip and (self.source_ip, 0) or None,
+                                mxConnectedCallback=self._cb_mx_connected,
+                                mxFailedCallback=self._eb_mx_failed)
+        if self.connection_pool is not None:
+            self.connection_pool.connect(factory, address, port, source_ip=self.source_ip,
+                                         fallback=lambda: self._open_connection(connector, address))
         else:
-            address = addresses[0]
-        self.mx_ip = address
-        reactor.connectTCP(address, port, factory)
-        #noinspection PyTypeChecker
-        self.mx_in_use.append(address)
-        #pylint: enable-msg=E1101
+            self._open_connection(connector, address)
 
-        return factory.deferred
+    def _open_connection(self, connector, address):
+        """
+        Opens a new connection, when allowed by the connections rate of the domain, of the MX server and of the
+        source IP.
+        """
+        delay = self.rate_limiter.acquire_connection(self.domain, address, self.source_ip) if self.rate_limiter else 0
+        if delay > 0:
+            self.log.debug("Connections rate reached for '%s'. Connecting in %.1fs", address, delay)
+            reactor.callLater(delay, self._open_connection, connector, address)
+            return
+        self.t0_connection = time.time()
+        connector.connect()
 
     def _ebExchange(self, err, factory, domain, recipients):
         self.log.error('Error setting up managed relay factory for %s: %s', domain, repr(err))
@@ -885,7 +1335,8 @@ class Queue(object):
 
     def _cbRecipient(self, recipient, factory):
         #self.log.debug("Recipient '%s' finished with success." % recipient)
-        pass
+        if self.source_ip:
+            self.source_ips.add_sent(self.source_ip)
 
     def _ebRecipient(self, err, recipient, factory):
         #self.log.error("Recipient '%s' finished with error '%s'." % (recipient, err))
@@ -893,7 +1344,7 @@ class Queue(object):
 
 
 class RecipientManager(object):
-    def __init__(self, factory, recipient, get_target_ip, log):
+    def __init__(self, factory, recipient, get_target_ip, log, mailing=None, spool=None):
         assert(isinstance(recipient, MailingRecipient))
         self.factory = factory
         self.recipient = recipient
@@ -903,78 +1354,117 @@ class RecipientManager(object):
         self.log = log
         self.email_from = recipient.mail_from
         self.email_to   = recipient.email
-        self.mailing_id = recipient.mailing.id
-        self.temp_filename = None
+        self.domain_name = self.email_to.split('@', 1)[1].lower()
+        self.mailing = mailing or recipient.mailing
+        self.mailing_id = self.mailing.id
+        self.spool = spool if spool is not None else Queue.spool  # an empty spool is false
+        self.spooled_message = None
+        self.customized = None
         
-    def send(self):
-        if self.recipient.mailing.return_path_domain:
-            email_from = "%s-%s@%s" % (self.recipient.mailing.id, self.recipient.tracking_id,
-                                       self.recipient.mailing.return_path_domain)
+    def send(self, customizer_pool=None):
+        """
+        Customizes the email for this recipient, stores it into the spool then adds it into the factory.
+
+        @param customizer_pool: if given, customization is made by a worker process of this L{CustomizerPool}.
+            Else, it is made into a reactor thread.
+        @return: a deferred fired when the recipient has been handled. The `customized` attribute contains another
+            deferred fired when the customization is done (successfully or not).
+        """
+        if customizer_pool:
+            self.customized = customizer_pool.customize(self.recipient, self.mailing)
+        else:
+            self.customized = deferToThread(MailCustomizer(self.recipient,
+                                                           self.mailing.read_tracking,
+                                                           self.mailing.click_tracking,
+                                                           self.mailing.url_encoding,
+                                                           mailing=self.mailing).customize)
+        self.customized.addCallback(self._add_to_factory)
+        self.customized.addErrback(self._on_customization_failure)
+        return self.deferred
+
+    def _add_to_factory(self, customizer_result):
+        if self.factory.deferred is None:
+            # factory already stopped (connection failed while customizing): the recipient has been postponed by
+            # Queue._ebExchange()
+            self.factory.cancel_email()
+            self.deferred.errback(Failure(smtp.SMTPConnectError(-1, "Connection closed before email customization "
+                                                                    "was finished.")))
+            return
+        if self.mailing.return_path_domain:
+            email_from = "%s-%s@%s" % (self.mailing.id, self.recipient.tracking_id,
+                                       self.mailing.return_path_domain)
         else:
             email_from = self.email_from
-        try:
-            uid, path = MailCustomizer(self.recipient,
-                                       self.recipient.mailing.read_tracking,
-                                       self.recipient.mailing.click_tracking,
-                                       self.recipient.mailing.url_encoding).customize()
-            self.temp_filename = path
-            self.factory.send_email(email_from, (self.email_to,), path)\
-                .addCallbacks(self.onSuccess, self.onFailure)
-
-        except OSError, ex:
+        uid, segments = customizer_result
+        # emails to backup are written on disk to be moved into backup folder once sent
+        self.spooled_message = self.spool.store(self.mailing_id, self.recipient.id, segments,
+                                                on_disk=self.mailing.backup_customized_emails)
+        self.factory.send_email(email_from, (self.email_to,), self.spooled_message)\
+            .addCallbacks(self.onSuccess, self.onFailure)
+
+    def _on_customization_failure(self, err):
+        self.factory.cancel_email()
+        ex = err.value
+        if err.check(OSError):
             self.log.error("Mailing customizer failure for mailing %s and recipient %s: %s", self.email_from, self.email_to, str(ex))
             if ex.errno == 2:  # No such file or directory
                 self.recipient.update_send_status(RECIPIENT_STATUS.WARNING, smtp_message = "Email customization temporary error: %s" % str(ex.message))
             else:
                 self.recipient.update_send_status(RECIPIENT_STATUS.GENERAL_ERROR, smtp_message = str(ex))
 
-        except smtp.AddressError, ex:
+        elif err.check(smtp.AddressError):
             self.log.error("[Mailing %s] Failed to add email '%s' to SMTPRelayerFactory: %s", self.email_from, self.email_to, ex.message)
             self.recipient.update_send_status(RECIPIENT_STATUS.GENERAL_ERROR, smtp_message = ex.message)
             self.recipient.mark_as_finished()
             HourlyStats.add_failed()
-            DomainStats.add_failed(self.factory.targetDomain)
-            self.deferred.errback(Failure(ex))
+            DomainStats.add_failed(self.domain_name)
+            self.deferred.errback(err)
 
-        except Exception, ex:
-            self.log.exception("[Mailing %s] Failed to handle email '%s'", self.email_from, self.email_to)
+        else:
+            self.log.error("[Mailing %s] Failed to handle email '%s': %s", self.email_from, self.email_to, err.getTraceback())
             self.recipient.update_send_status(RECIPIENT_STATUS.GENERAL_ERROR, smtp_message = str(ex))
             self.recipient.mark_as_finished()
             HourlyStats.add_failed()
-            DomainStats.add_failed(self.factory.targetDomain)
-            self.deferred.errback(Failure(ex))
+            DomainStats.add_failed(self.domain_name)
+            self.deferred.errback(err)
 
-        return self.deferred
+    def stored_session_id(self, failed):
+        """
+        Returns the id of the SMTP session transcript if it is stored (see L{Queue.store_transcript}), else None.
+        A refused email makes its session failed.
+        """
+        mode = settings_vars.get(settings_vars.SMTP_TRANSCRIPTS)
+        if mode == 'all' or mode == 'failures' and failed:
+            return self.factory.session_id
+        return None
 
     def onSuccess(self, data):
         logging.getLogger('mailing.out').info("MAILING [%d] SENT FROM <%s> TO <%s>", self.mailing_id,
                                               self.email_from, self.email_to)
-        self.recipient.update_send_status(RECIPIENT_STATUS.FINISHED, smtp_message = '', target_ip=self.get_target_ip())
+        self.recipient.update_send_status(RECIPIENT_STATUS.FINISHED, smtp_message = '', target_ip=self.get_target_ip(),
+                                          smtp_session=self.stored_session_id(failed=False))
         self.recipient.mark_as_finished()
         HourlyStats.add_sent()
-        DomainStats.add_sent(self.factory.targetDomain)
-        # print Mailing._get_collection().find({'_id': self.mailing_id}, {'backup_customized_emails': True})[0]
-        if self.temp_filename and os.path.exists(self.temp_filename):
-            if Mailing._get_collection().find({'_id': self.mailing_id}, {'backup_customized_emails': True})[0].get('backup_customized_emails', False):
-                self.log.debug("Moving customized content '%s' to '%s' folder", os.path.basename(self.temp_filename), settings.CUSTOMIZED_CONTENT_FOLDER)
-                os.rename(self.temp_filename, os.path.join(settings.CUSTOMIZED_CONTENT_FOLDER, os.path.basename(self.temp_filename)))
-                self.log.debug(os.path.join(settings.CUSTOMIZED_CONTENT_FOLDER, os.path.basename(self.temp_filename)))
-                self.log.debug("Exists? %s", os.path.exists(os.path.join(settings.CUSTOMIZED_CONTENT_FOLDER, os.path.basename(self.temp_filename))))
+        DomainStats.add_sent(self.domain_name)
+        if Queue.concurrency:
+            Queue.concurrency.on_success(self.domain_name)
+        if self.spooled_message:
+            if self.mailing.backup_customized_emails:
+                self.spool.release(self.spooled_message, backup_folder=settings.CUSTOMIZED_CONTENT_FOLDER)
             else:
-                self.log.debug("Deleting customized content: '%s'", self.temp_filename)
-                # os.remove(self.temp_filename)
+                self.spool.release(self.spooled_message)
         self.deferred.callback(self.recipient)
     
     def onFailure(self, err):
-        handle_recipient_failure(err, self.recipient, self.email_from, self.email_to, self.get_target_ip(), self.log)
-        if self.recipient.send_status in (RECIPIENT_STATUS.ERROR, RECIPIENT_STATUS.GENERAL_ERROR) \
-                and self.temp_filename and os.path.exists(self.temp_filename):
-            self.log.debug("Deleting customized content: '%s'", self.temp_filename)
-            os.remove(self.temp_filename)
+        handle_recipient_failure(err, self.recipient, self.email_from, self.email_to, self.get_target_ip(), self.log,
+                                 smtp_session=self.stored_session_id(failed=True))
+        if self.spooled_message:
+            # customized again on next try, keeping it would hold the spool memory meanwhile
+            self.spool.release(self.spooled_message)
         self.deferred.errback(err)
 
 
-def handle_recipient_failure(err, recipient, email_from, email_to, target_ip, log):
+def handle_recipient_failure(err, recipient, email_from, email_to, target_ip, log, smtp_session=None):
     assert(isinstance(recipient, MailingRecipient))
     if not recipient.in_progress:
         log.error("Programming error : trying to handle error on recipient <%s> not in progress. Skipped...", recipient)
@@ -1001,11 +1491,19 @@ def handle_recipient_failure(err, recipient, email_from, email_to, target_ip, lo
             log.warn("WARNING sending mailing FROM <%s> TO <%s>: %s", email_from, email_to, resp)
             logging.getLogger('mailing.out').warn("MAILING [%d] SOFTBOUNCED sending mailing FROM <%s> TO <%s>: %s", recipient.mailing.id, email_from, email_to, resp)
             recipient.update_send_status(RECIPIENT_STATUS.WARNING, smtp_code=code, smtp_message=resp, smtp_log=exc.log,
-                                         target_ip=target_ip)
+                                         target_ip=target_ip, smtp_session=smtp_session)
             recipient.set_send_mail_next_time()
             recipient.mark_as_finished()
             HourlyStats.add_try()
             DomainStats.add_try(domain_name)
+            if Queue.concurrency:
+                reason = code and "%s %s" % (code, resp) or resp
+                if not code or code < 0 or code == 421:
+                    # the server itself is congested (421, connection failed, lost or timed out)
+                    Queue.concurrency.on_congestion(domain_name, reason)
+                else:
+                    # may only concern this recipient (greylisting, full mailbox, ...)
+                    Queue.concurrency.on_deferral(domain_name, reason)
             log.debug("Mailing [%s]: recipient <%s> postponed to %s", recipient.mail_from,
                                                                       recipient,
                                                                       recipient.next_try.isoformat(' '))
@@ -1013,7 +1511,7 @@ def handle_recipient_failure(err, recipient, email_from, email_to, target_ip, lo
             log.error("ERROR sending mailing FROM <%s> TO <%s>: %s", email_from, email_to, resp)
             logging.getLogger('mailing.out').error("MAILING [%d] ERROR sending mailing FROM <%s> TO <%s>: %s", recipient.mailing.id, email_from, email_to, resp)
             recipient.update_send_status(RECIPIENT_STATUS.ERROR, smtp_code=code, smtp_message=resp, smtp_log=exc.log,
-                                         target_ip=target_ip)
+                                         target_ip=target_ip, smtp_session=smtp_session)
             recipient.mark_as_finished()
             HourlyStats.add_failed()
             DomainStats.add_failed(domain_name)
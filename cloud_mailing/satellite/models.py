@@ -101,7 +101,8 @@ class MailingRecipient(Model):
     reply_code      = Field(int)
     reply_enhanced_code = Field()
     reply_text      = Field()
-    smtp_log        = Field()
+    smtp_log        = Field()   # its own part of the SMTP session transcript
+    smtp_session    = Field()   # id of the SmtpSession holding the whole transcript, if stored
     in_progress     = Field(bool, default=False)  # added in temp queue
     created         = Field(datetime, default=datetime.utcnow)
     modified        = Field(datetime, default=datetime.utcnow)
@@ -125,8 +126,33 @@ class MailingRecipient(Model):
         self.next_try = datetime.utcnow()
         self.save()
 
+    @classmethod
+    def set_send_mail_in_progress_many(cls, recipients):
+        """
+        Same as `set_send_mail_in_progress()` for several recipients, using at most 3 database writes whatever
+        their count.
+        """
+        now = datetime.utcnow()
+        fields = {'send_status': RECIPIENT_STATUS.IN_PROGRESS, 'in_progress': True, 'next_try': now, 'modified': now}
+        first_tries, counted, not_counted = [], [], []
+        for recipient in recipients:
+            if not recipient.first_try:
+                recipient.first_try = now
+                first_tries.append(recipient.id)
+            (not_counted if recipient.try_count is None else counted).append(recipient.id)
+            recipient.try_count = (recipient.try_count or 0) + 1
+            for name, value in fields.items():
+                setattr(recipient, name, value)
+        collection = cls._get_collection()
+        if counted:
+            collection.update_many({'_id': {'$in': counted}}, {'$set': fields, '$inc': {'try_count': 1}})
+        if not_counted:
+            collection.update_many({'_id': {'$in': not_counted}}, {'$set': dict(fields, try_count=1)})
+        if first_tries:
+            collection.update_many({'_id': {'$in': first_tries}}, {'$set': {'first_try': now}})
+
     def update_send_status(self, send_status, smtp_code=None, smtp_e_code=None, smtp_message=None, in_progress=False,
-                           smtp_log=None, target_ip=None):
+                           smtp_log=None, target_ip=None, smtp_session=None):
         """
         Updates the contact status.
         """
@@ -141,6 +167,7 @@ class MailingRecipient(Model):
         self.reply_enhanced_code = smtp_e_code and smtp_e_code or None
         self.reply_text = smtp_message and unicode(smtp_message, errors='replace') or None
         self.smtp_log = smtp_log and unicode(smtp_log, errors='replace') or None
+        self.smtp_session = smtp_session
         self.in_progress = in_progress
         self.save()
         #if send_status in (RECIPIENT_STATUS.ERROR, RECIPIENT_STATUS.GENERAL_ERROR):
@@ -175,6 +202,8 @@ class HourlyStats(Model):
     sent        = Field(int, default=0)
     failed      = Field(int, default=0)
     tries       = Field(int, default=0)  # Total tentatives count, including sent, failed and temporary failed.
+    tls_handshakes = Field(int, default=0)  # successful TLS handshakes, including resumed sessions
+    tls_resumed = Field(int, default=0)  # TLS sessions resumed (abbreviated handshakes)
     up_to_date  = Field(bool, default=False)  # If false, this entry needs to be sent to the CloudMaster.
 
     @staticmethod
@@ -200,6 +229,10 @@ class HourlyStats(Model):
     def add_try():
         HourlyStats.__generic_update({'$inc': {'tries': 1}})
 
+    @staticmethod
+    def add_tls_handshake(resumed):
+        HourlyStats.__generic_update({'$inc': {'tls_handshakes': 1, 'tls_resumed': resumed and 1 or 0}})
+
 
 
 class DomainStats(Model):
@@ -303,10 +336,35 @@ class DomainConfiguration(Model):
                                 # or None to use the default rule = half of the MX servers)
     cnx_per_mx = Field(int)     # the maximum simultaneous connections per MX server
     max_mx = Field(int)         # the maximum simultaneous connected MX servers
+    max_messages_per_second = Field(float)      # None or 0 to use the default rate
+    max_connections_per_minute = Field(float)   # None or 0 to use the default rate
+
+
+class MXConfiguration(Model):
+    mx_name = Field(required=True)  # MX server host name (or IP address)
+    max_messages_per_second = Field(float)      # None or 0 for no limit
+    max_connections_per_minute = Field(float)   # None or 0 for no limit
+
+
+class DomainConcurrency(Model):
+    """Limits learned by the ConcurrencyController, kept across restarts."""
+    domain_name = Field(required=True)
+    queues = Field(float)               # allowed simultaneous queues
+    messages_per_queue = Field(float)   # allowed messages per queue (so per connection)
+    updated = Field(datetime)
+
+
+class SmtpSession(Model):
+    """Whole transcript of an SMTP session, stored once for all its recipients and sent to the CloudMaster."""
+    target = Field()    # server address
+    created = Field(datetime, default=datetime.utcnow)
+    failed = Field(bool, default=False)  # True if an email was refused or if the connection was lost
+    log = Field()       # zlib compressed transcript
 
 
 class ActiveQueue(Model):
     domain_name = Field(required=True)
+    domains = Field()  # all domains of its recipients, `domain_name` being the one used to get MX servers
     recipients = Field()
     created = Field(datetime, default=datetime.utcnow)
 
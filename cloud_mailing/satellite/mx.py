@@ -235,5 +235,8 @@ class FakedMXCalculator:
     def markBad(self, ip):
         pass
 
+    def markGood(self, ip):
+        pass
+
     def cleanupBadMXs(self):
         pass
\ No newline at end of file
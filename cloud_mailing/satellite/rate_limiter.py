@@ -0,0 +1,139 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+__author__ = 'ricard'
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` events per second on average, with bursts of at most `capacity` events.
+    """
+
+    def __init__(self, rate, capacity, clock):
+        self.clock = clock
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = clock.seconds()
+
+    def update(self, rate, capacity):
+        """Changes the limits. Tokens already available are kept, up to the new capacity."""
+        self._refill()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def delay(self):
+        """Returns the time, in seconds, to wait for the next token (0 if available)."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class RateLimiter(object):
+    """
+    Token buckets limiting messages per second and connections per minute, for each domain, each MX server and
+    each local source IP.
+
+    There is no limit for a domain, a server or a source IP until it is configured with non null rates. The same instance may
+    be used by reactor's threads.
+    """
+
+    def __init__(self, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self._buckets = {}  # key = (kind ('domain', 'mx' or 'ip'), name, 'messages' or 'connections')
+        self._lock = threading.Lock()
+
+    def configure_domain(self, domain, messages_per_second=None, connections_per_minute=None):
+        self._configure('domain', domain, messages_per_second, connections_per_minute)
+
+    def configure_mx(self, mx, messages_per_second=None, connections_per_minute=None):
+        self._configure('mx', mx, messages_per_second, connections_per_minute)
+
+    def configure_ip(self, ip, messages_per_second=None, connections_per_minute=None):
+        self._configure('ip', ip, messages_per_second, connections_per_minute)
+
+    def _configure(self, kind, name, messages_per_second, connections_per_minute):
+        with self._lock:
+            self._set_rate((kind, name, 'messages'), messages_per_second)
+            self._set_rate((kind, name, 'connections'), connections_per_minute and connections_per_minute / 60.0)
+
+    def _set_rate(self, key, rate):
+        if not rate:
+            self._buckets.pop(key, None)
+            return
+        # bursts up to one second of messages, or one minute of connections
+        capacity = max(1.0, rate if key[2] == 'messages' else rate * 60)
+        bucket = self._buckets.get(key)
+        if bucket:
+            bucket.update(rate, capacity)
+        else:
+            self._buckets[key] = TokenBucket(rate, capacity, self.clock)
+
+    def _acquire(self, keys):
+        """Takes a token from each existing bucket if all have one. Else, returns the time to wait for them."""
+        with self._lock:
+            buckets = filter(None, map(self._buckets.get, keys))
+            delay = max([bucket.delay() for bucket in buckets] or [0])
+            if not delay:
+                for bucket in buckets:
+                    bucket.consume()
+            return delay
+
+    def acquire_message(self, domain, mx=None, ip=None):
+        """
+        Takes the right to send a message to the domain through the MX server, from the source IP.
+
+        @return: 0 if allowed, else the delay (in seconds) to wait before asking again.
+        """
+        return self._acquire([('domain', domain, 'messages'), ('mx', mx, 'messages'), ('ip', ip, 'messages')])
+
+    def acquire_connection(self, domain=None, mx=None, ip=None):
+        """
+        Takes the right to open a connection for the domain and/or to the MX server, from the source IP.
+
+        @return: 0 if allowed, else the delay (in seconds) to wait before asking again.
+        """
+        return self._acquire([('domain', domain, 'connections'), ('mx', mx, 'connections'),
+                              ('ip', ip, 'connections')])
+
+    def can_send_message(self, domain):
+        """Returns True if a message for this domain may be sent now (without taking it)."""
+        return self._is_available(('domain', domain, 'messages'))
+
+    def can_open_connection(self, domain):
+        """Returns True if a connection for this domain may be opened now (without taking it)."""
+        return self._is_available(('domain', domain, 'connections'))
+
+    def _is_available(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            return not bucket or not bucket.delay()
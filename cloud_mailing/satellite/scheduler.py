@@ -0,0 +1,185 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import calendar
+import heapq
+import logging
+import threading
+
+from .models import MailingRecipient, RECIPIENT_STATUS
+
+__author__ = 'ricard'
+
+
+def _timestamp(date):
+    if date is None:
+        return 0
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
+
+
+class SendScheduler(object):
+    """
+    Keeps in memory the recipients waiting to be sent, so queues are built without scanning the recipients
+    collection.
+
+    Recipients whose `next_try` is reached are ready: they wait in a queue per domain, ordered by `next_try`. The
+    other ones wait in a heap until their `next_try`. `wakeupCallback` is called as soon as recipients become ready,
+    and when asked by `wake_up()`, for example once a queue is finished. Several requests made before the callback
+    is called lead to a single call.
+
+    Entries are only hints: recipients are checked against the database when queues are built, so removed or
+    already handled recipients are simply ignored.
+
+    `add()`, `load()` and `wake_up()` must be called from the reactor thread. Other methods may be used by reactor's
+    threads.
+    """
+
+    def __init__(self, wakeupCallback, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.log = logging.getLogger('scheduler')
+        self._wakeupCallback = wakeupCallback
+        self._ready = {}  # key = domain, value = heap of (next_try, recipient id, mailing id)
+        self._waiting = []  # heap of (next_try, recipient id, mailing id, domain)
+        self._timer = None  # fires when the first waiting recipient is ready
+        self._wakeup_call = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._waiting) + sum(map(len, self._ready.values()))
+
+    def ready_count(self):
+        with self._lock:
+            self._release_due()
+            return sum(map(len, self._ready.values()))
+
+    def add(self, recipient_id, domain, mailing_id, next_try=None):
+        """Adds a recipient to send from its `next_try` date (now if None)."""
+        with self._lock:
+            when = _timestamp(next_try)
+            if when <= self.clock.seconds():
+                heapq.heappush(self._ready.setdefault(domain.lower(), []), (when, recipient_id, mailing_id))
+                ready = True
+            else:
+                heapq.heappush(self._waiting, (when, recipient_id, mailing_id, domain.lower()))
+                ready = False
+        if ready:
+            self.wake_up()
+        else:
+            self._schedule_timer()
+
+    def load(self):
+        """Replaces all entries by the recipients ready to be sent found in database."""
+        with self._lock:
+            self._ready = {}
+            self._waiting = []
+        cursor = MailingRecipient._get_collection().find(
+            {'$or': [{'in_progress': False}, {'in_progress': None}],
+             'send_status': RECIPIENT_STATUS.READY,
+             'finished': False},
+            projection=('domain_name', 'mailing', 'next_try'))
+        count = 0
+        for recipient in cursor:
+            self.add(recipient['_id'], recipient['domain_name'], recipient['mailing'].id, recipient.get('next_try'))
+            count += 1
+        self.log.debug("Scheduler loaded with %d recipients", count)
+
+    def remove_mailing(self, mailing_id):
+        """Forgets all recipients of the mailing."""
+        with self._lock:
+            for domain, heap in self._ready.items():
+                heap[:] = [entry for entry in heap if entry[2] != mailing_id]
+                if heap:
+                    heapq.heapify(heap)
+                else:
+                    del self._ready[domain]
+            self._waiting = [entry for entry in self._waiting if entry[2] != mailing_id]
+            heapq.heapify(self._waiting)
+
+    def domains(self):
+        """Returns the domains having ready recipients, the ones waiting for the longest time first."""
+        with self._lock:
+            self._release_due()
+            return sorted(self._ready, key=lambda domain: self._ready[domain][0])
+
+    def take(self, domain, count, mailing_ids):
+        """
+        Removes, then returns the ids of, at most `count` ready recipients of the domain belonging to the given
+        mailings, the oldest first. Recipients of other mailings stay ready.
+        """
+        with self._lock:
+            heap = self._ready.get(domain)
+            taken = []
+            kept = []
+            while heap and len(taken) < count:
+                entry = heapq.heappop(heap)
+                if entry[2] in mailing_ids:
+                    taken.append(entry[1])
+                else:
+                    kept.append(entry)
+            for entry in kept:
+                heapq.heappush(heap, entry)
+            if domain in self._ready and not heap:
+                del self._ready[domain]
+            return taken
+
+    def wake_up(self, delay=0):
+        """Asks for a call to `wakeupCallback` within `delay` seconds."""
+        if self._wakeup_call and self._wakeup_call.active():
+            if self._wakeup_call.getTime() <= self.clock.seconds() + delay:
+                return
+            self._wakeup_call.cancel()
+        self._wakeup_call = self.clock.callLater(delay, self._wake_up)
+
+    def stop(self):
+        """Cancels pending calls."""
+        for call in (self._wakeup_call, self._timer):
+            if call and call.active():
+                call.cancel()
+        self._wakeup_call = self._timer = None
+
+    def _wake_up(self):
+        self._wakeup_call = None
+        self._wakeupCallback()
+
+    def _release_due(self):
+        now = self.clock.seconds()
+        while self._waiting and self._waiting[0][0] <= now:
+            when, recipient_id, mailing_id, domain = heapq.heappop(self._waiting)
+            heapq.heappush(self._ready.setdefault(domain, []), (when, recipient_id, mailing_id))
+
+    def _schedule_timer(self):
+        with self._lock:
+            if not self._waiting:
+                return
+            when = self._waiting[0][0]
+        if self._timer and self._timer.active():
+            if self._timer.getTime() <= when:
+                return
+            self._timer.cancel()
+        self._timer = self.clock.callLater(max(0, when - self.clock.seconds()), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        with self._lock:
+            self._release_due()
+            ready = bool(self._ready)
+        if ready:
+            self.wake_up()
+        self._schedule_timer()
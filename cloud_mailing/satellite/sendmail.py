@@ -158,12 +158,14 @@ class EmailSender(smtplib.SMTP):
 
 from OpenSSL.SSL import SSLv3_METHOD
 
-from twisted.mail.smtp import ESMTPClient, ESMTPSenderFactory, DNSNAME, Address
+from twisted.mail.smtp import ESMTPClient, ESMTPSenderFactory, DNSNAME, Address, quoteaddr
 from twisted.internet.ssl import ClientContextFactory
 from twisted.internet import defer
 from twisted.internet import reactor, protocol, error
+from twisted.protocols import basic, policies
 from twisted.mail import smtp
 from twisted.python.failure import Failure
+from .transcripts import SessionTranscript
 
 def sendmail_async(
     authenticationUsername, authenticationSecret,
@@ -218,7 +220,21 @@ def sendmail_async(
 class RelayerMixin:
     """
     Add relayer capability to an SMTPClient taking emails from its factory.
+
+    If the server supports the PIPELINING extension (RFC 2920), MAIL FROM, RCPT TO and DATA commands of an email are
+    sent at once, and replies are handled in the same order. If it also supports CHUNKING (RFC 3030), the message
+    is sent with BDAT commands, also pipelined, instead of DATA.
+
+    If the factory has a L{TLSSessionCache} and the server supports STARTTLS, the session is encrypted, resuming
+    the previous TLS session with this server when possible. Unless transport security is required, a refused
+    STARTTLS command lets the session go on in plain text.
     """
+    extensions = {}  # ESMTP extensions advertised by the server, in its EHLO reply
+    _tls_creator = None  # connection creator given by the TLSSessionCache, if STARTTLS is tried
+    data_sent = False  # True once the content of the current email started to be sent
+    pipelining_enabled = True
+    chunking_enabled = True
+    bdat_chunk_size = 64 * 1024
 
     #def _removeDeferred(self, argh):
         #del self.result
@@ -231,18 +247,211 @@ class RelayerMixin:
                                             
         n = self.factory.getNextEmail()
         if n:
-            fromEmail, toEmails, filename, deferred = n
-            if not os.path.exists(filename):
-                # content is removed from disk as soon as the mailing is closed
+            fromEmail, toEmails, message, deferred = n
+            if not message.is_available:
+                # content is released from spool as soon as the mailing is closed
                 raise smtp.SMTPClientError(471, "Sending aborted. Mailing stopped.")
             self.fromEmail = fromEmail
             self.toEmails = toEmails
-            self.mailFile = open(filename, 'rt')
+            self.data_sent = False
+            self.message = message
+            self.mailFile = message.open()
             self.result = deferred
             #WHY? self.result.addBoth(self._removeDeferred)
             return str(self.fromEmail)
         return None
 
+    def smtpState_from(self, code, resp):
+        if not self.factory.has_email_ready():
+            if self.factory.pending_emails > 0:
+                # next emails are still under customization: the connection stays open waiting for them
+                logging.getLogger("sendmail").debug("[%s] Waiting for customized emails", self.factory.targetDomain)
+                self.setTimeout(None)
+                self.factory.wait_for_email().addCallback(self._cb_email_ready, code, resp)
+                return
+            # If kept open by the connection pool, any unsolicited reply (like a timeout notification) closes it.
+            # Set before releasing, as the connection may be reused immediately by another factory.
+            self._expected = xrange(0, 1000)
+            self._okresponse = self.smtpState_disconnect
+            if self.factory.release_connection(self):
+                return
+        else:
+            delay = self.factory.get_send_delay(self)
+            if delay > 0:
+                # rate limited: the email is sent later, on the same connection
+                self.setTimeout(None)
+                self._rate_limit_call = reactor.callLater(delay, self._cb_email_ready, None, code, resp)
+                return
+        if self.use_pipelining():
+            self.pipelineState_from(code, resp)
+        else:
+            ESMTPClient.smtpState_from(self, code, resp)
+
+    def _cb_email_ready(self, ignored, code, resp):
+        self._rate_limit_call = None
+        self.setTimeout(self.timeout)
+        self.smtpState_from(code, resp)
+
+    def esmtpState_serverConfig(self, code, resp):
+        self.extensions = {}
+        for line in resp.splitlines()[1:]:  # first line is the server greeting
+            e = line.split(None, 1)
+            self.extensions[e[0].upper()] = len(e) > 1 and e[1] or None
+        cache = self.factory.tlsSessionCache
+        if self._tls_creator and self._tlsMode:
+            # EHLO sent again once the handshake is done
+            cache.handshake_done(self._tls_creator, self.transport.getHandle())
+        elif cache and not self._tlsMode and self.context is None and 'STARTTLS' in self.extensions:
+            self._tls_creator = self.context = cache.connection_creator(
+                self.transport.connector.getDestination().host)
+        ESMTPClient.esmtpState_serverConfig(self, code, resp)
+
+    def esmtpTLSFailed(self, code=-1, resp=None):
+        if self._tls_creator and not self.requireTransportSecurity:
+            logging.getLogger("sendmail").info("[%s] STARTTLS refused by '%s': %s. Going on in plain text.",
+                                               self.factory.targetDomain, self.transport.getPeer(), resp)
+            self.context = None
+            self.authenticate(code, resp, self.extensions)
+            return
+        ESMTPClient.esmtpTLSFailed(self, code, resp)
+
+    def use_pipelining(self):
+        return self.pipelining_enabled and 'PIPELINING' in self.extensions
+
+    def use_chunking(self):
+        return self.chunking_enabled and 'CHUNKING' in self.extensions
+
+    def pipelineState_from(self, code, resp):
+        """Sends all commands of the next email without waiting for replies."""
+        self._from = self.getMailFrom()
+        if self._from is None:
+            self._disconnectFromServer()
+            return
+        self.toAddressesResult = []
+        self.successAddresses = []
+        self._mail_reply = None
+        self._rcpt_reply = (-1, 'No recipients accepted')
+        self._bdat_error = None
+        self._replies_handlers = []
+        self._expected = xrange(0, 1000)
+        self._okresponse = self._pipelineReply
+
+        self._sendPipelined('MAIL FROM:%s' % quoteaddr(self._from), self._pipelineMailReply)
+        for address in self.getMailTo():
+            self._sendPipelined('RCPT TO:%s' % quoteaddr(address), self._pipelineRcptReply, address)
+        if self.use_chunking():
+            s = basic.FileSender()
+            d = s.beginFileTransfer(self.getMailData(), self.transport, self._transformBdatChunk)
+            d.addCallbacks(self._finishedBdatTransfer, lambda err: self.sendError(err.value))
+        else:
+            self._sendPipelined('DATA', self._pipelineDataReply)
+
+    def _sendPipelined(self, line, handler, *args):
+        self._replies_handlers.append((handler, args))
+        self.sendLine(line)
+
+    def _pipelineReply(self, code, resp):
+        if not self._replies_handlers:
+            # unsolicited reply, like a timeout notification
+            self.sendError(smtp.SMTPClientError(code, resp, self.log.str()))
+            return
+        handler, args = self._replies_handlers.pop(0)
+        return handler(code, resp, *args)
+
+    def _pipelineMailReply(self, code, resp):
+        self._mail_reply = (code, resp)
+
+    def _pipelineRcptReply(self, code, resp, address):
+        self._rcpt_reply = (code, resp)
+        self.toAddressesResult.append((address, code, resp))
+        if code in smtp.SUCCESS:
+            self.successAddresses.append(address)
+
+    def _pipelineTransactionError(self):
+        """Returns the (code, resp) making the transaction failing before data was sent, or None."""
+        if self._mail_reply[0] not in smtp.SUCCESS:
+            return self._mail_reply
+        if not self.successAddresses:
+            return self._rcpt_reply[0], 'No recipients accepted'
+        return None
+
+    def _pipelineDataReply(self, code, resp):
+        transaction_error = self._pipelineTransactionError()
+        if code == 354 and transaction_error:
+            # DATA accepted anyway: an empty message is sent to end it
+            self._replies_handlers.append((lambda c, r: self.smtpState_msgSent(*transaction_error), ()))
+            self.sendLine('.')
+        elif code == 354:
+            self.smtpState_data(code, resp)
+            self._expected = xrange(0, 1000)
+            self._okresponse = self._pipelineMsgSent
+        else:
+            self.smtpState_msgSent(*(transaction_error or (code, resp)))
+
+    def _transformBdatChunk(self, chunk):
+        self.resetTimeout()
+        chunk = chunk.replace('\n', '\r\n')
+        line = 'BDAT %d' % len(chunk)
+        if self.debug:
+            self.log.append('>>> ' + line)
+        self._replies_handlers.append((self._pipelineBdatReply, ()))
+        return line + '\r\n' + chunk
+
+    def _finishedBdatTransfer(self, lastsent):
+        self._sendPipelined('BDAT 0 LAST', self._pipelineBdatLastReply)
+
+    def _pipelineBdatReply(self, code, resp):
+        if code not in smtp.SUCCESS and not self._bdat_error:
+            self._bdat_error = (code, resp)
+
+    def _pipelineBdatLastReply(self, code, resp):
+        error = self._pipelineTransactionError() or self._bdat_error
+        if error:
+            self.smtpState_msgSent(*error)
+        else:
+            self._pipelineMsgSent(code, resp)
+
+    def _pipelineMsgSent(self, code, resp):
+        if code not in smtp.SUCCESS:
+            # RSET before next email
+            return self.smtpState_msgSent(code, resp)
+        self.sentMail(code, resp, len(self.successAddresses), self.toAddressesResult, self.log)
+        self.toAddressesResult = []
+        self._from = None
+        # successful transaction: next one can start without RSET
+        self.smtpState_from(code, resp)
+
+    def reuse(self, factory, fallback):
+        """
+        Takes this idle connection back from the pool to send the emails of another factory.
+
+        The connection is checked first with a RSET command. If it isn't usable anymore, `fallback` is called.
+        """
+        self._reuse_factory = factory
+        self._reuse_fallback = fallback
+        self.setTimeout(self.timeout)
+        self.sendLine('RSET')
+        self._expected = smtp.SUCCESS
+        self._okresponse = self._cb_reused
+        self._failresponse = self._eb_reused
+
+    def _cb_reused(self, code, resp):
+        factory = self._reuse_factory
+        self._reuse_factory = self._reuse_fallback = None
+        logging.getLogger("sendmail").debug("[%s] Reusing connection to '%s'",
+                                            factory.targetDomain, self.transport.getPeer())
+        self.factory = factory
+        factory.session_id = self.log.session_id
+        self.result = None
+        factory.doStart()
+        self.smtpState_from(code, resp)
+
+    def _eb_reused(self, code, resp):
+        fallback = self._reuse_fallback
+        self._reuse_factory = self._reuse_fallback = None
+        self._disconnectFromServer()
+        fallback()
+
     def getMailTo(self):
         """Return a list of emails to send to."""
         return self.toEmails
@@ -254,9 +463,10 @@ class RelayerMixin:
         """
         # Rewind the file in case part of it was read while attempting to
         # send the message.
-        if not os.path.exists(self.mailFile.name):
-            # content is removed from disk as soon as the mailing is closed
+        if not self.message.is_available:
+            # content is released from spool as soon as the mailing is closed
             raise smtp.SMTPClientError(471, "Sending aborted. Mailing stopped.")
+        self.data_sent = True
         self.mailFile.seek(0, 0)
         return self.mailFile
 
@@ -270,6 +480,7 @@ class RelayerMixin:
         @type exc: C{SMTPClientError}
         """
         logging.getLogger("sendmail").error("sendError: %s", exc)
+        self.log.failed = True
         if isinstance(exc, smtp.SMTPClientError) and not exc.isFatal:
             self._disconnectFromServer()
         else:
@@ -280,7 +491,7 @@ class RelayerMixin:
         if hasattr(self, 'mailFile') and self.mailFile:
             self.mailFile.close()
             self.mailFile = None
-        if hasattr(self, 'result'):
+        if getattr(self, 'result', None):
             self.result.errback(exc)
 
     def sentMail(self, code, resp, numOk, addresses, log):
@@ -301,6 +512,7 @@ class RelayerMixin:
         if hasattr(self, 'mailFile') and self.mailFile:
             self.mailFile.close()
             self.mailFile = None
+        self.sent_count = getattr(self, 'sent_count', 0) + 1
         # Do not retry, the SMTP server acknowledged the request
         if code not in smtp.SUCCESS:
             errlog = []
@@ -309,6 +521,7 @@ class RelayerMixin:
                     errlog.append("%s: %03d %s" % (str(addr), acode, aresp))
 
             errlog.append(log.str())
+            log.failed = True
             #print '\n'.join(errlog)
             log.clear()
             exc = smtp.SMTPDeliveryError(code, resp, '\n'.join(errlog), addresses)
@@ -325,10 +538,38 @@ class RelayerMixin:
             self.mailFile.close()
             self.mailFile = None
         ## end of SMTPClient
+        self.factory.requeue_interrupted_email(self.data_sent, self.log.str())
+        self.factory.stop_waiting()
+        if getattr(self, '_rate_limit_call', None):
+            self._rate_limit_call.cancel()
+            self._rate_limit_call = None
+        if self._tls_creator and self._tlsMode:
+            if self._tls_creator.handshake_done:
+                # with TLS 1.3, the resumable session is only known once the server sent its tickets
+                self._tls_creator.cache.store_session(self._tls_creator.host, self.transport.getHandle())
+            else:
+                self._tls_creator.cache.handshake_failed(self._tls_creator)
         # Disconnected after a QUIT command -> normal case
         logging.getLogger("sendmail").debug("[%s] Disconnected from '%s'",
                                             self.factory.targetDomain, self.transport.getPeer())
         self.factory._lastLogOnConnectionLost = self.log.str()
+        if not reason.check(error.ConnectionDone):
+            self.log.failed = True
+        if self.factory.transcriptCallback:
+            self.factory.transcriptCallback(self.log, self.transport.getPeer().host)
+        if getattr(self, 'pool', None):
+            self.pool.discard(self)
+        if getattr(self, 'disconnected', None):
+            self.disconnected.callback(None)
+        if getattr(self, '_reuse_fallback', None):
+            # lost while checking the connection taken from the pool
+            fallback, self._reuse_factory, self._reuse_fallback = self._reuse_fallback, None, None
+            fallback()
+        elif self.factory is not self.transport.connector.factory and not self.factory.released:
+            # connection reused by another factory than the one that opened it: the connector only notifies the
+            # first one
+            self.factory.clientConnectionLost(self.transport.connector, reason)
+            self.factory.doStop()
 
 class SMTPRelayer(RelayerMixin, ESMTPClient):
     """
@@ -353,7 +594,14 @@ class SMTPRelayerFactory(protocol.ClientFactory):
                  logger=None,
                  username=None, secret=None,
                  connectionClosedCallback=None,
-                 connectionFailureErrback=None):
+                 connectionFailureErrback=None,
+                 emailRequestedCallback=None,
+                 connectionPool=None,
+                 rateLimiter=None,
+                 tlsSessionCache=None,
+                 transcriptCallback=None,
+                 reconnections=0,
+                 reconnectCallback=None):
         """
         @param targetDomain: All emails handled by this factory will be 
         handled by a simple SMTP server: the one specified as MX record 
@@ -364,6 +612,25 @@ class SMTPRelayerFactory(protocol.ClientFactory):
 
         @param timeout: Period, in seconds, for which to wait for
         server responses, or None to wait forever.
+
+        @param emailRequestedCallback: called each time the connection takes the next email, allowing to
+        prepare the following ones.
+
+        @param connectionPool: if given, the L{SMTPConnectionPool} keeping the connection open once all emails are
+        sent.
+
+        @param rateLimiter: if given, the L{RateLimiter} giving the right to send each email, according to the
+        limits of the target domain and of the connected server.
+
+        @param tlsSessionCache: if given, the L{TLSSessionCache} used to encrypt sessions with STARTTLS when the
+        server supports it.
+
+        @param transcriptCallback: if given, called with the L{SessionTranscript} and the server address once each
+        connection is closed.
+
+        @param reconnections: The number of times the connection may be lost while emails are still to send. Each
+        time, `reconnectCallback` is called with the connector and the error, to open a new connection (maybe to
+        another server) sending the emails not yet attempted.
         """
         assert isinstance(retries, (int, long))
 
@@ -377,6 +644,16 @@ class SMTPRelayerFactory(protocol.ClientFactory):
         self._secret=secret
         self._connectionFailureErrback = connectionFailureErrback
         self._connectionClosedCallback = connectionClosedCallback
+        self._emailRequestedCallback = emailRequestedCallback
+        self._connectionPool = connectionPool
+        self._rateLimiter = rateLimiter
+        self.tlsSessionCache = tlsSessionCache
+        self.transcriptCallback = transcriptCallback
+        self.session_id = None  # id of the transcript of the current connection
+        self.released = False  # True once the connection is given back to the pool
+        self.reconnections = reconnections
+        self._reconnectCallback = reconnectCallback
+        self.reconnecting = False  # True while a new connection is opened to replace the lost one
         self._dateStarted = datetime.now()
         self._lastLogOnConnectionLost = ""    # Used to track message returned by server in case of early rejection (before EHLO)
 
@@ -384,6 +661,8 @@ class SMTPRelayerFactory(protocol.ClientFactory):
         self.timeout = timeout
         
         self.mails = []
+        self.pending_emails = 0  # emails announced by expect_emails() but not yet given
+        self._email_waiter = None
         self.last_email = None
         self.deferred = defer.Deferred()
         self.log = logger or logging.getLogger("sendmail")
@@ -400,6 +679,10 @@ class SMTPRelayerFactory(protocol.ClientFactory):
     def startDate(self):
         return self._dateStarted
     
+    def startFactory(self):
+        # started again by the connection replacing a lost one
+        self.reconnecting = False
+
     def startedConnecting(self, connector):
         """Called when a connection has been started.
 
@@ -416,6 +699,7 @@ class SMTPRelayerFactory(protocol.ClientFactory):
 
         @type reason: L{twisted.python.failure.Failure}
         """
+        self.reconnecting = False
         self.log.warn("[%s] SMTP Connection failed for '%s': %s", self.targetDomain, connector.getDestination(), str(err.value).decode(encoding='utf-8', errors='replace'))
         self._processConnectionError(connector, err)
 
@@ -426,12 +710,23 @@ class SMTPRelayerFactory(protocol.ClientFactory):
 
         @type reason: L{twisted.python.failure.Failure}
         """
-        if self.last_email == None and len(self.mails) == 0 and err.check(error.ConnectionDone):
+        if self.released:
+            # the connection now belongs to the pool
+            return
+        if self.last_email == None and len(self.mails) == 0 and self.pending_emails <= 0 \
+                and err.check(error.ConnectionDone):
             self.log.debug("[%s] SMTP Connection done for '%s'.", self.targetDomain, connector.getDestination())
             if self._connectionClosedCallback:
                 self._connectionClosedCallback(connector)
             return
         self.log.warn("[%s] SMTP Connection lost for '%s': %s", self.targetDomain, connector.getDestination(), err.value)
+        if self.reconnections > 0 and self._reconnectCallback and (self.mails or self.pending_emails > 0):
+            self.reconnections -= 1
+            self.reconnecting = True
+            self.log.info("[%s] Reconnecting to send %d remaining emails. Reconnections left: %d", self.targetDomain,
+                          len(self.mails) + self.pending_emails, self.reconnections)
+            self._reconnectCallback(connector, err)
+            return
         self._processConnectionError(connector, err)
 
     def _processConnectionError(self, connector, err):
@@ -454,17 +749,32 @@ class SMTPRelayerFactory(protocol.ClientFactory):
         directly.
         """
         self.log.debug("[%s] Stopping relay factory.", self.targetDomain)
-        if self.deferred:
-            if len(self.mails) > 0 or self.last_email:
-                self.deferred.errback(Failure(smtp.SMTPConnectError(-1, self._lastLogOnConnectionLost or "Connection closed prematurely.")))
+        if self.deferred and not self.reconnecting:
+            if len(self.mails) > 0 or self.last_email or self.pending_emails > 0:
+                err = Failure(smtp.SMTPConnectError(-1, self._lastLogOnConnectionLost or "Connection closed prematurely."))
+                self._fail_remaining_emails(err)
+                self.deferred.errback(err)
             else:
                 self.deferred.callback(self.targetDomain)
             self.deferred = None   # to avoid another call
         
+    def _fail_remaining_emails(self, err):
+        """Errbacks the deferreds of emails that won't be sent, so their senders can release them."""
+        emails, self.mails = self.mails, []
+        if self.last_email is not None:
+            emails.append(self.last_email)
+            self.last_email = None
+        for email in emails:
+            if not email[3].called:
+                email[3].errback(err)
+
     def buildProtocol(self, addr):
         self.log.debug("[%s] BuildProtocol for ip '%s'.", self.targetDomain, addr)
-        p = self.protocol(secret=self._secret, contextFactory=None, identity=self.domain, logsize=len(self.mails)*2+2)
+        self.reconnecting = False
+        p = self.protocol(secret=self._secret, contextFactory=None, identity=self.domain)
         p.debug = True  # to enable SMTP log
+        p.log = SessionTranscript()
+        self.session_id = p.log.session_id
         p.heloFallback = self._heloFallback
         p.requireAuthentication = self._requireAuthentication
         p.requireTransportSecurity = self._requireTransportSecurity
@@ -477,7 +787,7 @@ class SMTPRelayerFactory(protocol.ClientFactory):
             p.registerAuthenticator(smtp.PLAINAuthenticator(self._username))
         return p
 
-    def send_email(self, fromEmail, toEmails, fileName):
+    def send_email(self, fromEmail, toEmails, message):
         """
         @param fromEmail: The RFC 2821 address from which to send this
         message.
@@ -485,27 +795,365 @@ class SMTPRelayerFactory(protocol.ClientFactory):
         @param toEmails: A sequence of RFC 2821 addresses to which to
         send this message.
 
-        @param fileName: A full path to the file containing the message to send.
+        @param message: The message to send, as an object having an `open()` method returning a file-like
+        object and an `is_available` attribute (see L{spool.SpooledMessage}).
 
         @param deferred: A Deferred to callback or errback when sending
         of this message completes.
         """
         deferred = defer.Deferred()
         self.log.debug("Add %s into factory (%s)", ', '.join(toEmails), self.targetDomain)
-        self.mails.insert(0, (Address(fromEmail), map(Address, toEmails), fileName, deferred))
+        self.mails.insert(0, (Address(fromEmail), map(Address, toEmails), message, deferred))
+        if self.pending_emails > 0:
+            self.pending_emails -= 1
+        self._fire_email_waiter()
         return deferred
-    
+
+    def expect_emails(self, count):
+        """
+        Announces emails that will be given later by `send_email()` (or cancelled by `cancel_email()`).
+        Until then, the connection waits for them instead of being closed.
+        """
+        self.pending_emails += count
+
+    def cancel_email(self):
+        """An announced email won't be given, for example because its customization failed."""
+        if self.pending_emails > 0:
+            self.pending_emails -= 1
+        self._fire_email_waiter()
+
+    def has_email_ready(self):
+        return len(self.mails) > 0
+
+    def wait_for_email(self):
+        """Returns a deferred fired when an email is ready or when no more email is expected."""
+        if self.mails or self.pending_emails <= 0:
+            return defer.succeed(None)
+        self._email_waiter = defer.Deferred()
+        return self._email_waiter
+
+    def stop_waiting(self):
+        """Forgets the waiting connection, once it is lost."""
+        self._email_waiter = None
+
+    def _fire_email_waiter(self):
+        if self._email_waiter and (self.mails or self.pending_emails <= 0):
+            d, self._email_waiter = self._email_waiter, None
+            d.callback(None)
+
+    def release_connection(self, protocol):
+        """
+        Called by the protocol once all emails are sent, instead of closing the connection.
+
+        @return: True if the connection has been kept by the pool. In this case, the factory is stopped as if the
+        connection was closed.
+        """
+        if self._connectionPool is None or not self._connectionPool.release(protocol):
+            return False
+        connector = protocol.transport.connector
+        self.log.debug("[%s] SMTP Connection to '%s' released into the pool.", self.targetDomain,
+                       connector.getDestination())
+        self.released = True
+        self.last_email = None
+        if self._connectionClosedCallback:
+            self._connectionClosedCallback(connector)
+        self.doStop()
+        return True
+
+    def requeue_interrupted_email(self, data_sent, log):
+        """
+        Called when the connection is lost. If an email was being sent, it is put back in front of the emails to
+        send, unless its content was already sent: the server may have accepted it, so it fails with a temporary
+        error instead of being sent again at once.
+        """
+        email, self.last_email = self.last_email, None
+        if email is None or email[3].called:
+            return
+        if data_sent:
+            email[3].errback(Failure(smtp.SMTPClientError(None, "Connection lost after message content was sent",
+                                                          log)))
+        else:
+            self.log.debug("[%s] Email to %s interrupted before its content. Sending it again.", self.targetDomain,
+                           email[1])
+            self.mails.append(email)
+
+    def get_send_delay(self, protocol):
+        """Returns 0 if the next email can be sent now by the protocol, else the delay (in seconds) to wait for."""
+        if self._rateLimiter is None:
+            return 0
+        connector = protocol.transport.connector
+        bind_address = connector.bindAddress
+        # recipients of a factory may belong to several domains served by the same MX servers
+        return self._rateLimiter.acquire_message(self.mails[-1][1][0].domain.lower(),
+                                                 connector.getDestination().host,
+                                                 bind_address and bind_address[0] or None)
+
     def getNextEmail(self):
         try:
             self.last_email = self.mails.pop()
             self.log.debug("Factory (%s) return next email: %s", self.targetDomain, self.last_email[1])
-            return self.last_email
         except IndexError:
             self.log.debug("Factory (%s) return next email: EMPTY", self.targetDomain)
             self.last_email = None
             #self.deferred.callback(self.targetDomain) 
-            return None
+        if self._emailRequestedCallback:
+            self._emailRequestedCallback()
+        return self.last_email
 
     def get_recipients_count(self):
         return len(self.mails)
         
+
+
+class _GreetingProtocol(protocol.Protocol, policies.TimeoutMixin):
+    """Waits for the server greeting, then gives the connection to the relayer protocol if its attempt wins."""
+
+    def __init__(self, attempt, timeout):
+        self.attempt = attempt
+        self.timeout = timeout
+        self.buffer = ''
+        self.greeted = False
+
+    def connectionMade(self):
+        self.setTimeout(self.timeout)
+
+    def dataReceived(self, data):
+        self.buffer += data
+        if not self.greeted and '\n' in self.buffer:
+            self.greeted = True
+            self.setTimeout(None)
+            self.attempt.greeted(self, self.buffer.split('\n', 1)[0].strip())
+
+    def timeoutConnection(self):
+        self.attempt.failed(error.TimeoutError("No greeting from server after %d seconds" % self.timeout))
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.setTimeout(None)
+        self.attempt.failed(reason.value)
+
+    def hand_over(self, relayer):
+        """The relayer protocol takes this connection, starting with the already received greeting."""
+        transport = self.transport
+        transport.protocol = relayer
+        relayer.makeConnection(transport)
+        relayer.dataReceived(self.buffer)
+
+
+class _MXAttempt(protocol.ClientFactory):
+    """A connection attempt to a single MX server, made by a L{MXConnector}."""
+
+    def __init__(self, connector, address):
+        self.mx_connector = connector
+        self.address = address
+        self.state = 'connecting'  # then 'won', 'failed' or 'cancelled'
+        self.greeting_protocol = None
+        self.connector = None
+
+    def buildProtocol(self, addr):
+        self.greeting_protocol = _GreetingProtocol(self, self.mx_connector.factory.timeout)
+        return self.greeting_protocol
+
+    def greeted(self, greeting_protocol, line):
+        self.mx_connector._greeted(self, greeting_protocol, line)
+
+    def failed(self, err):
+        if self.state == 'connecting':
+            self.state = 'failed'
+            self.mx_connector._failed(self, err)
+
+    def cancel(self):
+        self.state = 'cancelled'
+        if self.greeting_protocol:
+            self.greeting_protocol.transport.loseConnection()
+        elif self.connector:
+            self.connector.stopConnecting()
+
+    def clientConnectionFailed(self, connector, err):
+        self.failed(err.value)
+
+    def clientConnectionLost(self, connector, err):
+        # once won, the connection lost is notified to the relayer factory by its protocol
+        self.failed(err.value)
+
+
+class MXConnector(object):
+    """
+    Connects a L{SMTPRelayerFactory} to the first of several MX servers greeting it.
+
+    Servers are tried in the given order. If a server doesn't greet within `hedge_delay` seconds, the next one is
+    tried too, without giving up the first one: the first one sending a 220 greeting wins, the other attempts are
+    closed. A server refusing the connection or the session makes the next one tried immediately.
+
+    If all servers fail, the factory is notified by its `clientConnectionFailed()` method, as for a single
+    connection. Factory retries are not supported.
+    """
+
+    def __init__(self, factory, addresses, port, hedge_delay=5, bind_address=None,
+                 mxConnectedCallback=None, mxFailedCallback=None):
+        """
+        @param factory: the L{SMTPRelayerFactory} taking the connection.
+        @param addresses: the MX servers, in the preference order.
+        @param hedge_delay: delay, in seconds, after which the next server is tried in parallel. 0 disables hedged
+        attempts: the next server is only tried once the previous one failed.
+        @param bind_address: if given, the (host, port) local address the connections are made from.
+        @param mxConnectedCallback: called with the address of the server that won.
+        @param mxFailedCallback: called with the address of each failing server, and the error.
+        """
+        self.factory = factory
+        self.addresses = list(addresses)
+        self.port = port
+        self.hedge_delay = hedge_delay
+        self.bind_address = bind_address
+        self._mxConnectedCallback = mxConnectedCallback
+        self._mxFailedCallback = mxFailedCallback
+        self.attempts = []
+        self.winner = None
+        self._hedge_call = None
+
+    def connect(self):
+        self._start_next_attempt()
+
+    def _start_next_attempt(self):
+        if self._hedge_call and self._hedge_call.active():
+            self._hedge_call.cancel()
+        self._hedge_call = None
+        address = self.addresses[len(self.attempts)]
+        attempt = _MXAttempt(self, address)
+        self.attempts.append(attempt)
+        attempt.connector = reactor.connectTCP(address, self.port, attempt, bindAddress=self.bind_address)
+        if self.hedge_delay > 0 and len(self.attempts) < len(self.addresses):
+            self._hedge_call = reactor.callLater(self.hedge_delay, self._hedge)
+
+    def _hedge(self):
+        self._hedge_call = None
+        self.factory.log.info("[%s] No greeting from '%s' after %ss. Trying next MX...", self.factory.targetDomain,
+                              self.attempts[-1].address, self.hedge_delay)
+        self._start_next_attempt()
+
+    def _greeted(self, attempt, greeting_protocol, line):
+        if attempt.state != 'connecting':
+            return
+        if not line.startswith('220'):
+            self.factory._lastLogOnConnectionLost = line
+            attempt.failed(smtp.SMTPConnectError(int(line[:3]) if line[:3].isdigit() else -1, line))
+            greeting_protocol.transport.loseConnection()
+            return
+        attempt.state = 'won'
+        self.winner = attempt
+        if self._hedge_call and self._hedge_call.active():
+            self._hedge_call.cancel()
+        self._hedge_call = None
+        for other in self.attempts:
+            if other.state == 'connecting':
+                other.cancel()
+        self.factory.log.debug("[%s] SMTP server '%s' greeted first.", self.factory.targetDomain, attempt.address)
+        if self._mxConnectedCallback:
+            self._mxConnectedCallback(attempt.address)
+        self.factory.doStart()
+        greeting_protocol.hand_over(self.factory.buildProtocol(greeting_protocol.transport.getPeer()))
+
+    def _failed(self, attempt, err):
+        self.factory.log.warn("[%s] SMTP connection to '%s' failed: %s", self.factory.targetDomain, attempt.address,
+                              str(err).decode('utf-8', 'replace'))
+        if self._mxFailedCallback:
+            self._mxFailedCallback(attempt.address, err)
+        if len(self.attempts) < len(self.addresses):
+            self._start_next_attempt()
+        elif not [other for other in self.attempts if other.state == 'connecting']:
+            # all servers failed
+            self.factory.doStart()
+            self.factory.clientConnectionFailed(attempt.connector, Failure(err))
+            self.factory.doStop()
+
+
+class SMTPConnectionPool(object):
+    """
+    Keeps idle SMTP connections open, to give them to the next factory sending emails to the same server.
+
+    Connections are identified by the server IP and port, and the source IP used to connect it.
+    """
+
+    def __init__(self, max_idle_time=60, max_messages=1000, logger=None):
+        """
+        @param max_idle_time: delay, in seconds, after which an idle connection is closed.
+        @param max_messages: count of emails after which a connection isn't kept anymore.
+        """
+        self.max_idle_time = max_idle_time
+        self.max_messages = max_messages
+        self.log = logger or logging.getLogger("sendmail")
+        self._idle = {}  # key = (ip, port, source_ip), value = list of idle protocols
+
+    def __len__(self):
+        return sum(map(len, self._idle.values()))
+
+    @staticmethod
+    def make_key(ip, port, source_ip=None):
+        return ip, port, source_ip
+
+    def connect(self, factory, ip, port, source_ip=None, fallback=None):
+        """
+        Gives an idle connection to the factory, or opens a new one.
+
+        @param fallback: if given, called to open the new connection (for example L{MXConnector.connect}).
+        """
+        protocol = self._acquire(self.make_key(ip, port, source_ip))
+        if protocol:
+            protocol.reuse(factory, lambda: self.connect(factory, ip, port, source_ip, fallback))
+        elif fallback:
+            fallback()
+        else:
+            bind_address = source_ip and (source_ip, 0) or None
+            reactor.connectTCP(ip, port, factory, bindAddress=bind_address)
+
+    def release(self, protocol):
+        """Keeps the connection, unless it already sent too much emails. Returns True if kept."""
+        if getattr(protocol, 'sent_count', 0) >= self.max_messages:
+            return False
+        # the connector destination is the address given to connect(), maybe a host name
+        connector = protocol.transport.connector
+        destination = connector.getDestination()
+        bind_address = connector.bindAddress
+        key = self.make_key(destination.host, destination.port, bind_address and bind_address[0] or None)
+        protocol.setTimeout(None)
+        protocol.pool = self
+        protocol.pool_key = key
+        protocol.pool_expiration = reactor.callLater(self.max_idle_time, self._expire, protocol)
+        self._idle.setdefault(key, []).append(protocol)
+        return True
+
+    def discard(self, protocol):
+        """Forgets a connection, for example because it has been closed by the server."""
+        idle = self._idle.get(protocol.pool_key, [])
+        if protocol in idle:
+            idle.remove(protocol)
+            if not idle:
+                del self._idle[protocol.pool_key]
+        if protocol.pool_expiration.active():
+            protocol.pool_expiration.cancel()
+        protocol.pool = None
+
+    def close(self):
+        """Closes all idle connections. Returns a deferred fired once they are all closed."""
+        disconnections = []
+        for protocols in self._idle.values():
+            for protocol in list(protocols):
+                disconnections.append(self._expire(protocol))
+        return defer.DeferredList(disconnections)
+
+    def _acquire(self, key):
+        idle = self._idle.get(key)
+        if not idle:
+            return None
+        # the most recently used connection is the less likely to have been closed by the server
+        protocol = idle[-1]
+        self.discard(protocol)
+        return protocol
+
+    def _expire(self, protocol):
+        self.log.debug("Closing idle SMTP connection to '%s'", protocol.transport.getPeer())
+        self.discard(protocol)
+        protocol.disconnected = defer.Deferred()
+        protocol.setTimeout(protocol.timeout)
+        protocol._disconnectFromServer()
+        return protocol.disconnected
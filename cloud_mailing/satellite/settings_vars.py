@@ -28,12 +28,31 @@ MAILING_QUEUE_MAX_THREAD = 'max_mailing_thread'
 MAILING_QUEUE_MAX_THREAD_SIZE = 'mailing_queue_max_thread_size'
 MAILING_MAX_REPORTS = 'mailing_max_reports'
 MAILING_MAX_NEW_RECIPIENTS = 'mailing_max_new_recipients'
-# DEFAULT_CNX_PER_MX = 'default_connection_per_mx'
-# DEFAULT_MAX_MX = 'default_max_mx'
+DEFAULT_CNX_PER_MX = 'default_connection_per_mx'
+DEFAULT_MAX_MX = 'default_max_mx'
 DEFAULT_MAX_QUEUE_PER_DOMAIN = 'default_max_queue_per_domain'
+DEFAULT_MAX_MESSAGES_PER_SECOND = 'default_max_messages_per_second'
+DEFAULT_MAX_CONNECTIONS_PER_MINUTE = 'default_max_connections_per_minute'
 ZOMBIE_QUEUE_CHECKING = 'zombie_queue_checking'
 ZOMBIE_QUEUE_AGE_IN_SECONDS = 'zombie_queue_age_in_seconds'
 MAILING_QUEUE_ENDING_DELAY = 'mailing_queue_ending_delay'
+CUSTOMIZER_PROCESSES = 'customizer_processes'
+CUSTOMIZER_TIMEOUT = 'customizer_timeout'
+SPOOL_MAX_MEMORY = 'spool_max_memory'
+CUSTOMIZATION_LOOKAHEAD = 'customization_lookahead'
+SMTP_SESSION_MAX_IDLE_TIME = 'smtp_session_max_idle_time'
+SMTP_SESSION_MAX_MESSAGES = 'smtp_session_max_messages'
+MX_HEDGE_DELAY = 'mx_hedge_delay'
+DNS_NEGATIVE_CACHE_TTL = 'dns_negative_cache_ttl'
+DNS_PREFETCH_DELAY = 'dns_prefetch_delay'
+ADAPTIVE_CONCURRENCY = 'adaptive_concurrency'
+GROUP_DOMAINS_BY_MX = 'group_domains_by_mx'
+MAX_MESSAGES_PER_SECOND_PER_IP = 'max_messages_per_second_per_ip'
+MAX_CONNECTIONS_PER_MINUTE_PER_IP = 'max_connections_per_minute_per_ip'
+SMTP_STARTTLS = 'smtp_starttls'
+TLS_SESSION_MAX_AGE = 'tls_session_max_age'
+SMTP_TRANSCRIPTS = 'smtp_transcripts'
+SMTP_RECONNECTIONS = 'smtp_reconnections'
 
 default = {
     EHLO_STRING: 'mail.cloudmailing.net',
@@ -44,12 +63,31 @@ default = {
     MAILING_QUEUE_MAX_THREAD_SIZE: 50,
     MAILING_MAX_REPORTS: 1000,
     MAILING_MAX_NEW_RECIPIENTS: 100,
-    # DEFAULT_CNX_PER_MX: 1
-    # DEFAULT_MAX_MX: 2
+    DEFAULT_CNX_PER_MX: 1,  # used for domains without 'cnx_per_mx' configuration
+    DEFAULT_MAX_MX: 2,  # used for domains without 'max_mx' configuration
     DEFAULT_MAX_QUEUE_PER_DOMAIN: 1,  #2
+    DEFAULT_MAX_MESSAGES_PER_SECOND: 0,  # per domain, for domains without configured rate. 0 = no limit
+    DEFAULT_MAX_CONNECTIONS_PER_MINUTE: 0,  # per domain, for domains without configured rate. 0 = no limit
     ZOMBIE_QUEUE_CHECKING: True,
     ZOMBIE_QUEUE_AGE_IN_SECONDS: 3600,
     MAILING_QUEUE_ENDING_DELAY: 0,
+    CUSTOMIZER_PROCESSES: 0,  # 0 = customization made by reactor's threads. Read at startup only.
+    CUSTOMIZER_TIMEOUT: 120,  # in seconds. Longer customizations (e.g. killed worker) fail. Read at startup only.
+    SPOOL_MAX_MEMORY: 100 * 1024 * 1024,  # in bytes. Customized emails are written on disk beyond. Read at startup only.
+    CUSTOMIZATION_LOOKAHEAD: 5,  # max count of customized emails waiting for the SMTP connection, per queue
+    SMTP_SESSION_MAX_IDLE_TIME: 30,  # in seconds. 0 = SMTP connections are closed once queue is sent. Read at startup only.
+    SMTP_SESSION_MAX_MESSAGES: 1000,  # max count of emails sent through an SMTP connection before closing it
+    MX_HEDGE_DELAY: 5,  # in seconds. Next MX is tried in parallel if the first one doesn't greet within this delay. 0 = disabled
+    DNS_NEGATIVE_CACHE_TTL: 300,  # in seconds. Unknown domains or domains without MX are kept in DNS cache during this delay, unless their SOA says otherwise
+    DNS_PREFETCH_DELAY: 60,  # in seconds. Period of DNS prefetching for domains waiting in queue. 0 = disabled. Read at startup only.
+    ADAPTIVE_CONCURRENCY: True,  # queues count and size per domain are learned, unless set by its configuration. Read at startup only.
+    GROUP_DOMAINS_BY_MX: True,  # small queues of domains having the same MX servers are sent through the same connection
+    MAX_MESSAGES_PER_SECOND_PER_IP: 0,  # for each source IP. 0 means no limit
+    MAX_CONNECTIONS_PER_MINUTE_PER_IP: 0,  # for each source IP. 0 means no limit
+    SMTP_STARTTLS: True,  # sessions are encrypted when the server supports it. Read at startup only.
+    TLS_SESSION_MAX_AGE: 3600,  # in seconds. TLS sessions are resumed until this age. Read at startup only.
+    SMTP_TRANSCRIPTS: 'failures',  # SMTP sessions transcripts to store: 'all', 'failures' or 'none'
+    SMTP_RECONNECTIONS: 2,  # new connections a queue may open when its connection is lost before all emails are sent
 }
 
 # Helpers
@@ -0,0 +1,65 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import Counter
+
+__author__ = 'ricard'
+
+
+class SourceIPPool(object):
+    """
+    Local addresses used as source of outgoing connections, so the sending load is spread over several IPs.
+
+    A new connection uses the least loaded address: the one having the fewest connections to the target domain,
+    then the fewest connections at all, then the fewest sent messages.
+    """
+
+    def __init__(self, addresses):
+        self.addresses = list(addresses)
+        self.connections = Counter()  # key = source IP, value = count of open connections
+        self.domain_connections = Counter()  # key = (source IP, domain)
+        self.sent = Counter()  # key = source IP, value = count of sent messages
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def select(self, domain):
+        """Returns the least loaded address for a new connection to the domain (without counting it)."""
+        return min(self.addresses, key=lambda ip: (self.domain_connections[(ip, domain)],
+                                                   self.connections[ip],
+                                                   self.sent[ip]))
+
+    def acquire(self, ip, domain):
+        self.connections[ip] += 1
+        self.domain_connections[(ip, domain)] += 1
+
+    def release(self, ip, domain):
+        self._decrement(self.connections, ip)
+        self._decrement(self.domain_connections, (ip, domain))
+
+    @staticmethod
+    def _decrement(counter, key):
+        counter[key] -= 1
+        if counter[key] <= 0:
+            del counter[key]
+
+    def add_sent(self, ip):
+        self.sent[ip] += 1
+
+    def as_list(self):
+        """Returns the state of each address, as dicts with 'ip', 'connections' and 'sent' keys."""
+        return [{'ip': ip, 'connections': self.connections[ip], 'sent': self.sent[ip]} for ip in self.addresses]
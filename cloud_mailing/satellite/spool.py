@@ -0,0 +1,199 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import glob
+import logging
+import os
+import threading
+
+from .mail_customizer import MailCustomizer
+
+__author__ = 'ricard'
+
+
+class SegmentsFile(object):
+    """Read-only file-like object over a list of strings, avoiding to join them."""
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.seek(0)
+
+    def seek(self, offset, whence=0):
+        assert(whence == 0)
+        self._index = 0
+        self._offset = offset
+        while self._index < len(self.segments) and self._offset >= len(self.segments[self._index]):
+            self._offset -= len(self.segments[self._index])
+            self._index += 1
+
+    def read(self, size=-1):
+        chunks = []
+        while self._index < len(self.segments) and size != 0:
+            segment = self.segments[self._index]
+            if size < 0 or len(segment) - self._offset <= size:
+                chunk = segment[self._offset:] if self._offset else segment
+                self._index += 1
+                self._offset = 0
+            else:
+                chunk = segment[self._offset:self._offset + size]
+                self._offset += size
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        pass
+
+
+class SpooledMessage(object):
+    """A customized email kept by the L{MessageSpool}, in memory (as a list of strings) or on disk."""
+
+    def __init__(self, mailing_id, recipient_id, size, segments=None, path=None):
+        self.mailing_id = mailing_id
+        self.recipient_id = recipient_id
+        self.size = size
+        self.segments = segments
+        self.path = path
+        self.released = False
+
+    @property
+    def key(self):
+        return self.mailing_id, self.recipient_id
+
+    @property
+    def is_available(self):
+        """False once released, for example because its mailing has been closed."""
+        return not self.released
+
+    @property
+    def in_memory(self):
+        return self.path is None
+
+    def open(self):
+        """Returns a file-like object containing the email."""
+        if self.released:
+            raise IOError(errno.ENOENT, "Customized email released", self.path)
+        if self.path:
+            return open(self.path, 'rt')
+        return SegmentsFile(self.segments)
+
+
+class MessageSpool(object):
+    """
+    Keeps customized emails until they are sent.
+
+    Emails are kept in memory as long as the total size stays under `max_memory` bytes. Beyond, they are
+    written into `temp_path` folder.
+    """
+
+    def __init__(self, temp_path, max_memory):
+        self.log = logging.getLogger("spool")
+        self.temp_path = temp_path
+        self.max_memory = max_memory
+        self.memory_size = 0
+        self._messages = {}  # key = (mailing_id, recipient_id), value = SpooledMessage
+        self._lock = threading.Lock()
+        if not os.path.exists(temp_path):
+            os.makedirs(temp_path)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def get(self, mailing_id, recipient_id):
+        """Returns the already spooled email for this recipient, or None."""
+        return self._messages.get((mailing_id, str(recipient_id)))
+
+    def store(self, mailing_id, recipient_id, segments, on_disk=False):
+        """
+        Adds a customized email into the spool.
+
+        @param segments: the email as a list of strings.
+        @param on_disk: forces the email to be written on disk.
+        @return: the L{SpooledMessage}
+        """
+        recipient_id = str(recipient_id)
+        previous = self.get(mailing_id, recipient_id)
+        if previous:
+            self.release(previous)
+        size = sum(map(len, segments))
+        with self._lock:
+            if not on_disk and self.memory_size + size <= self.max_memory:
+                message = SpooledMessage(mailing_id, recipient_id, size, segments=segments)
+                self.memory_size += size
+                self._messages[message.key] = message
+                return message
+
+        fullpath = os.path.join(self.temp_path, MailCustomizer.make_file_name(mailing_id, recipient_id))
+        with open(fullpath + '.tmp', 'wt') as fp:
+            fp.writelines(segments)
+        os.rename(fullpath + '.tmp', fullpath)
+        message = SpooledMessage(mailing_id, recipient_id, size, path=fullpath)
+        with self._lock:
+            self._messages[message.key] = message
+        return message
+
+    def release(self, message, backup_folder=None):
+        """
+        Removes the email from the spool.
+
+        @param backup_folder: if given, the email is saved into this folder before.
+        """
+        with self._lock:
+            if self._messages.get(message.key) is message:
+                del self._messages[message.key]
+            if message.released:
+                return
+            message.released = True
+            if message.in_memory:
+                self.memory_size -= message.size
+        try:
+            if backup_folder:
+                backup_path = os.path.join(backup_folder, os.path.basename(
+                    MailCustomizer.make_file_name(message.mailing_id, message.recipient_id)))
+                self.log.debug("Moving customized content to '%s'", backup_path)
+                if message.in_memory:
+                    with open(backup_path, 'wt') as fp:
+                        fp.writelines(message.segments)
+                else:
+                    os.rename(message.path, backup_path)
+            elif not message.in_memory and os.path.exists(message.path):
+                os.remove(message.path)
+        except Exception:
+            self.log.exception("Can't release customized content for recipient [%s]", message.recipient_id)
+        message.segments = None
+
+    def release_mailing(self, mailing_id):
+        """Removes all emails of a mailing."""
+        for message in [m for m in self._messages.values() if m.mailing_id == mailing_id]:
+            self.release(message)
+        self._remove_files(MailCustomizer.make_patten_for_queue(mailing_id))
+
+    def clear(self):
+        """Removes all emails, including files left by a previous run."""
+        for message in self._messages.values():
+            self.release(message)
+        self._remove_files("cust_ml_*.rfc822*")
+
+    def _remove_files(self, pattern):
+        for entry in glob.glob(os.path.join(self.temp_path, pattern)):
+            #noinspection PyBroadException
+            try:
+                os.remove(entry)
+            except Exception:
+                self.log.exception("Can't remove customized file '%s'", entry)
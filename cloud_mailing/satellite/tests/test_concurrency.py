@@ -0,0 +1,91 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from ..concurrency import ConcurrencyController
+
+__author__ = 'ricard'
+
+
+class ConcurrencyControllerTestCase(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.controller = ConcurrencyController(initial_queues=1, queues_increase=1, messages_increase=10,
+                                                decrease_interval=60, clock=self.clock)
+
+    def test_initial_limits(self):
+        self.assertEqual((1, 50), self.controller.get_limits('example.org', 4, 50))
+
+    def test_additive_increase(self):
+        self.controller.get_limits('example.org', 4, 20)
+        self.controller.get_limits('example.org', 4, 10)
+        for i in range(9):
+            self.controller.on_success('example.org')
+        self.assertEqual((1, 10), self.controller.get_limits('example.org', 4, 20))
+        self.controller.on_success('example.org')
+        self.assertEqual((2, 20), self.controller.get_limits('example.org', 4, 20))
+        for i in range(40):
+            self.controller.on_success('example.org')
+        # bounded by the given limits
+        self.assertEqual((3, 20), self.controller.get_limits('example.org', 4, 20))
+        self.assertEqual((2, 15), self.controller.get_limits('example.org', 2, 15))
+
+    def test_multiplicative_decrease(self):
+        self.controller.get_limits('example.org', 8, 100)
+        self.controller.on_success('other.org')  # unknown domains are ignored
+        for i in range(100 + 2 * 100 + 3 * 100):
+            self.controller.on_success('example.org')
+        self.assertEqual((4, 100), self.controller.get_limits('example.org', 8, 100))
+        self.controller.on_congestion('example.org', "421 Too many connections")
+        self.assertEqual((2, 50), self.controller.get_limits('example.org', 8, 100))
+
+    def test_burst_of_congestion_signals(self):
+        self.controller.get_limits('example.org', 8, 100)
+        self.controller.on_congestion('example.org', "timeout")
+        self.controller.on_congestion('example.org', "timeout")
+        self.assertEqual((1, 50), self.controller.get_limits('example.org', 8, 100))
+        self.clock.advance(60)
+        self.controller.on_congestion('example.org', "timeout")
+        self.assertEqual((1, 25), self.controller.get_limits('example.org', 8, 100))
+
+    def test_deferrals(self):
+        controller = ConcurrencyController(decrease_interval=0, deferrals_threshold=3, deferrals_window=60,
+                                           clock=self.clock)
+        controller.get_limits('example.org', 8, 100)
+        for i in range(2):
+            controller.on_deferral('example.org', "450 Greylisted")
+            self.clock.advance(40)
+        # the first deferral is out of the window
+        controller.on_deferral('example.org', "452 Mailbox full")
+        self.assertEqual((1, 100), controller.get_limits('example.org', 8, 100))
+        controller.on_deferral('example.org', "450 Greylisted")
+        self.assertEqual((1, 50), controller.get_limits('example.org', 8, 100))
+        # counted again from zero after a cut
+        controller.on_deferral('example.org', "450 Greylisted")
+        controller.on_deferral('example.org', "450 Greylisted")
+        self.assertEqual((1, 50), controller.get_limits('example.org', 8, 100))
+
+    def test_lower_limits(self):
+        controller = ConcurrencyController(min_messages=5, decrease_interval=0, clock=self.clock)
+        controller.get_limits('example.org', 8, 10)
+        for i in range(5):
+            controller.on_congestion('example.org', "timeout")
+        self.assertEqual((1, 5), controller.get_limits('example.org', 8, 10))
+        self.assertEqual([{'domain_name': 'example.org', 'queues': 1, 'messages_per_queue': 5}],
+                         controller.as_list())
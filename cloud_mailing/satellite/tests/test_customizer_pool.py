@@ -0,0 +1,97 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import cPickle
+import email.message
+import email.parser
+import multiprocessing
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+import factories
+from ..customizer_pool import CustomizerPool
+from ...common.unittest_mixins import DatabaseMixin
+
+__author__ = 'ricard'
+
+
+class CustomizerPoolTestCase(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+        self.pool = CustomizerPool(2, poll_interval=0.1)
+
+    def tearDown(self):
+        self.pool.close()
+        return self.disconnect_from_db()
+
+    @defer.inlineCallbacks
+    def test_customize(self):
+        mailing = factories.MailingFactory()
+        recipient = factories.RecipientFactory(mailing=mailing)
+
+        message_id, segments = yield self.pool.customize(recipient, mailing)
+
+        message = email.parser.Parser().parsestr(''.join(segments))
+        assert(isinstance(message, email.message.Message))
+        self.assertEquals(message_id, message['Message-ID'])
+        self.assertEquals('This is a very simple mailing.', message.get_payload())
+
+    @defer.inlineCallbacks
+    def test_mailing_content_is_not_sent_for_each_recipient(self):
+        mailing = factories.MailingFactory(body='Hello {{ email }}.' + ' ' * 100000)
+        # with a single worker, the content is sent to it only once
+        pool = CustomizerPool(1, poll_interval=0.1)
+        self.addCleanup(pool.close)
+        payloads = []
+        apply_async = pool._pool.apply_async
+
+        def _apply_async(func, args, **kwargs):
+            payloads.append(len(cPickle.dumps(args, cPickle.HIGHEST_PROTOCOL)))
+            return apply_async(func, args, **kwargs)
+
+        pool._pool.apply_async = _apply_async
+        for i in range(10):
+            email = 'rcpt%d@example.org' % i
+            recipient = factories.RecipientFactory(mailing=mailing, email=email, contact_data={'email': email})
+            message_id, segments = yield pool.customize(recipient, mailing)
+            self.assertIn('Hello rcpt%d@example.org.' % i, ''.join(segments))
+
+        self.assertEqual(10, len([size for size in payloads if size < 10000]))
+        self.assertEqual(1, len([size for size in payloads if size > 100000]))
+
+    def test_customization_error(self):
+        mailing = factories.MailingFactory(body='This is a {{ broken mailing.')
+        recipient = factories.RecipientFactory(mailing=mailing)
+
+        return self.assertFailure(self.pool.customize(recipient, mailing), Exception)
+
+    def test_pickling_error(self):
+        mailing = factories.MailingFactory()
+
+        return self.assertFailure(self.pool.customize(lambda: None, mailing), cPickle.PicklingError)
+
+    def test_lost_result(self):
+        class LostResult(object):
+            # as the result of a killed worker
+            def ready(self):
+                return False
+
+        d = defer.Deferred()
+        self.pool._pending.append((LostResult(), d, 0, None, None))
+        self.pool._check_results()
+        return self.assertFailure(d, multiprocessing.TimeoutError)
@@ -0,0 +1,59 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import hashlib
+
+from dkim.canonicalization import Relaxed, Simple
+from twisted.trial.unittest import TestCase
+
+from ..dkim_signer import BodyHasher
+
+__author__ = 'ricard'
+
+
+class BodyHasherTestCase(TestCase):
+    bodies = [
+        '',
+        '\n',
+        '\n\n\n',
+        'Hello',
+        'Hello\n',
+        'Hello  world \t\nSecond\tline  \n\n\n',
+        'First\r\n\r\n\r\nAfter  empty lines\r\n \r\n\r\n',
+        'No\nend\n\nof line   ',
+    ]
+
+    def _expected(self, body, canonicalization):
+        canonicalized = canonicalization.canonicalize_body(body.replace('\r\n', '\n').replace('\n', '\r\n'))
+        return base64.b64encode(hashlib.sha256(canonicalized).digest()), len(canonicalized)
+
+    def _hash(self, body, relaxed, chunk_size):
+        hasher = BodyHasher(hashlib.sha256, relaxed=relaxed)
+        for i in range(0, len(body), chunk_size):
+            hasher.update(body[i:i + chunk_size])
+        return hasher.result()
+
+    def test_simple(self):
+        for body in self.bodies:
+            for chunk_size in (1, 3, 1000):
+                self.assertEqual(self._expected(body, Simple), self._hash(body, False, chunk_size), repr(body))
+
+    def test_relaxed(self):
+        for body in self.bodies:
+            for chunk_size in (1, 3, 1000):
+                self.assertEqual(self._expected(body, Relaxed), self._hash(body, True, chunk_size), repr(body))
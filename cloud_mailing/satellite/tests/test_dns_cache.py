@@ -0,0 +1,143 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import defer, task
+from twisted.names import dns
+from twisted.names.error import DNSNameError, DNSServerError
+from twisted.trial.unittest import TestCase
+
+from ..dns_cache import DnsCache
+
+__author__ = 'ricard'
+
+
+class DummyResolver(object):
+    def __init__(self):
+        self.queries = []
+        self.answers = {}  # key = (name, type), value = answer tuple or exception class
+        self.waiting = None
+
+    def _lookup(self, name, query_type):
+        self.queries.append((name, query_type))
+        if self.waiting is not None:
+            d = defer.Deferred()
+            self.waiting.append(d)
+            return d
+        answer = self.answers.get((name, query_type), DNSNameError)
+        if isinstance(answer, tuple):
+            return defer.succeed(answer)
+        return defer.fail(answer(name))
+
+    def lookupMailExchange(self, name, timeout=None):
+        return self._lookup(name, dns.MX)
+
+    def lookupAddress(self, name, timeout=None):
+        return self._lookup(name, dns.A)
+
+
+def mx_answer(name, ttl, *hosts):
+    return [dns.RRHeader(name, dns.MX, dns.IN, ttl, dns.Record_MX(10, host)) for host in hosts], [], []
+
+
+def a_answer(name, ttl, ip):
+    return [dns.RRHeader(name, dns.A, dns.IN, ttl, dns.Record_A(ip))], [], []
+
+
+class DnsCacheTestCase(TestCase):
+    def setUp(self):
+        self.resolver = DummyResolver()
+        self.clock = task.Clock()
+        self.cache = DnsCache(self.resolver, clock=self.clock, negative_ttl=60, path=self.mktemp())
+        self.resolver.answers[('example.org', dns.MX)] = mx_answer('example.org', 300, 'mx1.example.org')
+        self.resolver.answers[('mx1.example.org', dns.A)] = a_answer('mx1.example.org', 100, '10.0.0.1')
+
+    def test_ttl(self):
+        answer = self.successResultOf(self.cache.lookupMailExchange('example.org'))
+        self.assertEqual('mx1.example.org', str(answer[0][0].payload.name))
+        self.clock.advance(299)
+        self.successResultOf(self.cache.lookupMailExchange('Example.org'))
+        self.assertEqual(1, len(self.resolver.queries))
+        self.clock.advance(1)
+        self.successResultOf(self.cache.lookupMailExchange('example.org'))
+        self.assertEqual(2, len(self.resolver.queries))
+
+    def test_negative_caching(self):
+        self.failureResultOf(self.cache.lookupMailExchange('unknown.org'), DNSNameError)
+        self.failureResultOf(self.cache.lookupMailExchange('unknown.org'), DNSNameError)
+        self.assertEqual(1, len(self.resolver.queries))
+        self.clock.advance(60)
+        self.failureResultOf(self.cache.lookupMailExchange('unknown.org'), DNSNameError)
+        self.assertEqual(2, len(self.resolver.queries))
+
+    def test_negative_ttl_from_soa(self):
+        soa = dns.RRHeader('nomx.org', dns.SOA, dns.IN, 3600, dns.Record_SOA(minimum=10))
+        self.resolver.answers[('nomx.org', dns.MX)] = ([], [soa], [])
+        self.successResultOf(self.cache.lookupMailExchange('nomx.org'))
+        self.clock.advance(10)
+        self.successResultOf(self.cache.lookupMailExchange('nomx.org'))
+        self.assertEqual(2, len(self.resolver.queries))
+
+    def test_server_errors_are_not_cached(self):
+        self.resolver.answers[('broken.org', dns.MX)] = DNSServerError
+        self.failureResultOf(self.cache.lookupMailExchange('broken.org'), DNSServerError)
+        self.failureResultOf(self.cache.lookupMailExchange('broken.org'), DNSServerError)
+        self.assertEqual(2, len(self.resolver.queries))
+
+    def test_simultaneous_lookups(self):
+        self.resolver.waiting = []
+        d1 = self.cache.lookupMailExchange('example.org')
+        d2 = self.cache.lookupMailExchange('example.org')
+        self.assertEqual(1, len(self.resolver.queries))
+        self.resolver.waiting[0].callback(mx_answer('example.org', 300, 'mx1.example.org'))
+        self.assertIdentical(self.successResultOf(d1), self.successResultOf(d2))
+
+    def test_cached_mx_names(self):
+        self.resolver.answers[('example.org', dns.MX)] = mx_answer('example.org', 300, 'MX2.example.org',
+                                                                   'mx1.example.org')
+        self.assertEqual(None, self.cache.cached_mx_names('example.org'))
+        self.successResultOf(self.cache.lookupMailExchange('example.org'))
+        self.assertEqual(('mx1.example.org', 'mx2.example.org'), self.cache.cached_mx_names('example.org'))
+        self.clock.advance(300)
+        self.assertEqual(None, self.cache.cached_mx_names('example.org'))
+
+    def test_get_host_by_name(self):
+        self.assertEqual('10.0.0.1', self.successResultOf(self.cache.getHostByName('mx1.example.org')))
+        self.assertEqual('10.0.0.2', self.successResultOf(self.cache.getHostByName('10.0.0.2')))
+        self.assertEqual(1, len(self.resolver.queries))
+
+    def test_prefetch(self):
+        self.successResultOf(self.cache.prefetch(['example.org', 'unknown.org']))
+        self.assertEqual([('example.org', dns.MX), ('mx1.example.org', dns.A), ('unknown.org', dns.MX)],
+                         self.resolver.queries)
+        # answers expiring within the margin are refreshed
+        self.clock.advance(50)
+        self.successResultOf(self.cache.prefetch(['example.org'], margin=60))
+        self.assertEqual(('mx1.example.org', dns.A), self.resolver.queries[-1])
+        self.assertEqual(4, len(self.resolver.queries))
+
+    def test_persistence(self):
+        self.successResultOf(self.cache.prefetch(['example.org', 'unknown.org']))
+        self.clock.advance(70)
+        self.cache.save()
+        cache = DnsCache(DummyResolver(), clock=self.clock, path=self.cache.path)
+        cache.load()
+        # negative answer has expired
+        self.assertEqual(2, len(cache))
+        answer = self.successResultOf(cache.lookupMailExchange('example.org'))
+        self.assertEqual('mx1.example.org', str(answer[0][0].payload.name))
+        self.assertEqual('10.0.0.1', self.successResultOf(cache.getHostByName('mx1.example.org')))
+        self.assertEqual([], cache.resolver.queries)
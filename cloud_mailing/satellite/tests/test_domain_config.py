@@ -0,0 +1,57 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from ...common.unittest_mixins import DatabaseMixin
+from ..domain_config import DomainConfigurationCache
+from ..models import DomainConfiguration
+
+__author__ = 'ricard'
+
+
+class DomainConfigurationCacheTestCase(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+        DomainConfiguration.remove({})
+        DomainConfiguration.create(domain_name='Example.org', max_relayers=3)
+        self.clock = task.Clock()
+        self.cache = DomainConfigurationCache(max_age=60, clock=self.clock)
+
+    def tearDown(self):
+        DomainConfiguration.remove({})
+        self.disconnect_from_db()
+
+    def test_get(self):
+        self.assertEqual(3, self.cache.get('example.org')['max_relayers'])
+        self.assertEqual({}, self.cache.get('other.org'))
+
+    def test_invalidate(self):
+        self.cache.get('example.org')
+        DomainConfiguration.create(domain_name='other.org', max_relayers=2)
+        self.assertEqual({}, self.cache.get('other.org'))
+        self.cache.invalidate()
+        self.assertEqual(2, self.cache.get('other.org')['max_relayers'])
+
+    def test_max_age(self):
+        self.cache.get('example.org')
+        DomainConfiguration.create(domain_name='other.org', max_relayers=2)
+        self.clock.advance(59)
+        self.assertEqual({}, self.cache.get('other.org'))
+        self.clock.advance(1)
+        self.assertEqual(2, self.cache.get('other.org')['max_relayers'])
@@ -46,28 +46,93 @@ class MailCustomizerTestCase(DatabaseMixin, TestCase):
         self.assertEquals(customizer._do_customization(recipient.mailing.body, recipient.contact_data),
                           'This is a very simple mailing.')
 
+    def test_templates_are_compiled_once_per_mailing(self):
+        mailing = factories.MailingFactory()
+        recipient1 = factories.RecipientFactory(mailing=mailing)
+        recipient2 = factories.RecipientFactory(mailing=mailing, contact_data={
+            'email': 'another.one@domain.com',
+            'custom': 'really simple',
+        })
+
+        customizer = MailCustomizer(recipient1)
+        template = customizer._get_template(mailing.body, part_key='0')
+        self.assertIs(template, MailCustomizer(recipient2)._get_template(mailing.body, part_key='0'))
+        self.assertEquals(MailCustomizer(recipient2)._do_customization(mailing.body, recipient2.contact_data, part_key='0'),
+                          'This is a really simple mailing.')
+
+        MailCustomizer.invalidate_mailing_content(mailing.id)
+        self.assertIsNot(template, customizer._get_template(mailing.body, part_key='0'))
+
+    def test_rendered_parts_are_shared_by_recipients(self):
+        body = '<p>Hello {{ custom }}, <a href="{{ unsubscribe }}">unsubscribe</a></p>'
+        mailing = factories.MailingFactory(body=body)
+        recipient1 = factories.RecipientFactory(mailing=mailing, tracking_id='UID1', contact_data={
+            'email': 'firstname.lastname@domain.com',
+            'custom': 'John',
+        })
+        recipient2 = factories.RecipientFactory(mailing=mailing, tracking_id='UID2', contact_data={
+            'email': 'another.one@domain.com',
+            'custom': 'John',
+        })
+        MailCustomizer.renderedCache.clear()
+
+        text1 = MailCustomizer(recipient1)._do_customization(body, recipient1.contact_data, part_key='0')
+        text2 = MailCustomizer(recipient2)._do_customization(body, recipient2.contact_data, part_key='0')
+        self.assertEqual(1, len(MailCustomizer.renderedCache))
+        self.assertEqual('<p>Hello John, <a href="http://localhost/ml/u/UID1">unsubscribe</a></p>', text1)
+        self.assertEqual('<p>Hello John, <a href="http://localhost/ml/u/UID2">unsubscribe</a></p>', text2)
+
+        MailCustomizer(recipient1)._do_customization(body, {'email': 'x@domain.com', 'custom': 'Jack'}, part_key='0')
+        self.assertEqual(2, len(MailCustomizer.renderedCache))
+
+        MailCustomizer.invalidate_mailing_content(mailing.id)
+        self.assertEqual(0, len(MailCustomizer.renderedCache))
+
+    def test_rendered_parts_not_shared_when_recipient_variables_are_filtered(self):
+        body = 'Hello {{ custom }}, unsubscribe: {{ unsubscribe|upper }}'
+        mailing = factories.MailingFactory(body=body)
+        recipient = factories.RecipientFactory(mailing=mailing, tracking_id='UID1')
+        MailCustomizer.renderedCache.clear()
+
+        text = MailCustomizer(recipient)._do_customization(body, recipient.contact_data, part_key='0')
+        self.assertEqual('Hello very simple, unsubscribe: HTTP://LOCALHOST/ML/U/UID1', text)
+        self.assertEqual(0, len(MailCustomizer.renderedCache))
+
     def test_customize_message(self):
         mailing = factories.MailingFactory()
         recipient = factories.RecipientFactory(mailing=mailing)
 
         customizer = MailCustomizer(recipient)
-        fullpath = os.path.join(customizer.temp_path, MailCustomizer.make_file_name(recipient.mailing.id, recipient.id))
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-
-        self.assertFalse(os.path.exists(fullpath))
-
-        customizer._run_customizer()
-
-        self.assertTrue(os.path.exists(fullpath))
-        # print file(fullpath, 'rt').read()
+        message_id, segments = customizer._run_customizer()
+        message_str = ''.join(segments)
         parser = email.parser.Parser()
-        message = parser.parse(file(fullpath, 'rt'), headersonly = False)
+        message = parser.parsestr(message_str, headersonly = False)
         assert(isinstance(message, email.message.Message))
         self.assertFalse(message.is_multipart())
         self.assertTrue('Date' in message)
         self.assertEquals('This is a very simple mailing.', message.get_payload())
 
+    def test_skeleton_is_shared_by_recipients(self):
+        mailing = factories.MailingFactory(header="Subject: Great {{ custom }} news!\n")
+        recipient1 = factories.RecipientFactory(mailing=mailing)
+        recipient2 = factories.RecipientFactory(mailing=mailing, contact_data={
+            'email': 'another.one@domain.com',
+            'custom': 'really simple',
+        })
+
+        skeleton = MailCustomizer(recipient1)._get_skeleton()
+        self.assertIs(skeleton, MailCustomizer(recipient2)._get_skeleton())
+
+        parser = email.parser.Parser()
+        message1 = parser.parsestr(''.join(MailCustomizer(recipient1)._render_skeleton(skeleton, recipient1.contact_data)))
+        message2 = parser.parsestr(''.join(MailCustomizer(recipient2)._render_skeleton(skeleton, recipient2.contact_data)))
+        self.assertEquals('Great very simple news!', message1['Subject'])
+        self.assertEquals('This is a very simple mailing.', message1.get_payload())
+        self.assertEquals('<firstname.lastname@domain.com>', message1['To'])
+        self.assertEquals('Great really simple news!', message2['Subject'])
+        self.assertEquals('This is a really simple mailing.', message2.get_payload())
+        self.assertEquals('<another.one@domain.com>', message2['To'])
+
     def test_customize_simple_message_with_recipient_attachment(self):
         recipient = factories.RecipientFactory(
             contact_data={
@@ -87,17 +152,10 @@ class MailCustomizerTestCase(DatabaseMixin, TestCase):
         #print recipient.mailing.content
 
         customizer = MailCustomizer(recipient)
-        fullpath = os.path.join(customizer.temp_path, MailCustomizer.make_file_name(recipient.mailing.id, recipient.id))
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-
-        self.assertFalse(os.path.exists(fullpath))
-
-        customizer._run_customizer()
-
-        self.assertTrue(os.path.exists(fullpath))
+        message_id, segments = customizer._run_customizer()
+        message_str = ''.join(segments)
         parser = email.parser.Parser()
-        message = parser.parse(file(fullpath, 'rt'), headersonly = False)
+        message = parser.parsestr(message_str, headersonly = False)
         assert(isinstance(message, email.message.Message))
         self.assertTrue(message.is_multipart())
         # print
@@ -105,6 +163,36 @@ class MailCustomizerTestCase(DatabaseMixin, TestCase):
         self.assertEquals(message.get_payload(i=0).get_payload(), 'This is a very simple mailing.')
         self.assertEquals(message.get_payload(i=1).get_payload(), 'col1;col2;col3\nval1;val2;val3\n')
 
+    def test_attachments_are_encoded_once(self):
+        attachment = {
+            'filename': "report.pdf",
+            'data': base64.b64encode("%PDF-1.4 fake content"),
+            'content-type': 'application/pdf',
+        }
+        mailing = factories.MailingFactory()
+        recipient1 = factories.RecipientFactory(mailing=mailing, contact_data={
+            'email': 'firstname.lastname@domain.com',
+            'custom': 'very simple',
+            'attachments': [attachment],
+        })
+        recipient2 = factories.RecipientFactory(mailing=mailing, contact_data={
+            'email': 'another.one@domain.com',
+            'custom': 'really simple',
+            'attachments': [dict(attachment)],
+        })
+        MailCustomizer.attachmentsCache.clear()
+
+        parser = email.parser.Parser()
+        message1 = parser.parsestr(''.join(MailCustomizer(recipient1)._run_customizer()[1]))
+        message2 = parser.parsestr(''.join(MailCustomizer(recipient2)._run_customizer()[1]))
+
+        self.assertEqual(1, len(MailCustomizer.attachmentsCache))
+        for message in (message1, message2):
+            self.assertEqual("application/pdf", message.get_payload(i=1).get_content_type())
+            self.assertEqual("report.pdf", message.get_payload(i=1).get_filename())
+            self.assertEqual("%PDF-1.4 fake content", message.get_payload(i=1).get_payload(decode=True))
+        self.assertEqual('This is a really simple mailing.', message2.get_payload(i=0).get_payload())
+
     def test_customize_mixed_message_with_recipient_attachment(self):
         recipient = factories.RecipientFactory(
             mailing = factories.MailingFactory(
@@ -149,17 +237,10 @@ Nothing else to say...
         )
 
         customizer = MailCustomizer(recipient)
-        fullpath = os.path.join(customizer.temp_path, MailCustomizer.make_file_name(recipient.mailing.id, recipient.id))
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-
-        self.assertFalse(os.path.exists(fullpath))
-
-        customizer._run_customizer()
-
-        self.assertTrue(os.path.exists(fullpath))
+        message_id, segments = customizer._run_customizer()
+        message_str = ''.join(segments)
         parser = email.parser.Parser()
-        message = parser.parse(file(fullpath, 'rt'), headersonly = False)
+        message = parser.parsestr(message_str, headersonly = False)
         assert(isinstance(message, email.message.Message))
         self.assertTrue(message.is_multipart())
         # print
@@ -214,17 +295,10 @@ Nothing else to say...
         )
 
         customizer = MailCustomizer(recipient)
-        fullpath = os.path.join(customizer.temp_path, MailCustomizer.make_file_name(recipient.mailing.id, recipient.id))
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-
-        self.assertFalse(os.path.exists(fullpath))
-
-        customizer._run_customizer()
-
-        self.assertTrue(os.path.exists(fullpath))
+        message_id, segments = customizer._run_customizer()
+        message_str = ''.join(segments)
         parser = email.parser.Parser()
-        message = parser.parse(file(fullpath, 'rt'), headersonly = False)
+        message = parser.parsestr(message_str, headersonly = False)
         assert(isinstance(message, email.message.Message))
         # print
         # print message.as_string()
@@ -289,17 +363,10 @@ AAAAjAAAANAAAABIAAAAAQAAAEgAAAABUGFpbnQuTkVUIHYzLjUuMTAAMjAxMjoxMjoxMSAx
         )
 
         customizer = MailCustomizer(recipient)
-        fullpath = os.path.join(customizer.temp_path, MailCustomizer.make_file_name(recipient.mailing.id, recipient.id))
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-
-        self.assertFalse(os.path.exists(fullpath))
-
-        customizer._run_customizer()
-
-        self.assertTrue(os.path.exists(fullpath))
+        message_id, segments = customizer._run_customizer()
+        message_str = ''.join(segments)
         parser = email.parser.Parser()
-        message = parser.parse(file(fullpath, 'rt'), headersonly = False)
+        message = parser.parsestr(message_str, headersonly = False)
         assert(isinstance(message, email.message.Message))
         # print
         # print message.as_string()
@@ -376,17 +443,10 @@ AAAAjAAAANAAAABIAAAAAQAAAEgAAAABUGFpbnQuTkVUIHYzLjUuMTAAMjAxMjoxMjoxMSAx
         )
 
         customizer = MailCustomizer(recipient)
-        fullpath = os.path.join(customizer.temp_path, MailCustomizer.make_file_name(recipient.mailing.id, recipient.id))
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-
-        self.assertFalse(os.path.exists(fullpath))
-
-        customizer._run_customizer()
-
-        self.assertTrue(os.path.exists(fullpath))
+        message_id, segments = customizer._run_customizer()
+        message_str = ''.join(segments)
         parser = email.parser.Parser()
-        message = parser.parse(file(fullpath, 'rt'), headersonly = False)
+        message = parser.parsestr(message_str, headersonly = False)
         assert(isinstance(message, email.message.Message))
         # print
         # print message.as_string()
@@ -480,17 +540,10 @@ Nothing else to say...
         )
 
         customizer = MailCustomizer(recipient)
-        fullpath = os.path.join(customizer.temp_path, MailCustomizer.make_file_name(recipient.mailing.id, recipient.id))
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-
-        self.assertFalse(os.path.exists(fullpath))
-
-        customizer._run_customizer()
-
-        self.assertTrue(os.path.exists(fullpath))
+        message_id, segments = customizer._run_customizer()
+        message_str = ''.join(segments)
         parser = email.parser.Parser()
-        message = parser.parse(file(fullpath, 'rt'), headersonly = False)
+        message = parser.parsestr(message_str, headersonly = False)
         assert(isinstance(message, email.message.Message))
         # print
         # print message.as_string()
@@ -504,6 +557,20 @@ Nothing else to say...
         self.assertIn("This is an attachment", message.get_payload(i=1).get_payload())
         self.assertEquals(message.get_payload(i=2).get_payload(), 'col1;col2;col3\nval1;val2;val3\n')
 
+    def test_rendered_parts_not_shared_when_recipient_variables_are_in_tracked_links(self):
+        body = '<p>Hello {{ custom }}, <a href="http://my.com/unsubscribe?u={{ unsubscribe }}">unsubscribe</a></p>'
+        mailing = factories.MailingFactory(body=body, tracking_url='http://tr.net/')
+        recipient = factories.RecipientFactory(mailing=mailing, tracking_id='UID1')
+        MailCustomizer.renderedCache.clear()
+
+        customizer = MailCustomizer(recipient, read_tracking=False, click_tracking=True)
+        text = customizer._do_customization(body, recipient.contact_data, is_html=True, part_key='0')
+        self.assertEqual(0, len(MailCustomizer.renderedCache))
+        self.assertEqual(
+            '<p>Hello very simple, <a href="http://tr.net/c/UID1/?o=http%3A//my.com/unsubscribe%3Fu%3D%7B%7B%20unsubscribe'
+            '%20%7D%7D&t=http%3A//my.com/unsubscribe%3Fu%3Dhttp%3A//tr.net/u/UID1">unsubscribe</a></p>',
+            text)
+
     def test_clicks_tracking(self):
         mailing = factories.MailingFactory(tracking_url='http://tracking.net/')
         recipient = factories.RecipientFactory(mailing=mailing, tracking_id="TRACKING_ID")
@@ -542,6 +609,28 @@ Nothing else to say...
                     '&t=http%3A//my.com/the_page%3Fid%3D123">click here</a></p>',
             new_content)
 
+    def test_prepare_mailing(self):
+        mailing = factories.MailingFactory(tracking_url='http://tr.net/',
+                                           header="Content-Type: text/html; charset=\"us-ascii\"\n"
+                                                  "Subject: Great news!\n",
+                                           body='<p>Please <a href="http://my.com/the_page">click here</a></p>',
+                                           read_tracking=False, click_tracking=True)
+        recipient = factories.RecipientFactory(mailing=mailing, tracking_id="TRACKING_ID")
+        mailing = recipient.mailing  # as stored in db
+
+        MailCustomizer.prepare_mailing(mailing)
+        skeleton = MailCustomizer.get_mailing_skeleton(mailing)
+        self.assertEqual(['0'], skeleton.text_parts.keys())
+
+        customizer = MailCustomizer(recipient, read_tracking=False, click_tracking=True)
+        self.assertIs(skeleton, customizer._get_skeleton())
+        template = MailCustomizer.get_mailing_template(mailing.id, '0', None, True, True, False)
+        self.assertIs(template, customizer._get_template(None, is_html=True, part_key='0'))
+        self.assertEquals(
+            '<p>Please <a href="http://tr.net/c/TRACKING_ID/?o=http%3A//my.com/the_page'
+            '&t=http%3A//my.com/the_page">click here</a></p>',
+            customizer._do_customization(None, customizer.make_contact_data_dict(recipient), True, part_key='0'))
+
     def test_customize_message_encoding(self):
         mailing = factories.MailingFactory(
             header="""Content-Transfer-Encoding: 7bit
@@ -579,17 +668,10 @@ I'm happy! Nothing else to say...
         recipient = factories.RecipientFactory(mailing=mailing)
 
         customizer = MailCustomizer(recipient)
-        fullpath = os.path.join(customizer.temp_path, MailCustomizer.make_file_name(recipient.mailing.id, recipient.id))
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-
-        self.assertFalse(os.path.exists(fullpath))
-
-        customizer._run_customizer()
-
-        self.assertTrue(os.path.exists(fullpath))
+        message_id, segments = customizer._run_customizer()
+        message_str = ''.join(segments)
         parser = email.parser.Parser()
-        message = parser.parse(file(fullpath, 'rt'), headersonly = False)
+        message = parser.parsestr(message_str, headersonly = False)
         assert(isinstance(message, email.message.Message))
         self.assertTrue(message.is_multipart())
         self.assertEquals("multipart/alternative", message.get_content_type())
@@ -642,17 +724,10 @@ I=92m happy! Nothing else to say...
 
         return
         customizer = MailCustomizer(recipient)
-        fullpath = os.path.join(customizer.temp_path, MailCustomizer.make_file_name(recipient.mailing.id, recipient.id))
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-
-        self.assertFalse(os.path.exists(fullpath))
-
-        customizer._run_customizer()
-
-        self.assertTrue(os.path.exists(fullpath))
+        message_id, segments = customizer._run_customizer()
+        message_str = ''.join(segments)
         parser = email.parser.Parser()
-        message = parser.parse(file(fullpath, 'rt'), headersonly = False)
+        message = parser.parsestr(message_str, headersonly = False)
         assert(isinstance(message, email.message.Message))
         self.assertTrue(message.is_multipart())
         self.assertEquals("multipart/alternative", message.get_content_type())
@@ -720,21 +795,32 @@ I=92m happy! Nothing else to say...
         self.assertTrue(d.verify(0, dnsfunc=self._get_txt))
         self.assertTrue(d.verify(1, dnsfunc=self._get_txt))
 
+    def test_dkim_signer_is_shared_by_recipients(self):
+        privkey = self._get_dkim_privkey()
+        mailing = factories.MailingFactory(dkim={'selector': 'mail', 'domain': 'unittest.cloud-mailing.net', 'privkey':privkey})
+        recipient1 = factories.RecipientFactory(mailing=mailing)
+        recipient2 = factories.RecipientFactory(mailing=mailing, contact_data={
+            'email': 'another.one@domain.com',
+            'custom': 'really simple',
+        })
+
+        signer = MailCustomizer(recipient1)._get_signer()
+        self.assertIs(signer, MailCustomizer(recipient2)._get_signer())
+
+        self.assertTrue(dkim.verify(self._customize(recipient1), dnsfunc=self._get_txt))
+        self.assertTrue(dkim.verify(self._customize(recipient2), dnsfunc=self._get_txt))
+
+        MailCustomizer.invalidate_mailing_content(mailing.id)
+        self.assertIsNot(signer, MailCustomizer(recipient1)._get_signer())
+
     def _get_txt(self, name):
         self.assertEqual("mail._domainkey.unittest.cloud-mailing.net.", name)
         return "v=DKIM1; h=sha256; k=rsa; p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQDQKTyffdhVj+Z7xke+b3/ns2u9ls3pVdI0tgCYKe8Fi6mXbF+Bri6rBadih/etMNOZ1BO/meLF8wfVgbizxAXjeinKH23HXjqTipJXoWWiwFLIijmSG/2Q+9vseAPGlVpgormOVj67gJRhjJw50i9COiHIq6ChpE969i2LGIfXpQIDAQAB"
 
     def _customize(self, recipient):
         customizer = MailCustomizer(recipient)
-        fullpath = os.path.join(customizer.temp_path, MailCustomizer.make_file_name(recipient.mailing.id, recipient.id))
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-        self.assertFalse(os.path.exists(fullpath))
-        customizer._run_customizer()
-        self.assertTrue(os.path.exists(fullpath))
-        # print file(fullpath, 'rt').read()
-        message_str = file(fullpath, 'rt').read()
-        return message_str
+        message_id, segments = customizer._run_customizer()
+        return ''.join(segments)
 
     def _get_dkim_privkey(self):
         return file(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'deployment', 'acceptance_tests', 'data',
@@ -16,15 +16,31 @@
 # along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
 
 from ...common.unittest_mixins import DatabaseMixin
+from .. import settings_vars
 from ..mail_customizer import MailCustomizer
-from ..mailing_sender import MailingSender
-from ..models import MailingRecipient, Mailing
+from ..dns_cache import DnsCache
+from ..mailing_sender import MailingSender, Queue, ActiveQueuesList, DomainLimits, RecipientManager, \
+    get_domain_limits, group_exchanges_by_mx
+from ..models import MailingRecipient, Mailing, SmtpSession, RECIPIENT_STATUS
+from ..mx import MXCalculator
+from ..rate_limiter import RateLimiter
+from ..scheduler import SendScheduler
+from ..sendmail import SMTPRelayerFactory
+from ..spool import MessageSpool
+from ..transcripts import SessionTranscript, decompress_transcript
+from twisted.internet import defer, protocol, reactor, task
+from twisted.mail import smtp
+from twisted.names import dns
 from twisted.trial.unittest import TestCase
+from test_dns_cache import DummyResolver, mx_answer
 import factories
 import os
 import email.parser
+import logging
+import threading
 import email.message
 import base64
+from datetime import datetime
 
 __author__ = 'ricard'
 
@@ -43,3 +59,301 @@ class TestMailingSender(DatabaseMixin, TestCase):
         factories.RecipientFactory(mailing=ml)
         filter = MailingSender.make_queue_filter()
         self.assertEqual(4, MailingRecipient.find(filter).count())
+
+    def test_set_send_mail_in_progress_many(self):
+        first_try = datetime(2015, 1, 1)
+        new = factories.RecipientFactory()
+        retried = factories.RecipientFactory(try_count=2, first_try=first_try)
+        MailingRecipient.set_send_mail_in_progress_many([new, retried])
+        for recipient, try_count in ((new, 1), (retried, 3)):
+            self.assertEqual(try_count, recipient.try_count)
+            stored = MailingRecipient.grab(recipient.id)
+            self.assertEqual(try_count, stored.try_count)
+            self.assertTrue(stored.in_progress)
+            self.assertEqual(RECIPIENT_STATUS.IN_PROGRESS, stored.send_status)
+            self.assertIsNotNone(stored.first_try)
+        self.assertEqual(first_try, MailingRecipient.grab(retried.id).first_try)
+
+
+class LightMailingSender(MailingSender):
+    """MailingSender without the database cleanup and the DNS setup made at creation."""
+    def __init__(self):
+        self.log = logging.getLogger('ml_queue')
+        self.scheduler = SendScheduler(self.check_mailing, clock=task.Clock())
+        self.relay_manager = ActiveQueuesList(self.log)
+        self.handlingQueueLock = threading.Lock()
+        self.check_again = False
+        self.timer_delay = 5
+
+
+class TestQueuesStart(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+        self.patch(settings_vars, 'get', lambda name: settings_vars.default[name])
+        self.patch(settings_vars, 'get_int', lambda name: settings_vars.default[name])
+        self.patch(settings_vars, 'get_float', lambda name: 0)
+        resolver = DummyResolver()
+        resolver.answers[('example.org', dns.MX)] = mx_answer('example.org', 300, 'mx1.example.org')
+        cache = DnsCache(resolver)
+        self.successResultOf(cache.lookupMailExchange('example.org'))
+        self.patch(Queue, 'mxcalc', MXCalculator(resolver=cache))
+        self.threads = []
+        self.patch(Queue, '_start_customization', self._start_customization)
+        self.patch(Queue, '_send_all_emails', lambda queue, addresses, port, factory, testing: queue.domain)
+
+    def tearDown(self):
+        self.disconnect_from_db()
+
+    def _start_customization(self, mxs, factory, recipients):
+        self.threads.append(threading.current_thread())
+        return mxs
+
+    def test_queue_started_from_reactor_thread_on_cache_hit(self):
+        recipient = factories.RecipientFactory(email='john@example.org')
+        sender = LightMailingSender()
+        sender.scheduler.add(recipient.id, 'example.org', recipient.mailing.id)
+        sender.handle_mailing_queue = lambda queue_filter: (
+            {'mode': 'direct'}, {'example.org': (DomainLimits(1, 1, 1), [[recipient]])}, {})
+
+        def check(ignored):
+            self.assertEqual([threading.current_thread()], self.threads)
+            self.assertEqual(0, sender.relay_manager.activeRelayCount())
+            self.assertTrue(sender.handlingQueueLock.acquire(False))
+
+        return sender.check_mailing().addCallback(check)
+
+
+class TestDomainLimits(TestCase):
+    def setUp(self):
+        self.patch(settings_vars, 'get_int', lambda name: settings_vars.default[name])
+
+    def test_defaults(self):
+        self.assertEqual((1, 2, 1), get_domain_limits({}))
+
+    def test_mx_fan_out(self):
+        self.assertEqual((6, 2, 3), get_domain_limits({'max_mx': 2, 'cnx_per_mx': 3}))
+
+    def test_max_relayers(self):
+        self.assertEqual((10, 2, 1), get_domain_limits({'max_relayers': 10}))
+
+    def test_max_relayers_is_capped_by_mx_configuration(self):
+        self.assertEqual((4, 2, 3), get_domain_limits({'max_relayers': 4, 'cnx_per_mx': 3}))
+        self.assertEqual((3, 3, 1), get_domain_limits({'max_relayers': 10, 'max_mx': 3}))
+
+    def test_default_max_queues_is_not_capped(self):
+        default = dict(settings_vars.default, **{settings_vars.DEFAULT_MAX_QUEUE_PER_DOMAIN: 5})
+        self.patch(settings_vars, 'get_int', lambda name: default[name])
+        self.assertEqual((5, 2, 1), get_domain_limits({}))
+
+
+class TestQueueMxSelection(TestCase):
+    def setUp(self):
+        self.patch(Queue, 'mx_connections', Queue.mx_connections.__class__())
+
+    def _make_queue(self, max_mx=2, cnx_per_mx=2):
+        return Queue('example.org', [], {'mode': 'direct'}, max_mx=max_mx, cnx_per_mx=cnx_per_mx)
+
+    def _connect(self, queue, addresses):
+        queue._acquire_mx(queue._select_mx(addresses))
+        return queue.mx_ip
+
+    def test_fan_out(self):
+        addresses = ['mx1', 'mx2', 'mx3']
+        queues = [self._make_queue() for _ in range(5)]
+        self.assertEqual(['mx1', 'mx1', 'mx2', 'mx2', 'mx1'], [self._connect(q, addresses) for q in queues])
+        self.assertEqual({'mx1': 3, 'mx2': 2}, dict(Queue.mx_connections))
+
+    def test_release(self):
+        queue = self._make_queue()
+        self._connect(queue, ['mx1'])
+        queue._release_mx()
+        queue._release_mx()
+        self.assertEqual({}, dict(Queue.mx_connections))
+        self.assertEqual('mx1', queue.mx_ip)
+
+
+class TestQueueConnectionsRate(TestCase):
+    def setUp(self):
+        self.patch(Queue, 'rate_limiter', RateLimiter(task.Clock()))
+        Queue.rate_limiter.configure_domain('example.org', connections_per_minute=1)
+        self.connections = []
+
+    def connect(self):
+        self.connections.append(True)
+
+    def test_domain_connection_taken_when_opened(self):
+        self.assertTrue(MailingSender.can_open_queue('example.org'))
+        self.assertTrue(MailingSender.can_open_queue('example.org'))
+        queue = Queue('example.org', [], {'mode': 'direct'})
+        queue._open_connection(self, 'mx1')
+        self.assertEqual(1, len(self.connections))
+        self.assertFalse(MailingSender.can_open_queue('example.org'))
+
+
+class TestGroupExchangesByMx(TestCase):
+    mx_names = {'a.com': ('mx.hoster.net',), 'b.com': ('mx.hoster.net',), 'c.com': ('mx.hoster.net',),
+                'd.com': ('mx.d.com',)}
+
+    def _group(self, exchanges, sizes=None):
+        max_messages = dict((domain, 5) for domain in exchanges)
+        max_messages.update(sizes or {})
+        return group_exchanges_by_mx(exchanges, max_messages, self.mx_names.get)
+
+    def test_grouping(self):
+        exchanges = {'a.com': (None, [['a1', 'a2']]),
+                     'b.com': (None, [['b1']]),
+                     'c.com': (None, [['c1', 'c2']]),
+                     'd.com': (None, [['d1']]),
+                     'unknown.com': (None, [['u1']])}
+        self.assertEqual(2, self._group(exchanges))
+        self.assertEqual(['a.com', 'd.com', 'unknown.com'], sorted(exchanges))
+        self.assertEqual([['a1', 'a2', 'c1', 'c2', 'b1']], exchanges['a.com'][1])
+
+    def test_queues_size(self):
+        exchanges = {'a.com': (None, [['a1', 'a2']]),
+                     'b.com': (None, [['b1', 'b2']]),
+                     'c.com': (None, [['c1', 'c2']])}
+        self.assertEqual(1, self._group(exchanges, {'a.com': 4}))
+        self.assertEqual([['a1', 'a2', 'b1', 'b2']], exchanges['a.com'][1])
+        self.assertEqual([['c1', 'c2']], exchanges['c.com'][1])
+
+    def test_smallest_queue_size_is_kept(self):
+        exchanges = {'a.com': (None, [['a1', 'a2']]),
+                     'b.com': (None, [['b1']]),
+                     'c.com': (None, [['c1']])}
+        max_messages = {'a.com': 5, 'b.com': 3, 'c.com': 5}
+        self.assertEqual(1, group_exchanges_by_mx(exchanges, max_messages, self.mx_names.get))
+        self.assertEqual([['a1', 'a2', 'b1']], exchanges['a.com'][1])
+        self.assertEqual([['c1']], exchanges['c.com'][1])
+        self.assertEqual(3, max_messages['a.com'])
+
+    def test_full_queues_are_not_grouped(self):
+        exchanges = {'a.com': (None, [['a1', 'a2', 'a3']]),
+                     'b.com': (None, [['b1'], ['b2']]),
+                     'c.com': (None, [['c1']])}
+        self.assertEqual(0, self._group(exchanges, {'a.com': 3}))
+        self.assertEqual(3, len(exchanges))
+
+
+class TestActiveQueuesList(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+        self.patch(settings_vars, 'get_float', lambda name: 0)  # no MAILING_QUEUE_ENDING_DELAY
+        self.removed = 0
+        self.queues = ActiveQueuesList(logging.getLogger('ml_queue'), queueRemovedCallback=self._on_removed)
+
+    def tearDown(self):
+        self.disconnect_from_db()
+
+    def _on_removed(self):
+        self.removed += 1
+
+    def test_queues_count(self):
+        queue = Queue('a.com', [], {'mode': 'direct'})
+        queue.domains = ['a.com', 'b.com']
+        q1 = self.queues.add_queue(queue)
+        q2 = self.queues.add_queue(Queue('a.com', [], {'mode': 'direct'}))
+        self.assertEqual((2, 1, 0), tuple(map(self.queues.queues_count, ('a.com', 'b.com', 'c.com'))))
+        self.queues.removeActiveRelay(q2)
+        self.assertEqual(1, self.queues.queues_count('a.com'))
+        self.queues.removeActiveRelay(q1)
+        self.assertEqual({}, dict(self.queues.domain_queues))
+        self.assertEqual(2, self.removed)
+
+
+class TestStoreTranscript(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+        self.mode = 'failures'
+        self.patch(settings_vars, 'get', lambda name: self.mode)
+
+    def tearDown(self):
+        self.disconnect_from_db()
+
+    def _make_transcript(self, failed):
+        transcript = SessionTranscript()
+        transcript.append('>>> EHLO localhost')
+        transcript.failed = failed
+        return transcript
+
+    def _stored(self, transcript):
+        return SmtpSession.grab(transcript.session_id) is not None
+
+    def test_only_failures(self):
+        succeeded = self._make_transcript(False)
+        Queue.store_transcript(succeeded, '10.0.0.1')
+        failed = self._make_transcript(True)
+        Queue.store_transcript(failed, '10.0.0.1')
+        self.assertFalse(self._stored(succeeded))
+        self.assertTrue(self._stored(failed))
+        self.assertEqual('>>> EHLO localhost', decompress_transcript(SmtpSession.grab(failed.session_id).log))
+
+    def test_recipient_session_reference(self):
+        factory = SMTPRelayerFactory('example.org')
+        factory.session_id = self._make_transcript(True).session_id
+        manager = RecipientManager(factory, factories.RecipientFactory(), lambda: '10.0.0.1',
+                                   logging.getLogger('ml_queue'))
+        self.assertEqual(factory.session_id, manager.stored_session_id(failed=True))
+        self.assertIsNone(manager.stored_session_id(failed=False))
+        self.mode = 'none'
+        self.assertIsNone(manager.stored_session_id(failed=True))
+        self.mode = 'all'
+        self.assertEqual(factory.session_id, manager.stored_session_id(failed=False))
+
+    def test_all_or_none(self):
+        self.mode = 'none'
+        transcript = self._make_transcript(True)
+        Queue.store_transcript(transcript, '10.0.0.1')
+        self.assertFalse(self._stored(transcript))
+        self.mode = 'all'
+        transcript = self._make_transcript(False)
+        Queue.store_transcript(transcript, '10.0.0.1')
+        self.assertTrue(self._stored(transcript))
+
+
+class TestRecipientManagerSpool(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+        self.patch(settings_vars, 'get', lambda name: settings_vars.default[name])
+        self.spool = MessageSpool(self.mktemp(), max_memory=1000)
+
+    def tearDown(self):
+        self.disconnect_from_db()
+
+    @defer.inlineCallbacks
+    def test_spool_released_on_refused_connection(self):
+        # nothing listens on a port just closed
+        port = reactor.listenTCP(0, protocol.ServerFactory(), interface='127.0.0.1')
+        port_number = port.getHost().port
+        yield port.stopListening()
+
+        factory = SMTPRelayerFactory('example.org', retries=0, timeout=5)
+        recipients = [factories.RecipientFactory(email='rcpt%d@example.org' % i, in_progress=True) for i in range(2)]
+        managers = []
+        for recipient in recipients:
+            manager = RecipientManager(factory, recipient, lambda: '127.0.0.1', logging.getLogger('ml_queue'),
+                                       spool=self.spool)
+            manager.deferred.addErrback(lambda err: None)
+            manager._add_to_factory(('<id>', ['Subject: test\n', '\nHello\n']))
+            managers.append(manager)
+        self.assertEqual(2, len(self.spool))
+
+        reactor.connectTCP('127.0.0.1', port_number, factory)
+        yield self.assertFailure(factory.deferred, smtp.SMTPConnectError)
+        self.assertEqual(0, len(self.spool))
+        for recipient in recipients:
+            self.assertEqual(RECIPIENT_STATUS.WARNING, MailingRecipient.grab(recipient.id).send_status)
+
+    def test_customized_after_connection_failure(self):
+        factory = SMTPRelayerFactory('example.org', retries=0, timeout=5)
+        factory.expect_emails(1)
+        factory.deferred.addErrback(lambda err: None)
+        factory.doStart()
+        factory.doStop()
+        manager = RecipientManager(factory, factories.RecipientFactory(in_progress=True), lambda: None,
+                                   logging.getLogger('ml_queue'), spool=self.spool)
+
+        manager._add_to_factory(('<id>', ['Subject: test\n', '\nHello\n']))
+        self.assertEqual(0, len(self.spool))
+        self.assertEqual(0, factory.pending_emails)
+        self.failureResultOf(manager.deferred, smtp.SMTPConnectError)
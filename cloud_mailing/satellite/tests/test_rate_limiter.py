@@ -0,0 +1,87 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from ..rate_limiter import RateLimiter
+
+__author__ = 'ricard'
+
+
+class RateLimiterTestCase(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limiter = RateLimiter(self.clock)
+
+    def test_no_limit(self):
+        for i in range(100):
+            self.assertEqual(0, self.limiter.acquire_message('example.org', 'mx.example.org'))
+            self.assertEqual(0, self.limiter.acquire_connection('example.org', 'mx.example.org'))
+        self.assertTrue(self.limiter.can_send_message('example.org'))
+
+    def test_messages_rate(self):
+        self.limiter.configure_domain('example.org', messages_per_second=2)
+        self.assertEqual(0, self.limiter.acquire_message('example.org'))
+        self.assertEqual(0, self.limiter.acquire_message('example.org'))
+        self.assertEqual(0.5, self.limiter.acquire_message('example.org'))
+        self.assertFalse(self.limiter.can_send_message('example.org'))
+        self.clock.advance(0.5)
+        self.assertEqual(0, self.limiter.acquire_message('example.org'))
+        self.assertEqual(0, self.limiter.acquire_message('other.org'))
+
+    def test_connections_rate(self):
+        self.limiter.configure_mx('mx.example.org', connections_per_minute=2)
+        self.assertEqual(0, self.limiter.acquire_connection(mx='mx.example.org'))
+        self.assertEqual(0, self.limiter.acquire_connection(mx='mx.example.org'))
+        self.assertEqual(30, self.limiter.acquire_connection(mx='mx.example.org'))
+        self.assertEqual(0, self.limiter.acquire_connection(domain='example.org'))
+
+    def test_can_open_connection(self):
+        self.limiter.configure_domain('example.org', connections_per_minute=1)
+        self.assertTrue(self.limiter.can_open_connection('example.org'))
+        self.assertTrue(self.limiter.can_open_connection('example.org'))
+        self.assertEqual(0, self.limiter.acquire_connection('example.org', 'mx.example.org'))
+        self.assertFalse(self.limiter.can_open_connection('example.org'))
+        self.assertTrue(self.limiter.can_open_connection('other.org'))
+
+    def test_domain_and_mx_limits(self):
+        self.limiter.configure_domain('example.org', messages_per_second=1)
+        self.limiter.configure_mx('mx.example.org', messages_per_second=1)
+        self.assertEqual(0, self.limiter.acquire_message('example.org', 'mx.example.org'))
+        self.assertEqual(1, self.limiter.acquire_message('other.org', 'mx.example.org'))
+        self.assertEqual(1, self.limiter.acquire_message('example.org', 'mx2.example.org'))
+        self.clock.advance(1)
+        # a denied message doesn't take any token
+        self.assertEqual(0, self.limiter.acquire_message('other.org', 'mx.example.org'))
+        self.assertEqual(0, self.limiter.acquire_message('example.org', 'mx2.example.org'))
+
+    def test_source_ip_limits(self):
+        self.limiter.configure_ip('127.0.0.2', messages_per_second=1, connections_per_minute=1)
+        self.assertEqual(0, self.limiter.acquire_message('example.org', 'mx.example.org', '127.0.0.2'))
+        self.assertEqual(1, self.limiter.acquire_message('other.org', 'mx.other.org', '127.0.0.2'))
+        self.assertEqual(0, self.limiter.acquire_message('other.org', 'mx.other.org', '127.0.0.3'))
+        self.assertEqual(0, self.limiter.acquire_connection(mx='mx.example.org', ip='127.0.0.2'))
+        self.assertEqual(60, self.limiter.acquire_connection(mx='mx.other.org', ip='127.0.0.2'))
+
+    def test_reconfiguration(self):
+        self.limiter.configure_domain('example.org', messages_per_second=1)
+        self.assertEqual(0, self.limiter.acquire_message('example.org'))
+        self.limiter.configure_domain('example.org', messages_per_second=4)
+        self.assertEqual(0.25, self.limiter.acquire_message('example.org'))
+        self.limiter.configure_domain('example.org', messages_per_second=None)
+        self.assertEqual(0, self.limiter.acquire_message('example.org'))
@@ -0,0 +1,92 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from ..scheduler import SendScheduler
+
+__author__ = 'ricard'
+
+
+def at(seconds):
+    return datetime.utcfromtimestamp(seconds)
+
+
+class SendSchedulerTestCase(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.wakeups = 0
+        self.scheduler = SendScheduler(self._wake_up, clock=self.clock)
+
+    def _wake_up(self):
+        self.wakeups += 1
+
+    def test_ready_recipients(self):
+        self.scheduler.add('b2', 'b.com', 1, at(900))
+        self.scheduler.add('a1', 'A.com', 1, at(100))
+        self.scheduler.add('b1', 'b.com', 1, at(500))
+        self.scheduler.add('a2', 'a.com', 1, None)
+        self.assertEqual(['a.com', 'b.com'], self.scheduler.domains())
+        self.assertEqual(['a2', 'a1'], self.scheduler.take('a.com', 5, {1}))
+        self.assertEqual(['b1'], self.scheduler.take('b.com', 1, {1}))
+        self.assertEqual(['b.com'], self.scheduler.domains())
+        self.assertEqual(1, len(self.scheduler))
+
+    def test_wake_ups_are_grouped(self):
+        for i in range(3):
+            self.scheduler.add('a%d' % i, 'a.com', 1)
+        self.assertEqual(0, self.wakeups)
+        self.clock.advance(0)
+        self.assertEqual(1, self.wakeups)
+        self.scheduler.wake_up(10)
+        self.scheduler.wake_up(5)
+        self.clock.advance(10)
+        self.assertEqual(2, self.wakeups)
+
+    def test_recipients_waiting_for_next_try(self):
+        self.scheduler.add('a1', 'a.com', 1, at(1060))
+        self.scheduler.add('a2', 'a.com', 1, at(1030))
+        self.clock.advance(0)
+        self.assertEqual(0, self.wakeups)
+        self.assertEqual([], self.scheduler.domains())
+        self.clock.advance(30)
+        self.assertEqual(1, self.wakeups)
+        self.assertEqual(['a2'], self.scheduler.take('a.com', 5, {1}))
+        self.clock.advance(30)
+        self.assertEqual(2, self.wakeups)
+        self.assertEqual(['a1'], self.scheduler.take('a.com', 5, {1}))
+
+    def test_other_mailings_stay_ready(self):
+        self.scheduler.add('a1', 'a.com', 1, at(100))
+        self.scheduler.add('a2', 'a.com', 2, at(200))
+        self.scheduler.add('a3', 'a.com', 1, at(300))
+        self.assertEqual(['a2'], self.scheduler.take('a.com', 5, {2}))
+        self.assertEqual([], self.scheduler.take('a.com', 5, {3}))
+        self.assertEqual(2, self.scheduler.ready_count())
+        self.assertEqual(['a1', 'a3'], self.scheduler.take('a.com', 5, {1, 2}))
+
+    def test_remove_mailing(self):
+        self.scheduler.add('a1', 'a.com', 1)
+        self.scheduler.add('a2', 'a.com', 2)
+        self.scheduler.add('b1', 'b.com', 1, at(2000))
+        self.scheduler.remove_mailing(1)
+        self.assertEqual(1, len(self.scheduler))
+        self.assertEqual(['a2'], self.scheduler.take('a.com', 5, {1, 2}))
@@ -0,0 +1,592 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from twisted.internet import defer, protocol, reactor
+from twisted.mail import smtp
+from twisted.protocols import basic
+from twisted.trial.unittest import TestCase
+from zope.interface import implements
+
+from ..sendmail import SMTPRelayerFactory, SMTPConnectionPool, MXConnector
+from ..rate_limiter import RateLimiter
+from ..spool import MessageSpool
+from ..tls_session_cache import TLSSessionCache
+from ..transcripts import decompress_transcript
+
+__author__ = 'ricard'
+
+
+class SMTPRelayerFactoryTestCase(TestCase):
+    def setUp(self):
+        self.requested = 0
+        self.factory = SMTPRelayerFactory('example.org', retries=0, emailRequestedCallback=self._on_email_requested)
+        self.spool = MessageSpool(self.mktemp(), max_memory=1000)
+
+    def _on_email_requested(self):
+        self.requested += 1
+
+    def _send_email(self, recipient):
+        return self.factory.send_email('sender@cloud-mailing.net', (recipient,),
+                                       self.spool.store(1, recipient, ['content']))
+
+    def test_wait_for_email(self):
+        self.factory.expect_emails(2)
+        d = self.factory.wait_for_email()
+        self.assertNoResult(d)
+
+        self._send_email('rcpt1@example.org')
+        self.successResultOf(d)
+        self.assertEqual(1, self.factory.pending_emails)
+        self.assertEqual('rcpt1@example.org', str(self.factory.getNextEmail()[1][0]))
+        self.assertEqual(1, self.requested)
+
+        d = self.factory.wait_for_email()
+        self.assertNoResult(d)
+        self.factory.cancel_email()
+        self.successResultOf(d)
+        self.assertEqual(0, self.factory.pending_emails)
+        self.assertIsNone(self.factory.getNextEmail())
+
+    def test_wait_without_pending_email(self):
+        self.successResultOf(self.factory.wait_for_email())
+
+    def test_stop_waiting(self):
+        self.factory.expect_emails(1)
+        d = self.factory.wait_for_email()
+        self.factory.stop_waiting()
+        self._send_email('rcpt1@example.org')
+        self.assertNoResult(d)
+        self.assertTrue(self.factory.has_email_ready())
+
+
+class FakeMessage(object):
+    implements(smtp.IMessage)
+
+    def __init__(self, server):
+        self.server = server
+        self.lines = []
+
+    def lineReceived(self, line):
+        self.lines.append(line)
+
+    def eomReceived(self):
+        self.server.messages.append('\n'.join(self.lines))
+        return defer.succeed(None)
+
+    def connectionLost(self):
+        pass
+
+
+class FakeSMTPServerFactory(smtp.SMTPFactory):
+    """Accepts all emails, counting connections and keeping their source addresses."""
+    implements(smtp.IMessageDelivery)
+    protocol = smtp.ESMTP
+    contextFactory = None  # if set, STARTTLS is supported
+
+    def __init__(self):
+        smtp.SMTPFactory.__init__(self)
+        self.connections = 0
+        self.messages = []
+        self.peers = []
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        self.peers.append(addr.host)
+        p = self.protocol(contextFactory=self.contextFactory)
+        p.delivery = self
+        p.factory = self
+        return p
+
+    def receivedHeader(self, helo, origin, recipients):
+        return None
+
+    def validateFrom(self, helo, origin):
+        return origin
+
+    def validateTo(self, user):
+        if user.dest.local.startswith('bad'):
+            raise smtp.SMTPBadRcpt(user)
+        return lambda: FakeMessage(self)
+
+
+class SMTPConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServerFactory()
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.pool = SMTPConnectionPool(max_idle_time=10, max_messages=3)
+        self.spool = MessageSpool(self.mktemp(), max_memory=1000)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.pool.close()
+        yield self.port.stopListening()
+
+    def _send(self, *recipients):
+        factory = SMTPRelayerFactory('example.org', retries=0, connectionPool=self.pool)
+        for recipient in recipients:
+            factory.send_email('sender@cloud-mailing.net', (recipient,),
+                               self.spool.store(1, recipient, ['Subject: test\n', '\nHello\n']))
+        self.pool.connect(factory, 'localhost', self.port.getHost().port)
+        return factory.deferred
+
+    @defer.inlineCallbacks
+    def test_connection_is_reused(self):
+        yield self._send('rcpt1@example.org')
+        self.assertEqual(1, len(self.pool))
+        yield self._send('rcpt2@example.org')
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(2, len(self.server.messages))
+        self.assertEqual(1, len(self.pool))
+
+    @defer.inlineCallbacks
+    def test_connection_opened_by_mx_connector_is_reused(self):
+        for recipient in ('rcpt1@example.org', 'rcpt2@example.org'):
+            factory = SMTPRelayerFactory('example.org', retries=0, connectionPool=self.pool)
+            factory.send_email('sender@cloud-mailing.net', (recipient,),
+                               self.spool.store(1, recipient, ['Subject: test\n', '\nHello\n']))
+            connector = MXConnector(factory, ['localhost'], self.port.getHost().port)
+            self.pool.connect(factory, 'localhost', self.port.getHost().port, fallback=connector.connect)
+            yield factory.deferred
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(2, len(self.server.messages))
+
+    @defer.inlineCallbacks
+    def test_max_messages(self):
+        yield self._send('rcpt1@example.org', 'rcpt2@example.org', 'rcpt3@example.org')
+        self.assertEqual(0, len(self.pool))
+        yield self._send('rcpt4@example.org')
+        self.assertEqual(2, self.server.connections)
+
+    @defer.inlineCallbacks
+    def test_closed_connection_is_replaced(self):
+        yield self._send('rcpt1@example.org')
+        for protocols in self.pool._idle.values():
+            protocols[0].transport.loseConnection()
+        yield self._send('rcpt2@example.org')
+        self.assertEqual(2, self.server.connections)
+        self.assertEqual(2, len(self.server.messages))
+
+
+class SMTPRelayerRateLimitTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServerFactory()
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.spool = MessageSpool(self.mktemp(), max_memory=10000)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_messages_rate(self):
+        rate_limiter = RateLimiter()
+        rate_limiter.configure_domain('example.org', messages_per_second=20)
+        factory = SMTPRelayerFactory('example.org', retries=0, rateLimiter=rate_limiter)
+        for i in range(25):
+            recipient = 'rcpt%d@example.org' % i
+            factory.send_email('sender@cloud-mailing.net', (recipient,),
+                               self.spool.store(1, recipient, ['Subject: test\n', '\nHello\n']))
+        t0 = time.time()
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port, factory)
+        yield factory.deferred
+        # the 20 first emails are sent at once, then 20 emails per second
+        self.assertTrue(time.time() - t0 >= 0.2)
+        self.assertEqual(25, len(self.server.messages))
+
+
+class DroppingESMTP(smtp.ESMTP):
+    """
+    Once the first message is received, drops the connection when receiving a line starting with the `drop_on`
+    prefix of its factory. This happens only once.
+    """
+
+    def lineReceived(self, line):
+        if self.factory.drop_on and self.factory.messages and line.startswith(self.factory.drop_on):
+            self.factory.drop_on = None
+            self.transport.loseConnection()
+            return
+        smtp.ESMTP.lineReceived(self, line)
+
+
+class SMTPRelayerReconnectionTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServerFactory()
+        self.server.protocol = DroppingESMTP
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.spool = MessageSpool(self.mktemp(), max_memory=1000)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def _send(self, drop_on, reconnections=1):
+        self.server.drop_on = drop_on
+        self.factory = SMTPRelayerFactory('example.org', retries=0, timeout=5, reconnections=reconnections,
+                                          reconnectCallback=lambda connector, err: connector.connect())
+        results = []
+        for recipient in ('rcpt1@example.org', 'rcpt2@example.org', 'rcpt3@example.org'):
+            d = self.factory.send_email('sender@cloud-mailing.net', (recipient,),
+                                        self.spool.store(1, recipient, ['Subject: test\n', '\nHello\n']))
+            d.addErrback(lambda err: err.value)
+            results.append(d)
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port, self.factory)
+        return results
+
+    @defer.inlineCallbacks
+    def test_interrupted_before_content(self):
+        results = self._send('MAIL FROM:')
+        yield self.factory.deferred
+        results = yield defer.gatherResults(results)
+        self.assertEqual([1, 1, 1], [result[0] for result in results])
+        self.assertEqual(3, len(self.server.messages))
+        self.assertEqual(2, self.server.connections)
+        self.assertEqual(0, self.factory.reconnections)
+
+    @defer.inlineCallbacks
+    def test_interrupted_after_content(self):
+        results = self._send('.')
+        yield self.factory.deferred
+        ok, error, ok2 = yield defer.gatherResults(results)
+        self.assertIsInstance(error, smtp.SMTPClientError)
+        self.assertIsNone(error.code)
+        self.assertEqual((1, 1), (ok[0], ok2[0]))
+        self.assertEqual(2, len(self.server.messages))
+        self.assertEqual(2, self.server.connections)
+
+    @defer.inlineCallbacks
+    def test_no_reconnection_left(self):
+        results = self._send('.', reconnections=0)
+        yield self.assertFailure(self.factory.deferred, smtp.SMTPConnectError)
+        self.assertEqual(1, (yield results[0])[0])
+        self.assertIsInstance((yield results[1]), smtp.SMTPClientError)
+        self.assertIsInstance((yield results[2]), smtp.SMTPConnectError)
+        self.assertEqual(1, self.server.connections)
+
+
+class SMTPRelayerTranscriptTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServerFactory()
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.spool = MessageSpool(self.mktemp(), max_memory=1000)
+        self.transcripts = []
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_transcript(self):
+        factory = SMTPRelayerFactory('example.org', retries=0,
+                                     transcriptCallback=lambda t, target: self.transcripts.append((t, target)))
+        results = []
+        for recipient in ('rcpt1@example.org', 'bad@example.org'):
+            factory.send_email('sender@cloud-mailing.net', (recipient,),
+                               self.spool.store(1, recipient, ['Subject: test\n', '\nHello\n']))\
+                .addErrback(lambda err: err.value).addCallback(results.append)
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port, factory)
+        yield factory.deferred
+        # the error only holds its own part of the session
+        self.assertIn('RCPT TO:<bad@example.org>', results[1].log)
+        self.assertNotIn('rcpt1@example.org', results[1].log)
+        self.assertNotIn('EHLO', results[1].log)
+
+        transcript, target = self.transcripts[0]
+        self.assertEqual('127.0.0.1', target)
+        self.assertEqual(factory.session_id, transcript.session_id)
+        self.assertTrue(transcript.failed)
+        for line in ('EHLO', 'rcpt1@example.org', 'bad@example.org', 'QUIT'):
+            self.assertIn(line, transcript.full())
+        self.assertEqual(transcript.full(), decompress_transcript(transcript.compressed()))
+
+
+def make_server_tls_options():
+    from OpenSSL import crypto
+    from twisted.internet import ssl
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'mx.example.org'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return ssl.CertificateOptions(privateKey=key, certificate=cert, enableSessionTickets=True)
+
+
+class SMTPRelayerTLSTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServerFactory()
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.spool = MessageSpool(self.mktemp(), max_memory=1000)
+        self.handshakes = []
+        self.cache = TLSSessionCache(handshakeCallback=lambda host, resumed: self.handshakes.append(resumed))
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def _send(self, recipient):
+        factory = SMTPRelayerFactory('example.org', retries=0, tlsSessionCache=self.cache)
+        factory.send_email('sender@cloud-mailing.net', (recipient,),
+                           self.spool.store(1, recipient, ['Subject: test\n', '\nHello\n']))
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port, factory)
+        return factory.deferred
+
+    @defer.inlineCallbacks
+    def test_session_resumption(self):
+        self.server.contextFactory = make_server_tls_options()
+        yield self._send('rcpt1@example.org')
+        yield self._send('rcpt2@example.org')
+        self.assertEqual([False, True], self.handshakes)
+        self.assertEqual(0.5, self.cache.resumption_ratio)
+        self.assertEqual(2, len(self.server.messages))
+
+    @defer.inlineCallbacks
+    def test_plain_text_without_starttls(self):
+        yield self._send('rcpt1@example.org')
+        self.assertEqual([], self.handshakes)
+        self.assertEqual(1, len(self.server.messages))
+
+    def test_failed_handshake(self):
+        creator = self.cache.connection_creator('mx.example.org')
+        self.cache.handshake_failed(creator)
+        self.assertEqual(None, self.cache.connection_creator('mx.example.org'))
+        self.assertNotEqual(None, self.cache.connection_creator('mx2.example.org'))
+        self.assertEqual(1, self.cache.get_stats()['failures'])
+
+
+class RejectingSMTPServer(protocol.Protocol):
+    def connectionMade(self):
+        self.transport.write('554 No SMTP service here\r\n')
+
+
+class MXConnectorTestCase(TestCase):
+    """The good server listens on 127.0.0.1, other addresses on the same port are refused, silent or rejecting."""
+
+    def setUp(self):
+        self.server = FakeSMTPServerFactory()
+        self.ports = [reactor.listenTCP(0, self.server, interface='127.0.0.1')]
+        self.port = self.ports[0].getHost().port
+        self.spool = MessageSpool(self.mktemp(), max_memory=1000)
+        self.connected = []
+        self.failed = []
+
+    def tearDown(self):
+        return defer.gatherResults([port.stopListening() for port in self.ports])
+
+    def _listen(self, interface, protocol_class):
+        factory = protocol.ServerFactory()
+        factory.protocol = protocol_class
+        self.ports.append(reactor.listenTCP(self.port, factory, interface=interface))
+
+    def _send(self, addresses, hedge_delay=0, bind_address=None):
+        factory = SMTPRelayerFactory('example.org', retries=0, timeout=5)
+        self.email_result = factory.send_email('sender@cloud-mailing.net', ('rcpt@example.org',),
+                                               self.spool.store(1, 'rcpt@example.org',
+                                                                ['Subject: test\n', '\nHello\n']))
+        self.email_result.addErrback(lambda err: err.value)
+        self.connector = MXConnector(factory, addresses, self.port, hedge_delay=hedge_delay,
+                                     bind_address=bind_address,
+                                     mxConnectedCallback=self.connected.append,
+                                     mxFailedCallback=lambda address, err: self.failed.append(address))
+        self.connector.connect()
+        return factory.deferred
+
+    @defer.inlineCallbacks
+    def test_failover(self):
+        yield self._send(['127.0.0.2', '127.0.0.1'])
+        self.assertEqual(['127.0.0.1'], self.connected)
+        self.assertEqual(['127.0.0.2'], self.failed)
+        self.assertEqual(1, len(self.server.messages))
+
+    @defer.inlineCallbacks
+    def test_rejected_greeting(self):
+        self._listen('127.0.0.2', RejectingSMTPServer)
+        yield self._send(['127.0.0.2', '127.0.0.1'])
+        self.assertEqual(['127.0.0.1'], self.connected)
+        self.assertEqual(['127.0.0.2'], self.failed)
+        self.assertEqual(1, len(self.server.messages))
+
+    @defer.inlineCallbacks
+    def test_hedged_attempt(self):
+        self._listen('127.0.0.2', protocol.Protocol)
+        yield self._send(['127.0.0.2', '127.0.0.1'], hedge_delay=0.1)
+        self.assertEqual(['127.0.0.1'], self.connected)
+        self.assertEqual([], self.failed)
+        self.assertEqual(['cancelled', 'won'], [attempt.state for attempt in self.connector.attempts])
+        self.assertEqual(1, len(self.server.messages))
+
+    @defer.inlineCallbacks
+    def test_source_addresses(self):
+        yield self._send(['127.0.0.1'], bind_address=('127.0.0.2', 0))
+        yield self._send(['127.0.0.1'], bind_address=('127.0.0.3', 0))
+        self.assertEqual(['127.0.0.2', '127.0.0.3'], self.server.peers)
+
+    @defer.inlineCallbacks
+    def test_all_servers_failed(self):
+        self._listen('127.0.0.2', RejectingSMTPServer)
+        yield self.assertFailure(self._send(['127.0.0.2', '127.0.0.3']), smtp.SMTPConnectError)
+        self.assertEqual([], self.connected)
+        self.assertEqual(['127.0.0.2', '127.0.0.3'], self.failed)
+        self.assertIsInstance((yield self.email_result), smtp.SMTPConnectError)
+
+
+class PipeliningSMTPServer(basic.LineReceiver):
+    """
+    Minimal ESMTP server advertising PIPELINING (and CHUNKING if enabled by its factory).
+
+    To check that the client really pipelines its commands, replies to MAIL and RCPT commands are only sent with the
+    reply to DATA or BDAT.
+    """
+    delimiter = '\r\n'
+    MAX_LENGTH = 1000000
+
+    def connectionMade(self):
+        self.replies = []
+        self.data = None
+        self.bdat_chunks = []
+        self.bdat_remaining = 0
+        self.sendLine('220 fake.server ESMTP')
+
+    def lineReceived(self, line):
+        if self.data is not None:
+            if line == '.':
+                self.message_received('\n'.join(self.data))
+                self.data = None
+            else:
+                self.data.append(line[1:] if line.startswith('.') else line)
+            return
+        command, _, arg = line.partition(' ')
+        getattr(self, 'do_' + command.upper())(arg)
+
+    def reply(self, line, wait=False):
+        self.replies.append(line)
+        if not wait:
+            for reply in self.replies:
+                self.sendLine(reply)
+            self.replies = []
+
+    def message_received(self, message):
+        self.factory.messages.append(message)
+        self.reply('250 Ok queued')
+
+    def do_EHLO(self, arg):
+        self.sendLine('250-fake.server')
+        if self.factory.chunking:
+            self.sendLine('250-CHUNKING')
+        self.sendLine('250 PIPELINING')
+
+    def do_MAIL(self, arg):
+        self.recipients = []
+        self.reply('250 Ok', wait=True)
+
+    def do_RCPT(self, arg):
+        if 'error' in arg:
+            self.reply('550 Unknown recipient', wait=True)
+        else:
+            self.recipients.append(arg)
+            self.reply('250 Ok', wait=True)
+
+    def do_DATA(self, arg):
+        if not self.recipients:
+            self.reply('554 No valid recipients')
+        else:
+            self.data = []
+            self.reply('354 Go ahead')
+
+    def do_BDAT(self, arg):
+        args = arg.split()
+        self.bdat_last = len(args) > 1
+        self.bdat_remaining = int(args[0])
+        if self.bdat_remaining:
+            self.setRawMode()
+        else:
+            self.bdat_chunk_received()
+
+    def rawDataReceived(self, data):
+        chunk, rest = data[:self.bdat_remaining], data[self.bdat_remaining:]
+        self.bdat_chunks.append(chunk)
+        self.bdat_remaining -= len(chunk)
+        if not self.bdat_remaining:
+            self.bdat_chunk_received()
+            self.setLineMode(rest)
+
+    def bdat_chunk_received(self):
+        if not self.recipients:
+            self.bdat_chunks = []
+            self.reply('554 No valid recipients')
+        elif self.bdat_last:
+            message = ''.join(self.bdat_chunks).replace('\r\n', '\n')
+            self.bdat_chunks = []
+            self.message_received(message[:-1])
+        else:
+            self.reply('250 Chunk received')
+
+    def do_RSET(self, arg):
+        self.reply('250 Ok')
+
+    def do_QUIT(self, arg):
+        self.sendLine('221 Bye')
+        self.transport.loseConnection()
+
+
+class SMTPRelayerPipeliningTestCase(TestCase):
+    message = ['Subject: test\n', '\n.line starting with a dot\n', 'x' * 100000 + '\n']
+
+    def setUp(self):
+        self.server = protocol.ServerFactory()
+        self.server.protocol = PipeliningSMTPServer
+        self.server.messages = []
+        self.server.chunking = False
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.spool = MessageSpool(self.mktemp(), max_memory=1000000)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def _send(self, *recipients):
+        factory = SMTPRelayerFactory('example.org', retries=0)
+        results = []
+        for recipient in recipients:
+            d = factory.send_email('sender@cloud-mailing.net', (recipient,),
+                                   self.spool.store(1, recipient, self.message))
+            d.addErrback(lambda err: err.value)
+            results.append(d)
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port, factory)
+        yield factory.deferred
+        results = yield defer.gatherResults(results)
+        defer.returnValue(results)
+
+    def _check_results(self, results):
+        ok1, error, ok2 = results
+        self.assertEqual((1, [('rcpt1@example.org', 250, 'Ok')]), (ok1[0], [(str(a), c, r) for a, c, r in ok1[1]]))
+        self.assertIsInstance(error, smtp.SMTPDeliveryError)
+        self.assertEqual(550, error.addresses[0][1])
+        self.assertEqual(1, ok2[0])
+        self.assertEqual([''.join(self.message)[:-1]] * 2, self.server.messages)
+
+    @defer.inlineCallbacks
+    def test_pipelining(self):
+        results = yield self._send('rcpt1@example.org', 'error@example.org', 'rcpt2@example.org')
+        self._check_results(results)
+
+    @defer.inlineCallbacks
+    def test_chunking(self):
+        self.server.chunking = True
+        results = yield self._send('rcpt1@example.org', 'error@example.org', 'rcpt2@example.org')
+        self._check_results(results)
@@ -0,0 +1,52 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.trial.unittest import TestCase
+
+from ..source_ips import SourceIPPool
+
+__author__ = 'ricard'
+
+
+class SourceIPPoolTestCase(TestCase):
+    def setUp(self):
+        self.pool = SourceIPPool(['127.0.0.2', '127.0.0.3'])
+
+    def _connect(self, domain):
+        ip = self.pool.select(domain)
+        self.pool.acquire(ip, domain)
+        return ip
+
+    def test_least_loaded(self):
+        self.assertEqual('127.0.0.2', self._connect('example.org'))
+        self.assertEqual('127.0.0.3', self._connect('example.org'))
+        self.assertEqual('127.0.0.2', self._connect('example.org'))
+        # fewest connections to the domain first
+        self.assertEqual('127.0.0.3', self._connect('other.org'))
+        self.assertEqual('127.0.0.2', self._connect('other.org'))
+
+    def test_release(self):
+        self._connect('example.org')
+        self.pool.release('127.0.0.2', 'example.org')
+        self.assertEqual({}, dict(self.pool.connections))
+        self.assertEqual({}, dict(self.pool.domain_connections))
+
+    def test_sent_messages(self):
+        self.pool.add_sent('127.0.0.2')
+        self.assertEqual('127.0.0.3', self.pool.select('example.org'))
+        self.assertEqual([{'ip': '127.0.0.2', 'connections': 0, 'sent': 1},
+                          {'ip': '127.0.0.3', 'connections': 0, 'sent': 0}], self.pool.as_list())
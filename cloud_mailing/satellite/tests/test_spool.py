@@ -0,0 +1,95 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from twisted.trial.unittest import TestCase
+
+from ..spool import MessageSpool, SegmentsFile
+
+__author__ = 'ricard'
+
+
+class MessageSpoolTestCase(TestCase):
+    def setUp(self):
+        self.temp_path = self.mktemp()
+        self.spool = MessageSpool(self.temp_path, max_memory=100)
+
+    def test_store_in_memory(self):
+        message = self.spool.store(1, 'rcpt1', ['x' * 60])
+        self.assertTrue(message.in_memory)
+        self.assertEqual(60, self.spool.memory_size)
+        self.assertEqual('x' * 60, message.open().read())
+        self.assertIs(message, self.spool.get(1, 'rcpt1'))
+        self.assertEqual([], os.listdir(self.temp_path))
+
+        self.spool.release(message)
+        self.assertFalse(message.is_available)
+        self.assertEqual(0, self.spool.memory_size)
+        self.assertIsNone(self.spool.get(1, 'rcpt1'))
+        self.assertRaises(IOError, message.open)
+
+    def test_spill_to_disk(self):
+        self.spool.store(1, 'rcpt1', ['x' * 60])
+        message = self.spool.store(1, 'rcpt2', ['y' * 60])
+        self.assertFalse(message.in_memory)
+        self.assertEqual(60, self.spool.memory_size)
+        self.assertTrue(os.path.exists(message.path))
+        self.assertEqual('y' * 60, message.open().read())
+
+        self.spool.release(message)
+        self.assertFalse(os.path.exists(message.path))
+
+    def test_release_with_backup(self):
+        backup_path = self.mktemp()
+        os.makedirs(backup_path)
+        in_memory = self.spool.store(1, 'rcpt1', ['memory'])
+        on_disk = self.spool.store(1, 'rcpt2', ['disk'], on_disk=True)
+
+        self.spool.release(in_memory, backup_folder=backup_path)
+        self.spool.release(on_disk, backup_folder=backup_path)
+
+        self.assertEqual([], os.listdir(self.temp_path))
+        self.assertEqual('memory', open(os.path.join(backup_path, 'cust_ml_1_rcpt_rcpt1.rfc822')).read())
+        self.assertEqual('disk', open(os.path.join(backup_path, 'cust_ml_1_rcpt_rcpt2.rfc822')).read())
+
+    def test_release_mailing(self):
+        message1 = self.spool.store(1, 'rcpt1', ['x' * 60])
+        message2 = self.spool.store(1, 'rcpt2', ['x' * 60])
+        message3 = self.spool.store(2, 'rcpt3', ['x' * 10])
+
+        self.spool.release_mailing(1)
+
+        self.assertFalse(message1.is_available)
+        self.assertFalse(message2.is_available)
+        self.assertTrue(message3.is_available)
+        self.assertEqual(1, len(self.spool))
+        self.assertEqual(10, self.spool.memory_size)
+        self.assertEqual([], os.listdir(self.temp_path))
+
+
+class SegmentsFileTestCase(TestCase):
+    def test_read(self):
+        f = SegmentsFile(['abc', '', 'defgh', 'ij'])
+        self.assertEqual('ab', f.read(2))
+        self.assertEqual('cdefg', f.read(5))
+        self.assertEqual('hij', f.read())
+        self.assertEqual('', f.read(10))
+        f.seek(4)
+        self.assertEqual('efghij', f.read(100))
+        f.seek(0, 0)
+        self.assertEqual('abcdefghij', f.read())
@@ -0,0 +1,137 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from OpenSSL import SSL
+from OpenSSL._util import lib as _lib
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from zope.interface import implements
+
+__author__ = 'ricard'
+
+
+class _SessionConnectionCreator(object):
+    """Creates the TLS connection to a MX server, resuming its last session if any."""
+    implements(IOpenSSLClientConnectionCreator)
+
+    def __init__(self, cache, host):
+        self.cache = cache
+        self.host = host
+        self.handshake_done = False
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = SSL.Connection(self.cache.context, None)
+        connection.set_app_data(tlsProtocol)
+        if not isIPAddress(self.host) and not isIPv6Address(self.host):
+            connection.set_tlsext_host_name(self.host.encode('idna'))
+        session = self.cache.get_session(self.host)
+        if session is not None:
+            connection.set_session(session)
+        return connection
+
+
+class TLSSessionCache(object):
+    """
+    TLS client context for opportunistic STARTTLS, keeping the last session negotiated with each MX server so the
+    next connections resume it (abbreviated handshake) instead of doing a full one.
+
+    Certificates are not verified: encryption is only opportunistic, and MX servers rarely present a certificate
+    matching their name. A server failing the handshake is contacted in plain text during `failure_delay` seconds.
+    """
+
+    def __init__(self, max_age=3600, failure_delay=3600, clock=None, handshakeCallback=None):
+        """
+        @param max_age: delay, in seconds, after which a session isn't resumed anymore.
+        @param handshakeCallback: called with the server name and True if the session was resumed, after each
+            successful handshake.
+        """
+        self.max_age = max_age
+        self.failure_delay = failure_delay
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.log = logging.getLogger('tls')
+        self._handshakeCallback = handshakeCallback
+        self.context = SSL.Context(SSL.SSLv23_METHOD)
+        self.context.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3 | SSL.OP_NO_COMPRESSION)
+        self.context.set_verify(SSL.VERIFY_NONE, lambda *args: True)
+        self._sessions = {}  # key = server name, value = (expiration, session)
+        self._failed = {}  # key = server name, value = time until which STARTTLS isn't used
+        self.handshakes = 0
+        self.resumed = 0
+        self.failures = 0
+
+    def connection_creator(self, host):
+        """Returns the context to give to STARTTLS for this server, or None if it failed recently."""
+        if self._failed.get(host, 0) > self.clock.seconds():
+            return None
+        self._failed.pop(host, None)
+        return _SessionConnectionCreator(self, host)
+
+    def get_session(self, host):
+        entry = self._sessions.get(host)
+        if entry is None:
+            return None
+        if entry[0] <= self.clock.seconds():
+            self._sessions.pop(host, None)
+            return None
+        return entry[1]
+
+    def store_session(self, host, connection):
+        """Keeps the session of the connection, to be resumed by the next connections to this server."""
+        session = connection.get_session()
+        if session is not None:
+            self._sessions[host] = (self.clock.seconds() + self.max_age, session)
+
+    def handshake_done(self, creator, connection):
+        """Called once the handshake made by a connection of `connection_creator()` succeeded."""
+        if creator.handshake_done:
+            return
+        creator.handshake_done = True
+        resumed = bool(_lib.SSL_session_reused(connection._ssl))
+        self.handshakes += 1
+        if resumed:
+            self.resumed += 1
+        self.store_session(creator.host, connection)
+        if self._handshakeCallback:
+            self._handshakeCallback(creator.host, resumed)
+
+    def handshake_failed(self, creator):
+        self.failures += 1
+        self._sessions.pop(creator.host, None)
+        self._failed[creator.host] = self.clock.seconds() + self.failure_delay
+        self.log.warn("TLS handshake with '%s' failed. Using plain text for %ds.", creator.host, self.failure_delay)
+
+    @property
+    def resumption_ratio(self):
+        return self.handshakes and float(self.resumed) / self.handshakes or 0.0
+
+    def get_stats(self):
+        return {'handshakes': self.handshakes, 'resumed': self.resumed, 'failures': self.failures,
+                'resumption_ratio': self.resumption_ratio, 'sessions': len(self._sessions)}
+
+    def cleanup(self):
+        """Forgets expired sessions and failures."""
+        now = self.clock.seconds()
+        for host, entry in self._sessions.items():
+            if entry[0] <= now:
+                self._sessions.pop(host, None)
+        for host, expiration in self._failed.items():
+            if expiration <= now:
+                self._failed.pop(host, None)
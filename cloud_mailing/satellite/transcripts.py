@@ -0,0 +1,63 @@
+# Copyright 2015 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import zlib
+
+from bson import Binary, ObjectId
+
+from ..common.email_tools import decompress_transcript
+
+__author__ = 'ricard'
+
+
+class SessionTranscript(object):
+    """
+    Log of a whole SMTP session, used by the relayer instead of the ring buffer (C{LineLog}) of twisted's client.
+
+    `clear()`, called by the client once an email is sent, forgets nothing: it only starts the part of the next
+    email, which is what `str()` returns. So each recipient keeps its own part, while the whole transcript is
+    stored only once, with `session_id` as id.
+    """
+
+    def __init__(self, max_lines=10000):
+        self.session_id = str(ObjectId())
+        self.max_lines = max_lines
+        self.lines = []
+        self.start = 0  # first line of the current email
+        self.truncated = 0
+        self.failed = False
+
+    def append(self, line):
+        if len(self.lines) >= self.max_lines:
+            self.truncated += 1
+            return
+        self.lines.append(line)
+
+    def str(self):
+        return '\n'.join(self.lines[self.start:])
+
+    def clear(self):
+        self.start = len(self.lines)
+
+    def full(self):
+        text = '\n'.join(self.lines)
+        if self.truncated:
+            text += '\n[%d lines truncated]' % self.truncated
+        return text
+
+    def compressed(self):
+        return Binary(zlib.compress(self.full()))
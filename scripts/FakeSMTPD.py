@@ -28,6 +28,82 @@ from datetime import datetime
 
 
 class FakeSMTPChannel(smtpd.SMTPChannel):
+    def __init__(self, server, conn, addr, extensions=()):
+        """
+        @param extensions: ESMTP extensions to advertise (only PIPELINING and CHUNKING are supported). If empty, EHLO
+        command isn't implemented, as with the standard smtpd module.
+        """
+        self.extensions = list(extensions)
+        self._bdat_chunks = []
+        self._bdat_size = None  # size of the BDAT chunk being received
+        self._bdat_last = False
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+
+    def smtp_EHLO(self, arg):
+        if not self.extensions:
+            self.push('502 Error: command "EHLO" not implemented')
+            return
+        if not arg:
+            self.push('501 Syntax: EHLO hostname')
+            return
+        if self._SMTPChannel__greeting:
+            self.push('503 Duplicate HELO/EHLO')
+            return
+        self._SMTPChannel__greeting = arg
+        lines = [self._SMTPChannel__fqdn] + self.extensions
+        self.push('\r\n'.join(['250-%s' % line for line in lines[:-1]] + ['250 %s' % lines[-1]]))
+
+    def smtp_RSET(self, arg):
+        self._bdat_chunks = []
+        smtpd.SMTPChannel.smtp_RSET(self, arg)
+
+    def smtp_BDAT(self, arg):
+        if 'CHUNKING' not in self.extensions:
+            self.push('502 Error: command "BDAT" not implemented')
+            return
+        args = (arg or '').split()
+        if not 1 <= len(args) <= 2 or not args[0].isdigit() or len(args) == 2 and args[1].upper() != 'LAST':
+            self.push('501 Syntax: BDAT size [LAST]')
+            return
+        self._bdat_last = len(args) == 2
+        size = int(args[0])
+        if size:
+            # chunk data is received by found_terminator()
+            self._bdat_size = size
+            self.set_terminator(size)
+        else:
+            self._bdat_chunk_received('')
+
+    def found_terminator(self):
+        if self._bdat_size is None:
+            return smtpd.SMTPChannel.found_terminator(self)
+        chunk = ''.join(self._SMTPChannel__line)
+        self._SMTPChannel__line = []
+        self._bdat_size = None
+        self.set_terminator('\r\n')
+        self._bdat_chunk_received(chunk)
+
+    def _bdat_chunk_received(self, chunk):
+        if not self._SMTPChannel__rcpttos:
+            self._bdat_chunks = []
+            self.push('503 Error: need RCPT command')
+            return
+        self._bdat_chunks.append(chunk)
+        if not self._bdat_last:
+            self.push('250 %d octets received' % len(chunk))
+            return
+        data = ''.join(self._bdat_chunks).replace('\r\n', '\n')
+        if data.endswith('\n'):
+            data = data[:-1]  # as for DATA command, without the last line ending
+        self._bdat_chunks = []
+        status = self._SMTPChannel__server.process_message(self._SMTPChannel__peer,
+                                                           self._SMTPChannel__mailfrom,
+                                                           self._SMTPChannel__rcpttos,
+                                                           data)
+        self._SMTPChannel__rcpttos = []
+        self._SMTPChannel__mailfrom = None
+        self.push(status or '250 Ok')
+
     def smtp_RCPT(self, arg):
         print >> smtpd.DEBUGSTREAM, '===> RCPT', arg
         if not self._SMTPChannel__mailfrom:
@@ -52,8 +128,9 @@ class FakeSMTPChannel(smtpd.SMTPChannel):
         self.push('250 Ok')
 
 class FakeSMTPD(smtpd.SMTPServer):
-    def __init__(self, localaddr, remoteaddr):
+    def __init__(self, localaddr, remoteaddr, extensions=()):
         smtpd.SMTPServer.__init__(self, localaddr, remoteaddr)
+        self.extensions = extensions
         self.t0 = time.time()
         self.last_time = 0
         self.email_count = 0
@@ -67,7 +144,7 @@ class FakeSMTPD(smtpd.SMTPServer):
         if pair is not None:
             conn, addr = pair
             print 'Incoming connection from %s' % repr(addr)
-            channel = FakeSMTPChannel(self, conn, addr)
+            channel = FakeSMTPChannel(self, conn, addr, self.extensions)
 
     def process_message(self, peer, mailfrom, rcpttos, data):
         with self.lock:
@@ -91,12 +168,21 @@ class FakeSMTPD(smtpd.SMTPServer):
                 (self.bandwidth / 1024.0) / delta)
         
 if __name__ == "__main__":
+    # usage: FakeSMTPD.py [port] [--pipelining] [--chunking]
     port = 25
-    if len(sys.argv) > 1:
-        port = int(sys.argv[1])
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if args:
+        port = int(args[0])
+    extensions = []
+    if '--pipelining' in sys.argv:
+        extensions.append('PIPELINING')
+    if '--chunking' in sys.argv:
+        extensions.append('CHUNKING')
+    if extensions:
+        extensions.append('8BITMIME')
     # smtpd.DEBUGSTREAM = sys.stdout
-    server = FakeSMTPD(("0.0.0.0", port), None)
+    server = FakeSMTPD(("0.0.0.0", port), None, extensions)
     
-    print "Fake SMTP server listening on port %d" % port
+    print "Fake SMTP server listening on port %d%s" % (port, extensions and " with %s" % ', '.join(extensions) or "")
     asyncore.loop()
     